@@ -1083,6 +1083,68 @@ module ChefConfig
     # round trips.
     default :rubygems_cache_enabled, false
 
+    # The dnf_package python helper keeps a separately loaded sack for every distinct set of
+    # --enablerepo/--disablerepo options that it is queried with, so that repo-scoped package
+    # resources do not force the helper to restart and reload all of the repository metadata.
+    # This caps how many of those sacks are held in memory at once, the least recently used
+    # sack is dropped when the cap is reached.
+    default :dnf_helper_max_sacks, 4
+
+    # If a long-running dnf_helper.py is listening on this Unix socket (started with
+    # "dnf_helper.py --daemon <path>", e.g. from a systemd unit) the dnf_package provider uses it
+    # instead of spawning a new helper, so that the repository metadata stays loaded between
+    # chef-client runs.  The daemon takes its tunables from its own environment rather than from
+    # this config.  If the socket does not exist a helper process is started as before.
+    default :dnf_helper_socket, "/run/#{ChefUtils::Dist::Infra::DIR_SUFFIX}/dnf_helper.sock"
+
+    # Start the dnf_package python helper at the start of the compile phase and have it load the
+    # rpmdb and repository metadata in the background, so that the loading overlaps with recipe
+    # compilation rather than stalling the first package resource.  This costs the memory of the
+    # helper on runs that turn out not to have any package resources.
+    default :dnf_helper_preload, false
+
+    # Have the dnf_package python helper run install and remove transactions itself, with the
+    # repository metadata that it already has loaded, rather than running the dnf command which
+    # loads all of it again.  This is only done for resources without an environment and with no
+    # options other than --enablerepo/--disablerepo, anything else still runs the dnf command.
+    default :dnf_helper_transactions, false
+
+    # The dnf_package python helper lives for the whole chef-client run and its loaded repository
+    # metadata can take hundreds of MB.  Above this RSS (in MB) it drops all but the most recently
+    # used of its sacks, and after this many seconds without a query it drops all of them.  A
+    # dropped sack is rebuilt from the solv files in the dnf cache when it is next needed.  Both
+    # are off when nil.
+    default :dnf_helper_memory_budget, nil
+    default :dnf_helper_idle_timeout, nil
+
+    # When the dnf_package python helper may refresh the repository metadata.  With "expire" it
+    # honours the metadata_expire of each repo like the dnf command does, so the first package
+    # resource to need a repo can block on downloading its metadata mid-converge.  With
+    # "never_expire" only repos with nothing cached are downloaded, and with "cache_only" nothing
+    # ever is.  Under those two the metadata is only refreshed by a flush_cache of a dnf_package
+    # resource (or its :flush_cache action), as a separate step at a point of your choosing.
+    default :dnf_helper_metadata_policy, "expire"
+
+    # A directory with a snapshot of the repository metadata, written on another node with the same
+    # repos by Chef::Provider::Package::Dnf::PythonHelper#export_snapshot and shipped to this one.
+    # The dnf_package python helper stages it into the dnf cache before loading the metadata, so that
+    # the solv files in it are used instead of parsing the repodata XML.  Repos that are configured
+    # differently, or that already have newer metadata in the cache, are loaded as usual.
+    default :dnf_helper_snapshot, nil
+
+    # Before the dnf_package python helper loads the repository metadata, have it rebuild the
+    # stale solv caches of the enabled repos in a pool of up to this many processes, instead of
+    # parsing the metadata of one repo after another.  This only helps with several repos whose
+    # metadata changed since they were last loaded, and costs the memory of the extra processes
+    # while they run.  Off when nil.
+    default :dnf_helper_parallel_load, nil
+
+    # Resolve the packages of every dnf_package and yum_package resource with one request to the
+    # python helper as the converge phase starts, instead of with one request per resource as it is
+    # converged.  This loads the repository metadata up front even on runs where no resource would
+    # have needed it, and the answers are only kept until the installed packages change.
+    default :package_helper_prefetch, false
+
     config_context :windows_service do
       # Set `watchdog_timeout` to the number of seconds to wait for a chef-client run
       # to finish
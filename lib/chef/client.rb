@@ -58,6 +58,9 @@ require "rbconfig" unless defined?(RbConfig)
 require "forwardable" unless defined?(Forwardable)
 
 require_relative "compliance/runner"
+require_relative "provider/package/dnf/preloader"
+require_relative "provider/package/dnf/stats_collector"
+require_relative "provider/package/prefetcher"
 
 class Chef
   # == Chef::Client
@@ -251,6 +254,9 @@ class Chef
         events.register(Chef::DataCollector::Reporter.new(events))
         events.register(Chef::ActionCollection.new(events))
         events.register(Chef::Compliance::Runner.new)
+        events.register(Chef::Provider::Package::Dnf::Preloader.new)
+        events.register(Chef::Provider::Package::Dnf::StatsCollector.new)
+        events.register(Chef::Provider::Package::Prefetcher.new)
 
         run_status.run_id = request_id = Chef::RequestID.instance.request_id
 
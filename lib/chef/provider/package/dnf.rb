@@ -24,6 +24,7 @@ require_relative "../../mixin/shell_out"
 require_relative "../../mixin/get_source_from_package"
 require_relative "dnf/python_helper"
 require_relative "dnf/version"
+require_relative "dnf/version_compare"
 
 class Chef
   class Provider
@@ -57,18 +58,17 @@ class Chef
         # a request to the python side.  The python side is then responsible for knowing everything
         # about RPMs and what is installed and what is available.  The ruby side of this class should
         # remain a lightweight translation layer to translate Chef requests into RPC requests to
-        # python.  This class knows nothing about how to compare RPM versions, and does not maintain
-        # any cached state of installed/available versions and should be kept that way.
+        # python.  The one exception is comparing RPM versions, which is done in-process by the
+        # VersionCompare port of the helper's comparison to save a round-trip per comparison.  This
+        # class does not maintain any cached state of installed/available versions and should be kept
+        # that way.
         #
         def python_helper
           @python_helper ||= PythonHelper.instance
         end
 
         def dnf5?
-          @dnf5 ||= begin
-            dnf_version = shell_out!("dnf --version").stdout
-            dnf_version =~ /dnf5/i
-          end
+          python_helper.backend_info["cli_version"] == 5
         end
 
         def load_current_resource
@@ -124,9 +124,11 @@ class Chef
             dnf(options, "-y", "install", new_resource.source)
           else
             resolved_names = names.each_with_index.map { |name, i| available_version(i).to_s unless name.nil? }
+            return helper_transaction(:install, resolved_names) if helper_transaction?
+
             dnf(options, "-y", "install", resolved_names)
           end
-          flushcache
+          refresh_installed
         end
 
         # dnf upgrade does not work on uninstalled packaged, while install will upgrade
@@ -134,8 +136,10 @@ class Chef
 
         def remove_package(names, versions)
           resolved_names = names.each_with_index.map { |name, i| magical_version(i).to_s unless name.nil? }
+          return helper_transaction(:remove, resolved_names) if helper_transaction?
+
           dnf(options, "-y", "remove", resolved_names)
-          flushcache
+          refresh_installed
         end
 
         alias purge_package remove_package
@@ -177,9 +181,12 @@ class Chef
           end
         end
 
+        # the helper reads the lock list of the dnf libraries that it uses, which are not necessarily the ones of the dnf command
         def locked_packages
           @locked_packages ||=
-            begin
+            if python_helper.backend_info["dnf_version"] == python_helper.backend_info["cli_version"]
+              python_helper.versionlock_list
+            else
               locked = dnf("versionlock", "list")
               if dnf5?
                 locked.stdout.each_line.select { |x| x.start_with?("Package name:") }
@@ -203,27 +210,50 @@ class Chef
         def version_gt?(v1, v2)
           return false if v1.nil? || v2.nil?
 
-          python_helper.compare_versions(v1, v2) == 1
+          VersionCompare.compare(v1, v2) == 1
         end
 
         def version_equals?(v1, v2)
           return false if v1.nil? || v2.nil?
 
-          python_helper.compare_versions(v1, v2) == 0
+          VersionCompare.compare(v1, v2) == 0
         end
 
         def version_compare(v1, v2)
-          python_helper.compare_versions(v1, v2)
+          VersionCompare.compare(v1, v2)
         end
 
         def resolve_source_to_version_obj
-          shell_out!("rpm -qp --queryformat '%{NAME} %{EPOCH} %{VERSION} %{RELEASE} %{ARCH}\n' #{new_resource.source}").stdout.each_line do |line|
-            # this is another case of committing the sin of doing some lightweight mangling of RPM versions in ruby -- but the output of the rpm command
-            # does not match what the yum library accepts.
-            case line
-              when /^(\S+)\s+(\S+)\s+(\S+)\s+(\S+)\s+(\S+)$/
-                return Version.new($1, "#{$2 == "(none)" ? "0" : $2}:#{$3}-#{$4}", $5)
-            end
+          python_helper.read_rpm_headers([ new_resource.source ]).first
+        end
+
+        # multipackage resources resolve all of their packages with a single batch request to the
+        # python helper instead of one round-trip per package.
+        def batch_query?
+          !new_resource.source && package_name_array.length > 1
+        end
+
+        # fills in every unresolved index of the version cache array with one batch request
+        #
+        # @return [Array<Version>]
+        def batch_query(cache, action, versions)
+          missing = package_name_array.each_index.select { |i| cache[i].nil? }
+          results = python_helper.package_query_batch(action, missing.map { |i| package_name_array[i] }, versions: missing.map { |i| versions[i] }, arches: missing.map { |i| safe_arch_array[i] }, options: options)
+          missing.zip(results).each { |i, version| cache[i] = version }
+          cache
+        end
+
+        # resolves the available versions of every package that does not have one yet with a single request to the python
+        # helper, which answers their installed and current versions in the same round-trip
+        def resolve_packages
+          missing = package_name_array.each_index.select { |i| @available_version[i].nil? }
+          resolutions = python_helper.resolve_batch(missing.map { |i| package_name_array[i] }, versions: missing.map { |i| safe_version_array[i] }, arches: missing.map { |i| safe_arch_array[i] }, options: options)
+          @magical_version ||= []
+          @current_version ||= []
+          missing.zip(resolutions).each do |i, resolution|
+            @available_version[i] = resolution[:available]
+            @magical_version[i] ||= resolution[:installed]
+            @current_version[i] ||= resolution[:current]
           end
         end
 
@@ -234,7 +264,8 @@ class Chef
           @available_version[index] ||= if new_resource.source
                                           resolve_source_to_version_obj
                                         else
-                                          python_helper.package_query(:whatavailable, package_name_array[index], version: safe_version_array[index], arch: safe_arch_array[index], options: options)
+                                          resolve_packages
+                                          @available_version[index]
                                         end
 
           @available_version[index]
@@ -245,6 +276,8 @@ class Chef
           @magical_version ||= []
           @magical_version[index] ||= if new_resource.source
                                         python_helper.package_query(:whatinstalled, available_version(index).name, version: safe_version_array[index], arch: safe_arch_array[index], options: options)
+                                      elsif batch_query?
+                                        batch_query(@magical_version, :whatinstalled, safe_version_array)[index]
                                       else
                                         python_helper.package_query(:whatinstalled, package_name_array[index], version: safe_version_array[index], arch: safe_arch_array[index], options: options)
                                       end
@@ -255,23 +288,46 @@ class Chef
           @current_version ||= []
           @current_version[index] ||= if new_resource.source
                                         python_helper.package_query(:whatinstalled, available_version(index).name, arch: safe_arch_array[index], options: options)
+                                      elsif batch_query?
+                                        batch_query(@current_version, :whatinstalled, [])[index]
                                       else
                                         python_helper.package_query(:whatinstalled, package_name_array[index], arch: safe_arch_array[index], options: options)
                                       end
           @current_version[index]
         end
 
-        # cache flushing is accomplished by simply restarting the python helper.  this produces a roughly
-        # 15% hit to the runtime of installing/removing/upgrading packages.  correctly using multipackage
-        # array installs (and the multipackage cookbook) can produce 600% improvements in runtime.
+        # cache flushing is accomplished by restarting the python helper (or telling the helper daemon to drop
+        # its sacks), which throws away all of the loaded repository metadata.  this is only done when the user
+        # explicitly asks for it, and is also when the metadata is refreshed under the "never_expire" and
+        # "cache_only" metadata policies.
         def flushcache
-          python_helper.restart
+          python_helper.flush_cache(options: options)
+        end
+
+        # after a transaction only the rpmdb has changed, so the helper just reloads the installed packages
+        # and keeps the (expensive to load) available repository metadata in memory.
+        def refresh_installed
+          python_helper.refresh_installed
         end
 
         def dnf(*args)
           shell_out!("dnf", *args, env: new_resource.environment)
         end
 
+        # the python helper can only be passed the --enablerepo/--disablerepo options, and not an environment
+        def helper_transaction?
+          Chef::Config[:dnf_helper_transactions] &&
+            new_resource.environment.empty? &&
+            Array(options).all? { |opt| opt.to_s.match?(/\A--(enable|disable)repo=/) }
+        end
+
+        # runs the transaction in the python helper, which already has the repository metadata loaded and
+        # reloads the installed packages itself afterwards
+        def helper_transaction(action, resolved_names)
+          result = python_helper.transaction(action, resolved_names.compact, options: options, timeout: new_resource.timeout&.to_i || 900)
+          logger.debug("#{new_resource}: dnf python helper installed #{result["installed"]} and removed #{result["removed"]}")
+        end
+
         def safe_version_array
           if new_resource.version.is_a?(Array)
             new_resource.version
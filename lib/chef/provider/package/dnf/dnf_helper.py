@@ -22,109 +22,1154 @@ import sys
 import signal
 import os
 import json
+import collections
+import concurrent.futures
+import configparser
+import contextlib
+import ctypes
+import functools
+import gc
+import hashlib
+import importlib
+import importlib.util
+import multiprocessing
+import shutil
+import socket
+import threading
+import time
+import xml.etree.ElementTree
 
 # to enable debug logging, set the CHEF_DNF_HELPER_DEBUG_FILE environment
 # variable to a file path
 DEBUG_FILE = os.environ.get("CHEF_DNF_HELPER_DEBUG_FILE", None)
+debug_file = None
 
-# Try to import dnf5 first, fall back to dnf4
-try:
-    import libdnf5
-    import rpm
+HELPER_STARTED = time.monotonic()
 
+# Like "dnf --installroot", when CHEF_DNF_HELPER_INSTALLROOT is set the rpmdb,
+# the configuration, the repo files and the cache are all taken from under that
+# directory instead of from the host.  This is mostly useful for benchmarking
+# the helper against synthetic repositories.
+INSTALLROOT = os.environ.get("CHEF_DNF_HELPER_INSTALLROOT", "/")
+
+# Timings returned by the "stats" action: the total time spent in each phase of
+# loading the sacks, the time spent answering each action, and the duration of
+# the most recent sack loads.
+stats = {
+    "phases": {},
+    "queries": {},
+    "sack_loads": collections.deque(maxlen=20),
+    "parallel_loads": collections.deque(maxlen=20),
+    "memory": {"releases": 0, "evictions": 0},
+}
+
+
+class LazyModule:
+    """
+    A module that is only imported when one of its attributes is first used.
+    Importing the dnf stack takes a good part of a second, which the helper
+    would otherwise spend before it can answer anything, even the commands
+    that never need it (stats, versioncompare, read_rpm_headers, ...).
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            started = time.monotonic()
+            self._module = importlib.import_module(self._name)
+            record(stats["phases"], "import", time.monotonic() - started)
+            log(f"  => importing {self._name} took {time.monotonic() - started:.3f}s")
+        return getattr(self._module, attr)
+
+
+# Use dnf5 if it is installed, fall back to dnf4.  Setting
+# CHEF_DNF_HELPER_DNF_VERSION to 4 forces the dnf4 libraries on hosts that have
+# both.  Which one is installed is found without importing either of them.
+if os.environ.get("CHEF_DNF_HELPER_DNF_VERSION") != "4" and importlib.util.find_spec("libdnf5"):
     DNF_VERSION = 5
-except ImportError:
+elif importlib.util.find_spec("dnf"):
+    DNF_VERSION = 4
+else:
+    raise RuntimeError(
+        "Neither dnf5 (libdnf5) nor dnf4 (dnf) libraries are available"
+    )
+
+libdnf5 = LazyModule("libdnf5")
+dnf = LazyModule("dnf")
+hawkey = LazyModule("hawkey")
+rpm = LazyModule("rpm")
+
+# The rpmdb is loaded on its own into a base that only has the @System repo.
+# That base is shared by every repo set and answers all whatinstalled queries,
+# so a converged node which only ever asks what is installed never has to
+# load any remote repository metadata.
+installed_base = None
+
+# Bases with the remote repository metadata are only loaded the first time a
+# query actually needs them.  They are kept per set of --enablerepo/--disablerepo
+# options so that repo-scoped queries do not force the whole sack to be thrown
+# away and reloaded.  The cache is kept in least-recently-used order and is
+# capped by the CHEF_DNF_HELPER_MAX_SACKS environment variable.
+MAX_SACKS = max(1, int(os.environ.get("CHEF_DNF_HELPER_MAX_SACKS", "4")))
+bases = collections.OrderedDict()
+
+# When running as a daemon the loaded bases outlive a single chef-client run.
+# For every loaded base we remember a fingerprint of the configuration files
+# and of the cached repomd.xml of each enabled repository, along with the time
+# that its metadata expires, and the base is thrown away at the start of the
+# next connection if any of that has changed.
+base_validity = {}
+
+# The rpmdb cookie at the time that the @System repo of each base was loaded.
+# refresh_installed reloads it in every base when the rpmdb changes, and a
+# transaction is never resolved against a base with a stale copy of it.
+base_rpmdb = {}
+
+# Only the primary metadata of the repositories is loaded by default.  The
+# filelists are usually larger than all of the rest of the metadata put
+# together and are only needed to look up packages by the paths of the files
+# in them, so they are only loaded into a base the first time that a query
+# asks for a path ("/usr/bin/perl"), or when the primary metadata had no answer
+# for a query.  This holds the repo keys of the bases that have them.
+filelists_bases = set()
+
+# The NEVRAs of the local rpm files read by read_rpm_headers(), keyed on the
+# path, size and mtime of each file so that a file that is replaced is read
+# again.
+rpm_headers = {}
+
+# The SackIndex of each dnf5 base, by id(base).  It is built by the first
+# query on the base and dropped by close_base().
+sack_indexes = {}
+
+
+# Answers to whatinstalled/whatavailable queries are memoized for the life of
+# the helper, keyed on the normalized query.  The whole cache is thrown away
+# whenever the rpmdb changes, and the answers from the available repos go
+# along with the base that they came from.
+results_cache = {}
+cache_stats = {"hits": 0, "misses": 0}
+rpmdb_cookie = None
+
+# All of the loading and querying of sacks is done while holding this lock, so
+# that the sack can be prefetched in a background thread while the helper waits
+# for its first command.  That command then only blocks on whatever loading is
+# still left to do.
+lock = threading.Lock()
+prefetch_thread = None
+
+# A loaded sack can take hundreds of MB, which a helper that lives for the
+# whole chef-client run holds on to between the package resources.  Above
+# CHEF_DNF_HELPER_MEMORY_BUDGET (in MB) of RSS the least recently used sacks are
+# dropped after each command, down to the one that is in use, and after
+# CHEF_DNF_HELPER_IDLE_TIMEOUT seconds without a command all of the sacks are
+# dropped.  Both are off when unset or 0.  A dropped sack is rebuilt from the
+# solv files in the dnf cache by the next query that needs it, without parsing
+# or downloading the repository metadata again.
+MEMORY_BUDGET = int(os.environ.get("CHEF_DNF_HELPER_MEMORY_BUDGET") or 0) * 1024 * 1024
+IDLE_TIMEOUT = float(os.environ.get("CHEF_DNF_HELPER_IDLE_TIMEOUT") or 0)
+last_command = time.monotonic()
+watchdog_thread = None
+
+# CHEF_DNF_HELPER_METADATA_POLICY decides whether a query may refresh the
+# repository metadata.  "expire" (the default) honours the metadata_expire of
+# every repo like the dnf command does, so whichever query first loads a sack
+# can block on downloading metadata in the middle of the converge.
+# "never_expire" only downloads the metadata of repos that have nothing cached
+# and "cache_only" never downloads any metadata (queries on a repo without a
+# cache fail), although transactions still download the packages that they
+# install.  With either of those the metadata is only brought up to date by an
+# explicit "refresh_metadata" command.
+METADATA_POLICIES = ("expire", "never_expire", "cache_only")
+METADATA_POLICY = os.environ.get("CHEF_DNF_HELPER_METADATA_POLICY") or "expire"
+if METADATA_POLICY not in METADATA_POLICIES:
+    raise RuntimeError(f"unknown metadata policy {METADATA_POLICY!r}")
+
+# Nodes that share the same mirrored repositories can skip downloading and
+# parsing the repository metadata each on their own: export_snapshot() copies
+# the repodata and the solv files that libsolv builds from it out of the dnf
+# cache, along with a manifest of the repomd.xml checksums, and import_snapshot()
+# stages them into the dnf cache of another node.  libsolv loads a solv file
+# instead of parsing the XML whenever the checksum stored in it matches the
+# repomd.xml.  When CHEF_DNF_HELPER_SNAPSHOT is set to the directory of such a
+# snapshot it is imported before every sack is loaded.
+SNAPSHOT = os.environ.get("CHEF_DNF_HELPER_SNAPSHOT") or None
+SNAPSHOT_FORMAT = 1
+REPOMD_NS = "{http://linux.duke.edu/metadata/repo}"
+
+# With many enabled repos most of the first load of a sack is spent parsing the
+# metadata of one repo after another on a single core.  When
+# CHEF_DNF_HELPER_PARALLEL_LOAD is above 1 the repos whose solv cache is stale
+# are first loaded each on its own in a pool of up to that many processes,
+# which writes their solv caches, and the sack is then loaded exactly as it is
+# without the pool, only from those caches.
+PARALLEL_LOAD = max(1, int(os.environ.get("CHEF_DNF_HELPER_PARALLEL_LOAD") or 1))
+
+# The answer to a whatinstalled/whatavailable query, evr and arch are None
+# when nothing matched.
+Package = collections.namedtuple("Package", ["name", "evr", "arch"])
+
+# An enabled repository of a base, see enabled_repos().
+Repo = collections.namedtuple("Repo", ["id", "cachedir", "expire", "baseurls"])
+
+
+def record(table, name, seconds):
+    entry = table.setdefault(name, {"count": 0, "seconds": 0.0})
+    entry["count"] += 1
+    entry["seconds"] += seconds
+
+
+@contextlib.contextmanager
+def timed(phase):
+    started = time.monotonic()
     try:
-        import dnf
-        import hawkey
+        yield
+    finally:
+        elapsed = time.monotonic() - started
+        record(stats["phases"], phase, elapsed)
+        log(f"  => {phase} took {elapsed:.3f}s")
+
+
+def get_stats():
+    return {
+        "helper": f"dnf{DNF_VERSION}",
+        "uptime": time.monotonic() - HELPER_STARTED,
+        "phases": stats["phases"],
+        "queries": stats["queries"],
+        "sack_loads": list(stats["sack_loads"]),
+        "parallel_loads": list(stats["parallel_loads"]),
+        "cache": dict(cache_stats, entries=len(results_cache)),
+        "memory": dict(stats["memory"], rss=get_rss()),
+        "metadata_policy": METADATA_POLICY,
+        "snapshot": SNAPSHOT,
+    }
+
+
+def repo_key(command):
+    """
+    Normalize the repo options of a command into a hashable key.
 
-        DNF_VERSION = 4
-    except ImportError:
-        raise RuntimeError(
-            "Neither dnf5 (libdnf5) nor dnf4 (dnf) libraries are available"
+    The order of the enable/disable patterns is significant ("disable *, then
+    enable foo" is not the same as the other way around), so it is preserved,
+    but repeated patterns are collapsed.
+    """
+    key = []
+    for repo_pattern in command.get("repos", []):
+        for op in ("enable", "disable"):
+            if op in repo_pattern:
+                entry = (op, repo_pattern[op])
+                if entry in key:
+                    key.remove(entry)
+                key.append(entry)
+    return tuple(key)
+
+
+def configure_base_dnf5(filelists=False, refresh=False):
+    base = libdnf5.base.Base()
+    config = base.get_config()
+
+    # Load configuration
+    with timed("load_config"):
+        if INSTALLROOT != "/":
+            config.get_installroot_option().set(INSTALLROOT)
+            config.get_config_file_path_option().set(
+                os.path.join(INSTALLROOT, "etc/dnf/dnf.conf")
+            )
+        base.load_config()
+        if INSTALLROOT != "/":
+            config.get_reposdir_option().set(
+                [os.path.join(INSTALLROOT, "etc/yum.repos.d")]
+            )
+            config.get_cachedir_option().set(
+                os.path.join(INSTALLROOT, "var/cache/dnf")
+            )
+        # none of comps, updateinfo, other or presto are ever used by the queries
+        config.get_optional_metadata_types_option().set(
+            libdnf5.conf.METADATA_TYPE_FILELISTS if filelists else ""
         )
+        if METADATA_POLICY == "cache_only" and not refresh:
+            config.get_cacheonly_option().set("metadata")
 
-base = None
+    # Set up vars
+    with timed("setup"):
+        base.setup()
 
+    return base
 
-def get_base_dnf5(command):
-    global base
-    if base is None:
-        base = libdnf5.base.Base()
 
-        # Load configuration
-        base.load_config()
+def load_installed_base_dnf5():
+    base = configure_base_dnf5()
+    with timed("load_system_repo"):
+        base.get_repo_sack().load_repos(libdnf5.repo.Repo.Type_SYSTEM)
+    return base
 
-        # Set up vars
-        base.setup()
 
-        # Load repositories
-        repo_sack = base.get_repo_sack()
+def setup_repos_dnf5(key, filelists=False, refresh=False):
+    base = configure_base_dnf5(filelists, refresh)
+
+    # Load repositories
+    repo_sack = base.get_repo_sack()
+    with timed("create_repos"):
         repo_sack.create_repos_from_system_configuration()
 
-        if "repos" in command:
-            for repo_pattern in command["repos"]:
-                if "enable" in repo_pattern:
-                    query = libdnf5.repo.RepoQuery(base)
-                    query.filter_id(
-                        repo_pattern["enable"], libdnf5.common.QueryCmp_GLOB
-                    )
-                    for repo in query:
-                        repo.enable()
-                if "disable" in repo_pattern:
-                    query = libdnf5.repo.RepoQuery(base)
-                    query.filter_id(
-                        repo_pattern["disable"], libdnf5.common.QueryCmp_GLOB
-                    )
-                    for repo in query:
-                        repo.disable()
-
-        # Load repositories and create solv files
-        repo_sack.load_repos()
+    for op, pattern in key:
+        query = libdnf5.repo.RepoQuery(base)
+        query.filter_id(pattern, libdnf5.common.QueryCmp_GLOB)
+        for repo in query:
+            if op == "enable":
+                repo.enable()
+            else:
+                repo.disable()
+
+    expire = metadata_expire(refresh)
+    if expire is not None:
+        for repo in libdnf5.repo.RepoQuery(base):
+            repo.get_config().get_metadata_expire_option().set(expire)
+
+    return base
+
+
+def load_base_dnf5(key, filelists=False, refresh=False):
+    base = setup_repos_dnf5(key, filelists, refresh)
+    if not refresh:
+        stage_configured_snapshot(base)
+        rebuild_solv_caches(base, key, filelists)
+
+    # Load repositories and create solv files
+    with timed("load_repos"):
+        base.get_repo_sack().load_repos()
 
     return base
 
 
-def get_sack_dnf4(command):
-    global base
-    if base is None:
-        base = dnf.Base()
-        conf = base.conf
+def configure_base_dnf4(filelists=False, refresh=False):
+    base = dnf.Base()
+    conf = base.conf
+    with timed("load_config"):
+        if INSTALLROOT != "/":
+            conf.config_file_path = os.path.join(INSTALLROOT, "etc/dnf/dnf.conf")
         conf.read()
-        conf.installroot = "/"
+        conf.installroot = INSTALLROOT
+        if INSTALLROOT != "/":
+            conf.reposdir = [os.path.join(INSTALLROOT, "etc/yum.repos.d")]
+            conf.cachedir = os.path.join(INSTALLROOT, "var/cache/dnf")
         conf.assumeyes = True
+        # dnf before 4.18 has no optional_metadata_types and always loads the filelists
+        if has_optional_metadata(base):
+            conf.optional_metadata_types = ["filelists"] if filelists else []
+        if METADATA_POLICY == "cache_only" and not refresh:
+            conf.cacheonly = True
         subst = conf.substitutions
         subst.update_from_etc(conf.installroot)
+    return base
+
+
+def load_installed_base_dnf4():
+    base = configure_base_dnf4()
+    with timed("load_system_repo"):
+        base.fill_sack(load_system_repo=True, load_available_repos=False)
+    return base
+
+
+def setup_repos_dnf4(key, filelists=False, refresh=False):
+    base = configure_base_dnf4(filelists, refresh)
+    with timed("plugins"):
         try:
             base.init_plugins()
             base.pre_configure_plugins()
         except AttributeError:
             pass
+    with timed("create_repos"):
         base.read_all_repos()
-        repos = base.repos
+    repos = base.repos
+
+    for op, pattern in key:
+        for repo in repos.get_matching(pattern):
+            if op == "enable":
+                repo.enable()
+            else:
+                repo.disable()
+
+    expire = metadata_expire(refresh)
+    for repo in repos.values():
+        if expire is not None:
+            repo.metadata_expire = expire
+        # the same as "dnf --cacheonly" does, conf.cacheonly alone is not enough
+        if base.conf.cacheonly:
+            repo._repo.setSyncStrategy(dnf.repo.SYNC_ONLY_CACHE)
 
-        if "repos" in command:
-            for repo_pattern in command["repos"]:
-                if "enable" in repo_pattern:
-                    for repo in repos.get_matching(repo_pattern["enable"]):
-                        repo.enable()
-                if "disable" in repo_pattern:
-                    for repo in repos.get_matching(repo_pattern["disable"]):
-                        repo.disable()
+    try:
+        base.configure_plugins()
+    except AttributeError:
+        pass
+    return base
+
+
+def load_base_dnf4(key, filelists=False, refresh=False):
+    base = setup_repos_dnf4(key, filelists, refresh)
+    if not refresh:
+        stage_configured_snapshot(base)
+        rebuild_solv_caches(base, key, filelists)
+    with timed("load_repos"):
+        base.fill_sack(load_system_repo="auto")
+    return base
+
+
+def metadata_expire(refresh=False):
+    """
+    The metadata_expire to override every repo with: 0 to check all of them
+    for new metadata on an explicit refresh, -1 for them never to expire
+    under the "never_expire" and "cache_only" policies, or None to leave the
+    setting of each repo alone.
+    """
+    if refresh:
+        return 0
+    if METADATA_POLICY != "expire":
+        return -1
+    return None
+
+
+def has_optional_metadata(base):
+    return DNF_VERSION == 5 or hasattr(base.conf, "optional_metadata_types")
+
+
+def needs_filelists(command):
+    return command.get("provides", "").startswith("/")
+
+
+def close_base(base):
+    sack_indexes.pop(id(base), None)
+    if DNF_VERSION == 4:
+        base.close()
+
+
+def get_installed_base():
+    global installed_base
+    if installed_base is None:
+        log("  => loading installed packages")
+        started = time.monotonic()
+        if DNF_VERSION == 5:
+            installed_base = load_installed_base_dnf5()
+        else:
+            installed_base = load_installed_base_dnf4()
+        stats["sack_loads"].append(
+            {"repos": "@System", "seconds": time.monotonic() - started}
+        )
+    return installed_base
+
+
+def get_base(command, filelists=False, refresh=False):
+    key = repo_key(command)
+    filelists = filelists or needs_filelists(command)
+
+    if key in bases:
+        if not filelists or key in filelists_bases:
+            bases.move_to_end(key)
+            return bases[key]
+        log(f"  => reloading sack for repos {key} with filelists")
+        drop_base(key)
+
+    while len(bases) >= MAX_SACKS:
+        evicted_key, evicted = bases.popitem(last=False)
+        log(f"  => evicting sack for repos {evicted_key}")
+        del base_validity[evicted_key]
+        del base_rpmdb[evicted_key]
+        filelists_bases.discard(evicted_key)
+        purge_results(evicted_key)
+        close_base(evicted)
+
+    log(f"  => loading sack for repos {key}")
+    # freshly loaded repository metadata may be newer than the cached answers
+    purge_results(key)
+    started = time.monotonic()
+    if DNF_VERSION == 5:
+        bases[key] = load_base_dnf5(key, filelists, refresh)
+    else:
+        bases[key] = load_base_dnf4(key, filelists, refresh)
+    if filelists or not has_optional_metadata(bases[key]):
+        filelists_bases.add(key)
+    stats["sack_loads"].append(
+        {
+            "repos": key,
+            "filelists": key in filelists_bases,
+            "seconds": time.monotonic() - started,
+        }
+    )
+    base_validity[key] = (base_fingerprint(bases[key]), metadata_expires_at(bases[key]))
+    base_rpmdb[key] = rpmdb_cookie
+    return bases[key]
+
+
+def drop_base(key):
+    close_base(bases.pop(key))
+    del base_validity[key]
+    del base_rpmdb[key]
+    filelists_bases.discard(key)
+    purge_results(key)
+
+
+def purge_results(key):
+    """
+    Throw away the cached answers that came from the base for the repo key.
+    The answers of whatinstalled queries do not depend on the repos and are
+    only thrown away when the rpmdb changes.
+    """
+    for cached in [k for k in results_cache if not is_installed_key(k) and k[-1] == key]:
+        del results_cache[cached]
 
+
+def close_bases():
+    global installed_base
+    base_validity.clear()
+    base_rpmdb.clear()
+    filelists_bases.clear()
+    while bases:
+        key, base = bases.popitem()
+        purge_results(key)
+        close_base(base)
+    if installed_base is not None:
+        close_base(installed_base)
+        installed_base = None
+
+
+def get_rss():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def trim_memory():
+    # hand the memory of the freed sacks back to the OS rather than keeping it
+    # in the malloc arenas
+    gc.collect()
+    try:
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+def release_memory():
+    log(f"  => releasing the sacks, rss is {get_rss()}")
+    close_bases()
+    trim_memory()
+    stats["memory"]["releases"] += 1
+
+
+def enforce_memory_budget():
+    while MEMORY_BUDGET and len(bases) > 1 and (get_rss() or 0) > MEMORY_BUDGET:
+        key = next(iter(bases))
+        log(f"  => over the memory budget, dropping the sack for repos {key}")
+        drop_base(key)
+        trim_memory()
+        stats["memory"]["evictions"] += 1
+
+
+def watchdog():
+    while True:
+        time.sleep(max(1.0, IDLE_TIMEOUT / 4))
+        with lock:
+            loaded = bases or installed_base is not None
+            if loaded and time.monotonic() - last_command >= IDLE_TIMEOUT:
+                log(f"  => idle for {IDLE_TIMEOUT}s")
+                release_memory()
+
+
+def start_watchdog():
+    global watchdog_thread
+    if IDLE_TIMEOUT > 0 and watchdog_thread is None:
+        watchdog_thread = threading.Thread(
+            target=watchdog, name="watchdog", daemon=True
+        )
+        watchdog_thread.start()
+
+
+def reload_system_repo(base):
+    """
+    Load the rpmdb into a base again, the metadata of the available
+    repositories that is already loaded into it is kept.
+    """
+    sack_indexes.pop(id(base), None)
+    with timed("load_system_repo"):
+        if DNF_VERSION == 5:
+            base.get_repo_sack().load_repos(libdnf5.repo.Repo.Type_SYSTEM)
+        else:
+            base.sack.load_system_repo(build_cache=False)
+
+
+def refresh_installed():
+    """
+    Pick up a change to the rpmdb without loading the available repository
+    metadata again.  The @System-only base is dropped, it is reloaded by the
+    next whatinstalled query, and the bases holding the available repository
+    metadata reload only their @System repo.  A base that fails to reload it
+    is dropped and loaded again when it is next needed.
+    """
+    global installed_base, rpmdb_cookie
+    results_cache.clear()
+    rpmdb_cookie = get_rpmdb_cookie()
+    if installed_base is not None:
+        close_base(installed_base)
+        installed_base = None
+    for key in list(bases):
+        log(f"  => reloading the installed packages of the sack for repos {key}")
         try:
-            base.configure_plugins()
-        except AttributeError:
+            reload_system_repo(bases[key])
+        except Exception as e:
+            log(f"  => reloading the installed packages failed, dropping the sack: {e}")
+            drop_base(key)
+            continue
+        base_rpmdb[key] = rpmdb_cookie
+
+
+def config_paths(base):
+    if DNF_VERSION == 5:
+        config = base.get_config()
+        paths = [config.get_config_file_path_option().get_value()]
+        reposdirs = config.get_reposdir_option().get_value()
+    else:
+        paths = [base.conf.config_file_path]
+        reposdirs = base.conf.reposdir
+    for reposdir in reposdirs:
+        try:
+            names = sorted(os.listdir(reposdir))
+        except OSError:
+            continue
+        paths.extend(os.path.join(reposdir, name) for name in names if name.endswith(".repo"))
+    return paths
+
+
+def enabled_repos(base):
+    """
+    Yields a Repo for every enabled repository of the base.
+    """
+    if DNF_VERSION == 5:
+        query = libdnf5.repo.RepoQuery(base)
+        query.filter_enabled(True)
+        query.filter_type(libdnf5.repo.Repo.Type_AVAILABLE)
+        for repo in query:
+            config = repo.get_config()
+            yield Repo(
+                repo.get_id(),
+                repo.get_cachedir(),
+                config.get_metadata_expire_option().get_value(),
+                list(config.get_baseurl_option().get_value()),
+            )
+    else:
+        for repo in base.repos.iter_enabled():
+            yield Repo(repo.id, repo._repo.getCachedir(), repo.metadata_expire, list(repo.baseurl))
+
+
+def repomd_paths(repo):
+    """
+    Where the repomd.xml of a repo can be found: in its cache directory, or
+    for a local file:// repo (which dnf reads in place) in the repo itself.
+    """
+    yield os.path.join(repo.cachedir, "repodata", "repomd.xml")
+    for url in repo.baseurls:
+        if url.startswith("file://"):
+            yield os.path.join(url[len("file://"):], "repodata", "repomd.xml")
+
+
+def base_fingerprint(base):
+    """
+    Cheap enough to compute on every connection: a stat() of the dnf.conf and
+    .repo files and a checksum of the (small) repomd.xml files in the cache
+    and in local file:// repos, which change whenever any of the repository
+    metadata is refreshed.
+    """
+    fingerprint = []
+    for path in config_paths(base):
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        fingerprint.append((path, st.st_size, st.st_mtime_ns))
+    for repo in enabled_repos(base):
+        for repomd in repomd_paths(repo):
+            fingerprint.append((repomd, file_checksum(repomd)))
+    return tuple(fingerprint)
+
+
+def file_checksum(path):
+    try:
+        with open(path, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return None
+
+
+def metadata_expires_at(base):
+    # under the other policies only refresh_metadata replaces the metadata
+    if METADATA_POLICY != "expire":
+        return None
+    expires = [repo.expire for repo in enabled_repos(base) if repo.expire >= 0]
+    if not expires:
+        return None
+    return time.time() + min(expires)
+
+
+def revalidate():
+    """
+    Throw away every loaded base whose configuration or cached repository
+    metadata has changed, or whose metadata has expired, since it was loaded.
+    Changes to the rpmdb are picked up by check_rpmdb() before every command.
+    """
+    now = time.time()
+    for key in list(bases):
+        fingerprint, expires_at = base_validity[key]
+        if expires_at is not None and now >= expires_at:
+            log(f"  => metadata expired for repos {key}")
+        elif base_fingerprint(bases[key]) != fingerprint:
+            log(f"  => metadata changed for repos {key}")
+        else:
+            continue
+        drop_base(key)
+
+
+def refresh_metadata(command):
+    """
+    The explicit refresh step of the "never_expire" and "cache_only" policies
+    (and a forced one under "expire"): the sack for the repos of the command
+    is reloaded with every repo checked for new metadata, and any other
+    loaded sack whose metadata changed because of that is dropped.
+    """
+    key = repo_key(command)
+    log(f"  => refreshing metadata for repos {key}")
+    filelists = key in filelists_bases
+    if key in bases:
+        drop_base(key)
+    with timed("refresh_metadata"):
+        get_base(command, filelists=filelists, refresh=True)
+    revalidate()
+    return metadata_age(command)
+
+
+def metadata_age(command):
+    """
+    The seconds since the metadata of each enabled repo of the command was
+    downloaded, going by the mtime of its repomd.xml, or None for a repo
+    without any metadata.
+    """
+    now = time.time()
+    ages = {}
+    for repo in enabled_repos(get_base(command)):
+        ages[repo.id] = None
+        for path in repomd_paths(repo):
+            try:
+                ages[repo.id] = now - os.stat(path).st_mtime
+                break
+            except OSError:
+                continue
+    return ages
+
+
+def solv_dir(repo):
+    # dnf5 keeps the solv files of a repo in its cache directory, dnf4 keeps
+    # them next to it
+    if DNF_VERSION == 5:
+        return os.path.join(repo.cachedir, "solv")
+    return os.path.dirname(repo.cachedir)
+
+
+def solv_names(repo):
+    try:
+        names = sorted(os.listdir(solv_dir(repo)))
+    except OSError:
+        return []
+    if DNF_VERSION == 5:
+        return [name for name in names if name.endswith((".solv", ".solvx"))]
+    # <repo>.solv and <repo>-filenames.solvx, <repo>-updateinfo.solvx, ...
+    return [
+        name
+        for name in names
+        if name == f"{repo.id}.solv"
+        or (name.endswith(".solvx") and name[: -len(".solvx")].rsplit("-", 1)[0] == repo.id)
+    ]
+
+
+def snapshot_files(repo):
+    """
+    The files of a repo that go into a snapshot, as (name in the snapshot,
+    path) pairs: its repomd.xml, whichever of the metadata listed in it has
+    been downloaded, and the solv files that libsolv built from them.
+    """
+    repomd = next((path for path in repomd_paths(repo) if os.path.exists(path)), None)
+    if repomd is None:
+        return []
+    root = os.path.dirname(os.path.dirname(repomd))
+    files = [("repodata/repomd.xml", repomd)]
+    for location in xml.etree.ElementTree.parse(repomd).iter(f"{REPOMD_NS}location"):
+        name = location.get("href", "")
+        if snapshot_name_ok(name) and os.path.exists(os.path.join(root, name)):
+            files.append((name, os.path.join(root, name)))
+    for name in solv_names(repo):
+        files.append((f"solv/{name}", os.path.join(solv_dir(repo), name)))
+    return files
+
+
+def snapshot_name_ok(name):
+    # the manifest of an imported snapshot may have come from anywhere
+    parts = name.split("/")
+    return len(parts) == 2 and parts[0] in ("repodata", "solv") and parts[1] not in ("", ".", "..")
+
+
+def link_or_copy(src, dst):
+    """
+    Hardlinks src to dst, or copies it where that is not possible (across
+    filesystems), by way of a temporary file so that dst is replaced
+    atomically.
+    """
+    tmp = f"{dst}.chef-{os.getpid()}"
+    with contextlib.suppress(FileNotFoundError):
+        os.unlink(tmp)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copy2(src, tmp)
+    os.replace(tmp, dst)
+
+
+def export_snapshot(command):
+    """
+    Writes a snapshot of the metadata of the enabled repos of the command to
+    the directory at command["path"]: a directory per repo with its repodata
+    and solv files, and a manifest.json with the checksum of each repomd.xml.
+    The sack is loaded first, so that the solv files are up to date.  The
+    files are hardlinked out of the dnf cache where possible.
+    """
+    path = command["path"]
+    if os.path.exists(path) and not os.path.exists(os.path.join(path, "manifest.json")):
+        raise RuntimeError(f"{path} exists and is not a snapshot")
+    base = get_base(command)
+    manifest = {"format": SNAPSHOT_FORMAT, "dnf_version": DNF_VERSION, "repos": {}}
+    staging = f"{path}.chef-{os.getpid()}"
+    shutil.rmtree(staging, ignore_errors=True)
+    with timed("export_snapshot"):
+        for repo in enabled_repos(base):
+            files = snapshot_files(repo)
+            if not files:
+                continue
+            for name, src in files:
+                dst = os.path.join(staging, repo.id, name)
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                link_or_copy(src, dst)
+            manifest["repos"][repo.id] = {
+                "cachedir": os.path.basename(repo.cachedir),
+                "repomd": file_checksum(os.path.join(staging, repo.id, "repodata", "repomd.xml")),
+                "files": [name for name, _ in files],
+            }
+        os.makedirs(staging, exist_ok=True)
+        with open(os.path.join(staging, "manifest.json"), "w") as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        shutil.rmtree(path, ignore_errors=True)
+        os.rename(staging, path)
+    return sorted(manifest["repos"])
+
+
+def stage_snapshot(base, path):
+    """
+    Stages the files of the snapshot at path into the dnf cache for each
+    enabled repo of the base that it has, before the base loads its repos.
+    A repo is skipped when it is configured differently than on the node that
+    exported it (the name of its cache directory is a hash of its URLs), when
+    its files in the snapshot do not match the manifest, or when the cache
+    already has newer metadata for it.
+    """
+    with open(os.path.join(path, "manifest.json")) as f:
+        manifest = json.load(f)
+    if manifest.get("format") != SNAPSHOT_FORMAT or manifest.get("dnf_version") != DNF_VERSION:
+        raise RuntimeError(f"{path} is not a snapshot for dnf{DNF_VERSION}")
+    result = {"imported": [], "current": [], "skipped": {}}
+    with timed("import_snapshot"):
+        for repo in enabled_repos(base):
+            if repo.id not in manifest["repos"]:
+                continue
+            outcome = stage_snapshot_repo(repo, os.path.join(path, repo.id), manifest["repos"][repo.id])
+            if outcome in ("imported", "current"):
+                result[outcome].append(repo.id)
+            else:
+                result["skipped"][repo.id] = outcome
+    return result
+
+
+def stage_snapshot_repo(repo, source, entry):
+    if entry["cachedir"] != os.path.basename(repo.cachedir):
+        return "configured differently"
+    repomd = os.path.join(source, "repodata", "repomd.xml")
+    if file_checksum(repomd) != entry["repomd"] or not all(map(snapshot_name_ok, entry["files"])):
+        return "does not match the manifest"
+    cached = os.path.join(repo.cachedir, "repodata", "repomd.xml")
+    with contextlib.suppress(OSError):
+        if os.stat(cached).st_mtime > os.stat(repomd).st_mtime:
+            return "cache is newer"
+
+    staged = False
+    # the repomd.xml goes last, so that it never lists files which are not there yet
+    for name in sorted(entry["files"], key=lambda name: name == "repodata/repomd.xml"):
+        src = os.path.join(source, name)
+        kind, filename = name.split("/")
+        if kind == "solv":
+            dst = os.path.join(solv_dir(repo), filename)
+        else:
+            dst = os.path.join(repo.cachedir, name)
+        if os.path.exists(dst) and os.path.samefile(src, dst):
+            continue
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        link_or_copy(src, dst)
+        staged = True
+    return "imported" if staged else "current"
+
+
+def stage_configured_snapshot(base):
+    """
+    Imports the CHEF_DNF_HELPER_SNAPSHOT snapshot, when there is one, into a
+    base that is about to load its repos.  Without a usable snapshot the
+    metadata is loaded the usual way, so failures are only logged.
+    """
+    if SNAPSHOT is None:
+        return
+    try:
+        log(f"  => staged snapshot {SNAPSHOT}: {stage_snapshot(base, SNAPSHOT)}")
+    except (OSError, ValueError, KeyError, RuntimeError) as e:
+        log(f"  => unable to stage snapshot {SNAPSHOT}: {e!r}")
+
+
+def import_snapshot(command):
+    """
+    Stages the snapshot at command["path"] into the dnf cache for the
+    enabled repos of the command, and drops any loaded sack whose metadata
+    that replaced.
+    """
+    key = repo_key(command)
+    if DNF_VERSION == 5:
+        base = setup_repos_dnf5(key)
+    else:
+        base = setup_repos_dnf4(key)
+    try:
+        result = stage_snapshot(base, command["path"])
+    finally:
+        close_base(base)
+    revalidate()
+    return result
+
+
+def stale_repos(base):
+    """
+    The ids of the enabled repos of the base that libsolv would have to parse
+    the metadata of: those whose solv file is missing or older than their
+    repomd.xml, and those without any metadata yet.
+    """
+    stale = []
+    for repo in enabled_repos(base):
+        repomd = next((path for path in repomd_paths(repo) if os.path.exists(path)), None)
+        try:
+            solv = os.stat(os.path.join(solv_dir(repo), f"{repo.id}.solv"))
+            if repomd is not None and solv.st_mtime >= os.stat(repomd).st_mtime:
+                continue
+        except OSError:
             pass
-        base.fill_sack(load_system_repo="auto")
-    return base.sack
+        stale.append(repo.id)
+    return stale
+
+
+def build_solv_cache(key, repo_id, filelists):
+    """
+    Runs in the process pool of rebuild_solv_caches(): loads just the one repo,
+    without the rpmdb, which writes its solv cache.  Returns the seconds that
+    took.
+    """
+    started = time.monotonic()
+    key = key + (("disable", "*"), ("enable", repo_id))
+    if DNF_VERSION == 5:
+        base = setup_repos_dnf5(key, filelists)
+        base.get_repo_sack().load_repos(libdnf5.repo.Repo.Type_AVAILABLE)
+    else:
+        base = setup_repos_dnf4(key, filelists)
+        base.fill_sack(load_system_repo=False)
+    close_base(base)
+    return time.monotonic() - started
+
+
+def rebuild_solv_caches(base, key, filelists):
+    """
+    Rebuilds the stale solv caches of the repos of a base that is about to
+    load them in a pool of CHEF_DNF_HELPER_PARALLEL_LOAD processes.  The pool
+    is spawned rather than forked, the helper may have threads and a loaded
+    sack.  A repo that fails to load in the pool is just left to the load of
+    the base, which reports the error.
+    """
+    if PARALLEL_LOAD < 2:
+        return
+    stale = stale_repos(base)
+    if len(stale) < 2:
+        return
+    workers = min(PARALLEL_LOAD, len(stale))
+    log(f"  => rebuilding solv caches of {stale} in {workers} processes")
+    started = time.monotonic()
+    serial = 0.0
+    with timed("parallel_load"):
+        context = multiprocessing.get_context("spawn")
+        with concurrent.futures.ProcessPoolExecutor(workers, mp_context=context) as pool:
+            futures = {
+                pool.submit(build_solv_cache, key, repo_id, filelists): repo_id
+                for repo_id in stale
+            }
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    serial += future.result()
+                except Exception as e:
+                    log(f"  => unable to rebuild the solv cache of {futures[future]}: {e!r}")
+    seconds = time.monotonic() - started
+    # how much longer the same loads would have taken one after another
+    stats["parallel_loads"].append(
+        {
+            "repos": stale,
+            "workers": workers,
+            "seconds": seconds,
+            "serial_seconds": serial,
+            "speedup": serial / seconds if serial else None,
+        }
+    )
+
+
+def prefetch(command):
+    """
+    Start loading the rpmdb and the sack for the repos of the command in a
+    background thread.  Failures are only logged, the query that needs the
+    sack will load it again and report the error.
+    """
+    global prefetch_thread
+    if prefetch_thread is not None and prefetch_thread.is_alive():
+        return
+
+    def load():
+        with lock:
+            log(f"  => prefetching sack for repos {repo_key(command)}")
+            try:
+                check_rpmdb()
+                get_installed_base()
+                get_base(command)
+            except Exception as e:
+                log(f"  => prefetch failed: {e!r}")
+
+    prefetch_thread = threading.Thread(target=load, name="prefetch", daemon=True)
+    prefetch_thread.start()
+
+
+@functools.lru_cache(maxsize=None)
+def get_rpmdb_path():
+    return os.path.realpath(
+        os.path.join(INSTALLROOT, rpm.expandMacro("%{_dbpath}").lstrip("/"))
+    )
+
+
+def get_rpmdb_cookie():
+    """
+    Cheaply fingerprint the rpmdb by the names, sizes and mtimes of its files.
+
+    Files which are written to by readers of the database (the Berkeley DB
+    environment, the sqlite shared memory index and the lock file) are left
+    out so that the helper's own queries do not change the cookie.  The
+    provider computes the same cookie to check its installed package index.
+    """
+    cookie = []
+    dbpath = get_rpmdb_path()
+    try:
+        entries = sorted(os.listdir(dbpath))
+    except OSError:
+        return None
+    for entry in entries:
+        if entry.startswith(("__db", ".")) or entry.endswith("-shm"):
+            continue
+        try:
+            st = os.stat(os.path.join(dbpath, entry))
+        except OSError:
+            continue
+        cookie.append((entry, st.st_size, st.st_mtime_ns))
+    return tuple(cookie)
+
+
+def check_rpmdb():
+    # picks up changes to the rpmdb made by anything other than the provider's
+    # own transactions, e.g. rpm_package or execute resources
+    global rpmdb_cookie
+    cookie = get_rpmdb_cookie()
+    if cookie != rpmdb_cookie:
+        if rpmdb_cookie is None:
+            rpmdb_cookie = cookie
+        else:
+            log("  => rpmdb changed, dropping cached results and reloading installed packages")
+            refresh_installed()
+
+
+def cache_key(command):
+    key = (
+        command["action"],
+        command["provides"],
+        command.get("epoch"),
+        command.get("version"),
+        command.get("release"),
+        command.get("arch"),
+    )
+    # what is installed does not depend on which repos are enabled
+    if command["action"] not in ("whatinstalled", "whatinstalled_all"):
+        key += (repo_key(command),)
+    return key
+
+
+def is_installed_key(key):
+    return key[0] in ("whatinstalled", "whatinstalled_all")
+
+
+def cache_hit(key):
+    """
+    Whether the results cache has a usable answer for the cache key.  An
+    answer from the available repos is only used while the base that it came
+    from is still loaded, the base may have been evicted or released since.
+    """
+    if key not in results_cache:
+        return False
+    if not is_installed_key(key) and key[-1] not in bases:
+        del results_cache[key]
+        return False
+    cache_stats["hits"] += 1
+    return True
+
+
+def phase():
+    """
+    Report how much of the package metadata has been loaded so far:
+
+    - "none": nothing has been loaded yet
+    - "installed": only the rpmdb has been loaded
+    - "available": remote repository metadata has been loaded as well
+    """
+    if bases:
+        return "available"
+    if installed_base is not None:
+        return "installed"
+    return "none"
 
 
 def get_sack(command):
+    # whatinstalled only needs the rpmdb, what is installed does not depend on
+    # which repos are enabled
+    if command.get("action") == "whatinstalled":
+        base = get_installed_base()
+    else:
+        base = get_base(command)
     if DNF_VERSION == 5:
-        return get_base_dnf5(command)
+        return base
     else:
-        return get_sack_dnf4(command)
+        return base.sack
 
 
 def version_tuple(versionstr):
@@ -151,55 +1196,66 @@ def version_tuple(versionstr):
     return (e, v, r)
 
 
-# If we pass in 0:1.10 and 1.2 to the dnf5 libraries, it won't compare
-# them correctly, they both need to have epochs or not have epochs. However,
-# unlike dnf4 libraries, it they don't take tuples, so use version_tuple to
-# canonicalize the parts of the version, then reassemble them into a full EVR
-# string.
-def version_canonicalize(versionstr):
-    e, v, r = version_tuple(versionstr)
-    return f"{e}:{v}-{r}"
-
-
+# dnf5 has no labelCompare(), so compare the epoch, version and release
+# separately with rpmvercmp the same way that rpm's labelCompare() does.
+# Comparing whole "e:v-r" strings with rpmvercmp is not the same thing, the
+# separators are ignored so e.g. 1.2-3 would sort above 1.2.1-3.
+def label_compare_dnf5(evr1, evr2):
+    for a, b in zip(evr1, evr2):
+        if a is None and b is None:
+            continue
+        if b is None:
+            return 1
+        if a is None:
+            return -1
+        rc = libdnf5.rpm.rpmvercmp(a, b)
+        if rc != 0:
+            return rc
+    return 0
+
+
+# NOTE: Chef::Provider::Package::Dnf::VersionCompare is a ruby port of this
+# comparison which the provider uses in-process, the two must be kept in sync
+# (see spec/data/dnf/version_compare_corpus.txt).  This deliberately never
+# touches the sack.
 def versioncompare(command):
     versions = command["versions"]
-    sack = get_sack(command)
     if (versions[0] is None) or (versions[1] is None):
-        outpipe.write("0\n")
-        outpipe.flush()
-    else:
-        if DNF_VERSION == 4:
-            evr_comparison = dnf.rpm.rpm.labelCompare(
-                version_tuple(versions[0]), version_tuple(versions[1])
-            )
-            outpipe.write("{}\n".format(evr_comparison))
+        return 0
+    evr1 = version_tuple(versions[0])
+    evr2 = version_tuple(versions[1])
+    if DNF_VERSION == 4:
+        return rpm.labelCompare(evr1, evr2)
+    return label_compare_dnf5(evr1, evr2)
+
+
+def base_query_dnf4(sack, action, base_queries):
+    # batch requests reuse the same unfiltered sack queries across all of their sub-queries
+    if base_queries is None:
+        base_queries = {}
+    if action not in base_queries:
+        if action == "whatinstalled":
+            # When attempting to figure out what is installed, we should ignore any
+            # excludes that are configured, a package can be installed even though
+            # it is excluded from the repos
+            base_queries[action] = sack.query(flags=hawkey.IGNORE_EXCLUDES)
         else:
-            # dnf5 version comparison - rpmvercmp handles full EVR strings
-            cmp_result = libdnf5.rpm.rpmvercmp(
-                version_canonicalize(versions[0]),
-                version_canonicalize(versions[1]),
-            )
-            outpipe.write("{}\n".format(cmp_result))
-        outpipe.flush()
+            base_queries[action] = sack.query()
+    # hand out a copy so the cached query is never filtered in place
+    return base_queries[action].filter()
 
 
-def query_dnf4(command):
+def match_dnf4(command, base_queries=None):
     sack = get_sack(command)
 
     subj = dnf.subject.Subject(command["provides"])
-    q = subj.get_best_query(sack, with_provides=True)
+    q = subj.get_best_query(
+        sack,
+        with_provides=True,
+        query=base_query_dnf4(sack, command["action"], base_queries),
+    )
 
     if command["action"] == "whatinstalled":
-        # When attempting to figure out what is installed, we should ignore any
-        # excludes that are configured, otherwise the "best" query for a given
-        # subject may refer to a package that is installed that provides that
-        # subject, but we really want to know if a package by that name exists
-        # in any available repository
-        q = subj.get_best_query(
-            sack,
-            with_provides=True,
-            query=sack.query(flags=hawkey.IGNORE_EXCLUDES),
-        )
         q = q.installed()
 
     if command["action"] == "whatavailable":
@@ -233,33 +1289,88 @@ def query_dnf4(command):
     if len(archq.run()) > 0:
         q = archq
 
-    pkgs = q.latest(1).run()
+    return q
+
+
+def query_dnf4(command, base_queries=None):
+    pkgs = match_dnf4(command, base_queries).latest(1).run()
 
     if not pkgs:
-        outpipe.write("{} nil nil\n".format(command["provides"].split().pop(0)))
-        outpipe.flush()
-    else:
-        # make sure we picked the package with the highest version
-        pkgs.sort
-        pkg = pkgs.pop()
-        outpipe.write(
-            "{} {}:{}-{} {}\n".format(
-                pkg.name, pkg.epoch, pkg.version, pkg.release, pkg.arch
-            )
-        )
-        outpipe.flush()
+        return None
+
+    # make sure we picked the package with the highest version
+    pkgs.sort
+    return pkgs.pop()
 
 
 def log(message):
+    global debug_file
     if DEBUG_FILE is None:
         return
-    with open(DEBUG_FILE, "a") as f:
-        f.write(message + "\n")
+    if debug_file is None:
+        debug_file = open(DEBUG_FILE, "a")
+    debug_file.write(message + "\n")
+    debug_file.flush()
+
 
+class SackIndex:
+    """
+    The parts of a dnf5 query that are the same for every query on a base,
+    worked out once for the base rather than by every query: the queries of
+    the installed and of the available packages, the packages of the native
+    arch (or noarch), and the packages of each name that has been looked up.
+    """
 
-def query_dnf5(command):
+    def __init__(self, base):
+        self.base = base
+        self.detected_arch = base.get_vars().get_value("arch")
+        self.everything = libdnf5.rpm.PackageQuery(base)
+        installed = libdnf5.rpm.PackageQuery(self.everything)
+        installed.filter_installed()
+        available = libdnf5.rpm.PackageQuery(self.everything)
+        available.filter_available()
+        self.queries = {"whatinstalled": installed, "whatavailable": available}
+        self.native = libdnf5.rpm.PackageQuery(self.everything)
+        self.native.filter_arch(["noarch", self.detected_arch])
+        self.names = {}
+
+    def query(self, action):
+        # hand out a copy so the shared query is never filtered in place
+        return libdnf5.rpm.PackageQuery(self.queries.get(action, self.everything))
+
+    def by_name(self, name):
+        """
+        Every package called name, or None if there is no such package.
+        Filtering on the interned name id is much cheaper than matching a glob
+        against the nevra strings of every package in the sack.
+        """
+        if name not in self.names:
+            q = libdnf5.rpm.PackageQuery(self.everything)
+            q.filter_name([name])
+            self.names[name] = None if q.empty() else q
+        return self.names[name]
+
+
+def sack_index(base):
+    index = sack_indexes.get(id(base))
+    if index is None or index.base is not base:
+        with timed("sack_index"):
+            index = sack_indexes[id(base)] = SackIndex(base)
+    return index
+
+
+@functools.lru_cache(maxsize=None)
+def archscore(arch):
+    return rpm.archscore(arch)
+
+
+def is_glob(pattern):
+    return any(c in pattern for c in "*?[")
+
+
+def match_dnf5(command, base_queries=None):
     """
-    Query dnf5 for package information based on the command dict.
+    Query dnf5 for the packages matching the command dict.
 
     This method does a fair amount of work to try to mimic the behavior
     of "dnf install <foo>". In the DNF4 world, this functionality was
@@ -283,9 +1394,13 @@ def query_dnf5(command):
 
     A full exercising of this functionality testing all known cases is
     in the unittest for the DNF provider.
+
+    The base queries come from the SackIndex of the base, base_queries is
+    only used by dnf4.
     """
     base = get_sack(command)
-    q = libdnf5.rpm.PackageQuery(base)
+    index = sack_index(base)
+    q = index.query(command["action"])
 
     # First, we need to know if this parses as a nevra or not, which will
     # inform the rest of our decision tree.
@@ -326,7 +1441,7 @@ def query_dnf5(command):
             f"  => Possible interpretation: n:{n.get_name()} v:{n.get_version()} r:{n.get_release()} a:{n.get_arch()}"
         )
         arch = n.get_arch()
-        if arch != "" and rpm.archscore(arch) > 0:
+        if arch != "" and archscore(arch) > 0:
             log(f"  => Selected interpretation with arch: {arch}")
             nevra = n
             break
@@ -340,6 +1455,10 @@ def query_dnf5(command):
             # strip of ".<arch>" from the end of provides_str
             provides_str = provides_str[: -(len(arch) + 1)]
 
+    # an exact package name is found through the name index, the glob over
+    # the whole sack below is only needed if no package of that name matches
+    named = None if is_glob(provides_str) else index.by_name(provides_str)
+
     # in order to get the behavior of "dnf install <blah>" we have to add
     # '*' to the end in order to make stuff like "chef_rpm-1.2" work.
     if not provides_str.endswith("*"):
@@ -347,11 +1466,6 @@ def query_dnf5(command):
 
     log(f"  => provides_str after processing: {provides_str}")
     log(f"  => command after processing: {command}")
-    if command["action"] == "whatinstalled":
-        q.filter_installed()
-
-    if command["action"] == "whatavailable":
-        q.filter_available()
 
     # Apply version filters
     if "epoch" in command:
@@ -381,21 +1495,33 @@ def query_dnf5(command):
     # name conventions, this gets is roughly compatible with the old
     # dnf4 "subject" calls.
     nevra_q = libdnf5.rpm.PackageQuery(q)
-    nevra_q.filter_nevra(provides_str, libdnf5.common.QueryCmp_GLOB)
+    if named is not None:
+        nevra_q.intersection(named)
+    if nevra_q.empty() or named is None:
+        nevra_q = libdnf5.rpm.PackageQuery(q)
+        nevra_q.filter_nevra(provides_str, libdnf5.common.QueryCmp_GLOB)
     if not nevra_q.empty():
         q = nevra_q
+    elif command["provides"].startswith("/"):
+        # files are not provides in dnf5, look paths up in the filelists (and
+        # in the files listed in the primary metadata)
+        q.filter_file([command["provides"]])
     else:
         q.filter_provides(provides_str, libdnf5.common.QueryCmp_GLOB)
 
     # Filter by architecture (prefer noarch and native arch)
-    # Get the system architecture from vars
-    detected_arch = base.get_vars().get_value("arch")
     archq = libdnf5.rpm.PackageQuery(q)
-    archq.filter_arch(["noarch", detected_arch])
+    archq.intersection(index.native)
 
     if not archq.empty():
         q = archq
 
+    return q
+
+
+def query_dnf5(command, base_queries=None):
+    q = match_dnf5(command, base_queries)
+
     # Get latest packages
     q.filter_latest_evr()
 
@@ -403,64 +1529,598 @@ def query_dnf5(command):
     log(f"  => pkgs from query: {pkgs}")
 
     if not pkgs:
-        outpipe.write("{} nil nil\n".format(command["provides"].split().pop(0)))
-        outpipe.flush()
+        return None
+
+    # Sort and get the highest version
+    pkgs.sort(
+        key=lambda p: (p.get_epoch(), p.get_version(), p.get_release()),
+        reverse=True,
+    )
+    return pkgs[0]
+
+
+def query(command, base_queries=None):
+    if DNF_VERSION == 5:
+        return query_dnf5(command, base_queries)
     else:
-        # Sort and get the highest version
-        pkgs.sort(
-            key=lambda p: (p.get_epoch(), p.get_version(), p.get_release()),
-            reverse=True,
+        return query_dnf4(command, base_queries)
+
+
+def query_all(command, base_queries=None):
+    """
+    Every package that a whatinstalled/whatavailable query picks the latest
+    of, as matches with the id of the repo that each is from, newest first.
+    Several questions about the versions of a package can be answered from
+    one of these.
+    """
+    if DNF_VERSION == 5:
+        pkgs = [
+            (p.get_name(), (p.get_epoch(), p.get_version(), p.get_release()), p.get_arch(), p.get_repo_id())
+            for p in match_dnf5(command, base_queries)
+        ]
+        compare = label_compare_dnf5
+    else:
+        pkgs = [
+            (p.name, (str(p.epoch), p.version, p.release), p.arch, p.reponame)
+            for p in match_dnf4(command, base_queries).run()
+        ]
+        compare = rpm.labelCompare
+    pkgs.sort(key=lambda p: (p[0], p[2], p[3]))
+    # the stable sort keeps the order above among packages of the same EVR
+    pkgs.sort(key=functools.cmp_to_key(lambda a, b: compare(a[1], b[1])), reverse=True)
+    return [
+        {"name": name, "version": "{}:{}-{}".format(*evr), "arch": arch, "repo": repo}
+        for name, evr, arch, repo in pkgs
+    ]
+
+
+def to_package(command, pkg):
+    if pkg is None:
+        return Package(command["provides"].split().pop(0), None, None)
+    if DNF_VERSION == 5:
+        return Package(
+            pkg.get_name(),
+            "{}:{}-{}".format(pkg.get_epoch(), pkg.get_version(), pkg.get_release()),
+            pkg.get_arch(),
         )
-        pkg = pkgs[0]
-        outpipe.write(
-            "{} {}:{}-{} {}\n".format(
-                pkg.get_name(),
-                pkg.get_epoch(),
-                pkg.get_version(),
-                pkg.get_release(),
-                pkg.get_arch(),
+    return Package(
+        pkg.name, "{}:{}-{}".format(pkg.epoch, pkg.version, pkg.release), pkg.arch
+    )
+
+
+def format_package(package):
+    return " ".join("nil" if field is None else field for field in package)
+
+
+def cached_query(command, base_queries=None):
+    key = cache_key(command)
+    if cache_hit(key):
+        log(f"  => cache hit: {results_cache[key]}")
+        return results_cache[key]
+    cache_stats["misses"] += 1
+    pkg = query(command, base_queries)
+    if pkg is None and load_filelists(command):
+        if base_queries is not None:
+            base_queries.clear()
+        pkg = query(command, base_queries)
+    result = to_package(command, pkg)
+    results_cache[key] = result
+    return result
+
+
+def load_filelists(command):
+    """
+    Reload the base of a whatavailable query that the primary metadata had no
+    answer for with the filelists, unless it already has them.
+
+    Returns whether the query should be retried.
+    """
+    if command["action"] != "whatavailable" or repo_key(command) in filelists_bases:
+        return False
+    log("  => no match in the primary metadata, loading the filelists")
+    get_base(command, filelists=True)
+    return True
+
+
+def whatprovides(command):
+    return cached_query(command)
+
+
+def whatprovides_all(command, base_queries=None):
+    key = cache_key(command)
+    if cache_hit(key):
+        return results_cache[key]
+    cache_stats["misses"] += 1
+    single = dict(command, action=command["action"][: -len("_all")])
+    result = query_all(single, base_queries)
+    if not result and load_filelists(single):
+        if base_queries is not None:
+            base_queries.clear()
+        result = query_all(single, base_queries)
+    results_cache[key] = result
+    return result
+
+
+def get_installonlypkgs():
+    base = get_installed_base()
+    if DNF_VERSION == 5:
+        return list(base.get_config().get_installonlypkgs_option().get_value())
+    else:
+        return list(base.conf.installonlypkgs)
+
+
+def resolve(command, base_queries=None):
+    """
+    Everything that the provider needs to know about one package in one
+    round-trip: the "available" candidate, the "installed" package that
+    matches the version (which without a version is the "current" one), the
+    "current" installed package, and whether the package is "installonly".
+    """
+    available = cached_query(dict(command, action="whatavailable"), base_queries)
+    unversioned = {
+        key: value
+        for key, value in command.items()
+        if key not in ("epoch", "version", "release")
+    }
+    current = cached_query(dict(unversioned, action="whatinstalled"), base_queries)
+    if len(unversioned) < len(command):
+        installed = cached_query(dict(command, action="whatinstalled"), base_queries)
+    else:
+        installed = current
+    return {
+        "available": available,
+        "installed": installed,
+        "current": current,
+        "installonly": available.name in get_installonlypkgs(),
+    }
+
+
+def batch(command):
+    """
+    Answer a list of whatinstalled/whatavailable (or _all) and resolve
+    sub-queries in one round-trip.
+
+    All of the sub-queries share the repo options of the batch request and
+    are run against the same loaded sack. The answers are in the same order
+    as the sub-queries.
+    """
+    base_queries = {}
+    results = []
+    for subcommand in command["queries"]:
+        if subcommand["action"] not in (
+            "whatinstalled",
+            "whatavailable",
+            "whatinstalled_all",
+            "whatavailable_all",
+            "resolve",
+        ):
+            raise RuntimeError("bad batch command")
+        if "repos" in command:
+            subcommand["repos"] = command["repos"]
+        log(f"  BATCH COMMAND: {subcommand}")
+        if subcommand["action"] == "resolve":
+            results.append(resolve(subcommand, base_queries))
+        elif subcommand["action"].endswith("_all"):
+            results.append(whatprovides_all(subcommand, base_queries))
+        else:
+            results.append(cached_query(subcommand, base_queries))
+    return results
+
+
+def check_signatures_dnf4(base, pkgs):
+    # the dnf command checks the signatures of the downloaded packages itself,
+    # do_transaction() does not
+    for pkg in pkgs:
+        result, error = base.package_signature_check(pkg)
+        if result == 1:
+            # the key is not installed yet, import it like "dnf -y" would
+            base.package_import_key(pkg, askcb=lambda *args: True)
+            result, error = base.package_signature_check(pkg)
+        if result != 0:
+            raise dnf.exceptions.Error(error)
+
+
+def transaction_dnf4(base, command):
+    try:
+        for spec in command["packages"]:
+            if command["action"] == "install":
+                base.install(spec)
+            else:
+                base.remove(spec)
+        with timed("resolve"):
+            base.resolve(allow_erasing=command["action"] == "remove")
+        install_set = list(base.transaction.install_set)
+        # the cache_only policy only keeps the repository metadata from being
+        # downloaded (like the "metadata" cacheonly of dnf5), the packages that
+        # are installed still have to be
+        cacheonly = base.conf.cacheonly
+        base.conf.cacheonly = False
+        try:
+            with timed("download"):
+                base.download_packages(install_set)
+        finally:
+            base.conf.cacheonly = cacheonly
+        check_signatures_dnf4(base, install_set)
+        with timed("transaction"):
+            base.do_transaction()
+        return {
+            "installed": [str(pkg) for pkg in install_set],
+            "removed": [str(pkg) for pkg in base.transaction.remove_set],
+        }
+    finally:
+        base.reset(goal=True)
+
+
+def transaction_dnf5(base, command):
+    goal = libdnf5.base.Goal(base)
+    for spec in command["packages"]:
+        if command["action"] == "install":
+            goal.add_rpm_install(spec)
+        else:
+            goal.add_rpm_remove(spec)
+    goal.set_allow_erasing(command["action"] == "remove")
+    with timed("resolve"):
+        transaction = goal.resolve()
+    if transaction.get_problems() != libdnf5.base.GoalProblem_NO_PROBLEM:
+        raise RuntimeError("\n".join(transaction.get_resolve_logs_as_strings()))
+    with timed("download"):
+        transaction.download()
+    if not transaction.check_gpg_signatures():
+        raise RuntimeError("\n".join(transaction.get_gpg_signature_problems()))
+    with timed("transaction"):
+        result = transaction.run()
+    if result != libdnf5.base.Transaction.TransactionRunResult_SUCCESS:
+        raise RuntimeError(
+            "\n".join(
+                [libdnf5.base.Transaction.transaction_result_to_string(result)]
+                + list(transaction.get_transaction_problems())
             )
         )
-        outpipe.flush()
+    installed = []
+    removed = []
+    for item in transaction.get_transaction_packages():
+        if libdnf5.transaction.transaction_item_action_is_inbound(item.get_action()):
+            installed.append(item.get_package().get_nevra())
+        elif libdnf5.transaction.transaction_item_action_is_outbound(item.get_action()):
+            removed.append(item.get_package().get_nevra())
+    return {"installed": installed, "removed": removed}
+
 
+def transaction(command):
+    """
+    Install or remove packages with the base that is already loaded for the
+    repos of the command, instead of the provider running the dnf command
+    which would load all of the repository metadata again.
+
+    The "packages" of the command are the same specs as the provider would
+    pass to "dnf -y install" or "dnf -y remove".  The answer is the NEVRAs of
+    the packages that the transaction installed and removed.
+    """
+    key = repo_key(command)
+    if key in bases and base_rpmdb[key] != rpmdb_cookie:
+        log(f"  => rpmdb changed since the sack for repos {key} was loaded")
+        drop_base(key)
+    base = get_base(command)
+    try:
+        if DNF_VERSION == 5:
+            return transaction_dnf5(base, command)
+        else:
+            return transaction_dnf4(base, command)
+    finally:
+        # even a failed transaction may have changed the rpmdb
+        refresh_installed()
 
-def query(command):
+
+def backend_info():
+    """
+    The major version of the dnf libraries that the helper uses, and of the dnf
+    command, which is a link to either dnf-3 or dnf5.  They can differ when
+    only the python bindings of the other one are installed.
+    """
+    cli_version = None
+    dnf_cli = shutil.which("dnf")
+    if dnf_cli is not None:
+        cli_name = os.path.basename(os.path.realpath(dnf_cli))
+        cli_version = 5 if cli_name.startswith("dnf5") else 4
+    return {"dnf_version": DNF_VERSION, "cli_version": cli_version}
+
+
+def versionlock_list_dnf5(base):
+    config = base.get_rpm_package_sack().get_versionlock_config()
+    return [pkg.get_name() for pkg in config.get_packages() if pkg.is_valid()]
+
+
+def versionlock_list_dnf4(base):
+    # the versionlock plugin is not loaded into the installed base, so read its
+    # config and lock list the same way that it does
+    locklist = "/etc/dnf/plugins/versionlock.list"
+    for confdir in base.conf.pluginconfpath:
+        parser = configparser.ConfigParser()
+        if parser.read(os.path.join(confdir, "versionlock.conf")):
+            if parser.has_option("main", "locklist"):
+                locklist = parser.get("main", "locklist")
+            break
+    try:
+        with open(locklist) as f:
+            lines = [line.strip() for line in f]
+    except OSError:
+        return []
+    names = []
+    for line in lines:
+        # skip comments and the excludes ("!name-v-r.arch")
+        if not line or line.startswith(("#", "!")):
+            continue
+        # "name-epoch:version-release.arch" with globs, or "epoch:name-version-release.arch"
+        parts = line.rsplit("-", 2)
+        name = parts[0] if len(parts) == 3 else line
+        names.append(name.split(":")[-1])
+    return names
+
+
+def versionlock_list():
+    """
+    The names of the packages that are locked by the versionlock plugin of
+    dnf4, or by dnf5's own versionlock, the same names as the provider used to
+    scrape from "dnf versionlock list".
+    """
+    base = get_installed_base()
     if DNF_VERSION == 5:
-        query_dnf5(command)
+        return versionlock_list_dnf5(base)
     else:
-        query_dnf4(command)
+        return versionlock_list_dnf4(base)
+
+
+def snapshot_installed_dnf5(base):
+    q = libdnf5.rpm.PackageQuery(base)
+    q.filter_installed()
+    installonlypkgs = get_installonlypkgs()
+    installonly = set()
+    if installonlypkgs:
+        installonlyq = libdnf5.rpm.PackageQuery(q)
+        installonlyq.filter_provides(installonlypkgs)
+        installonly = {pkg.get_nevra() for pkg in installonlyq}
+    packages = [
+        [
+            pkg.get_name(),
+            "{}:{}-{}".format(pkg.get_epoch(), pkg.get_version(), pkg.get_release()),
+            pkg.get_arch(),
+            pkg.get_nevra() in installonly,
+        ]
+        for pkg in q
+    ]
+    return base.get_vars().get_value("arch"), installonlypkgs, packages
+
+
+def snapshot_installed_dnf4(base):
+    q = base.sack.query(flags=hawkey.IGNORE_EXCLUDES).installed()
+    installonlypkgs = get_installonlypkgs()
+    installonly = set()
+    if installonlypkgs:
+        installonly = set(q.filter(provides=installonlypkgs))
+    packages = [
+        [
+            pkg.name,
+            "{}:{}-{}".format(pkg.epoch, pkg.version, pkg.release),
+            pkg.arch,
+            pkg in installonly,
+        ]
+        for pkg in q
+    ]
+    return hawkey.detect_arch(), installonlypkgs, packages
+
+
+def read_rpm_header(ts, path):
+    st = os.stat(path)
+    key = (path, st.st_size, st.st_mtime_ns)
+    if key not in rpm_headers:
+        for stale in [k for k in rpm_headers if k[0] == path]:
+            del rpm_headers[stale]
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            hdr = ts.hdrFromFdno(fd)
+        finally:
+            os.close(fd)
+        evr = f"{hdr[rpm.RPMTAG_EPOCH] or 0}:{hdr[rpm.RPMTAG_VERSION]}-{hdr[rpm.RPMTAG_RELEASE]}"
+        rpm_headers[key] = Package(hdr[rpm.RPMTAG_NAME], evr, hdr[rpm.RPMTAG_ARCH])
+    return rpm_headers[key]
+
+
+def read_rpm_headers(command):
+    """
+    The NEVRA of each of the local rpm files of the command, read from their
+    headers in-process rather than by running "rpm -qp" for every file.
+    """
+    ts = rpm.TransactionSet()
+    # like "rpm -qp", a signature by an unknown key is not an error, the
+    # digests of the header are still checked
+    ts.setVSFlags(rpm._RPMVSF_NOSIGNATURES)
+    with timed("read_rpm_headers"):
+        return [read_rpm_header(ts, path) for path in command["paths"]]
+
+
+def snapshot_installed():
+    """
+    Every installed package in one answer, so that the provider can index them
+    by name and look up what is installed without asking us again.
+
+    Each package is a [name, "e:v-r", arch, installonly] list, installonly
+    being whether it provides one of the "installonlypkgs" of the config.
+    The answer stays valid until the rpmdb changes, which the provider checks
+    for with the path and the cookie of the rpmdb that are sent along.
+    """
+    base = get_installed_base()
+    if DNF_VERSION == 5:
+        arch, installonlypkgs, packages = snapshot_installed_dnf5(base)
+    else:
+        arch, installonlypkgs, packages = snapshot_installed_dnf4(base)
+    return {
+        "arch": arch,
+        "installonlypkgs": installonlypkgs,
+        "packages": packages,
+        "rpmdb": {"path": get_rpmdb_path(), "cookie": rpmdb_cookie},
+    }
+
+
+def matches(package):
+    if package.evr is None:
+        return []
+    return [{"name": package.name, "version": package.evr, "arch": package.arch}]
+
+
+def encode(result):
+    # the packages anywhere in an answer become lists of matches, anything else
+    # (names, versions, stats) is sent as it is
+    if isinstance(result, Package):
+        return matches(result)
+    if isinstance(result, list):
+        return [encode(item) for item in result]
+    if isinstance(result, dict):
+        return {key: encode(value) for key, value in result.items()}
+    return result
+
+
+def respond(command, result):
+    """
+    Protocol 1 answers every request with a bare line: space-separated
+    "name e:v-r arch" triples for package queries ("nil" for a missing field),
+    and JSON for any other list or dict (versionlock_list, the _all queries).
+
+    Protocol 2 requests carry an "id" and are answered with a JSON object
+    tagged with that id, so a client can pipeline requests.  Package queries
+    answer with a list of matches, a batch with one list per sub-query, and
+    failures with an "error" object instead of killing the helper.
+    """
+    if command.get("protocol", 1) >= 2:
+        line = json.dumps({"id": command.get("id"), "result": encode(result)})
+    elif isinstance(result, Package):
+        line = format_package(result)
+    elif isinstance(result, list) and all(isinstance(item, Package) for item in result):
+        line = " ".join(format_package(package) for package in result)
+    elif result is None:
+        line = "nil nil nil"
+    elif isinstance(result, (list, dict)):
+        line = json.dumps(encode(result))
+    else:
+        line = str(result)
+    outpipe.write("{}\n".format(line))
+    outpipe.flush()
+
+
+def respond_error(command, error):
+    response = {
+        "id": command.get("id"),
+        "error": {"type": type(error).__name__, "message": str(error)},
+    }
+    outpipe.write("{}\n".format(json.dumps(response)))
+    outpipe.flush()
 
 
 # the design of this helper is that it should try to be 'brittle' and fail hard and exit in order
 # to keep process tables clean.  additional error handling should probably be added to the retry loop
 # on the ruby side.
 def exit_handler(signal, frame):
-    if DNF_VERSION == 4 and base is not None:
-        base.close()
+    close_bases()
     sys.exit(0)
 
 
-def setup_exit_handler():
+def setup_exit_handler(daemon=False):
     signal.signal(signal.SIGINT, exit_handler)
     signal.signal(signal.SIGHUP, exit_handler)
-    signal.signal(signal.SIGPIPE, exit_handler)
     signal.signal(signal.SIGQUIT, exit_handler)
+    if daemon:
+        # a client going away must only end its own connection
+        signal.signal(signal.SIGTERM, exit_handler)
+    else:
+        signal.signal(signal.SIGPIPE, exit_handler)
 
 
-if len(sys.argv) < 3:
-    inpipe = sys.stdin
-    outpipe = sys.stdout
-else:
-    os.set_blocking(int(sys.argv[1]), True)
-    inpipe = os.fdopen(int(sys.argv[1]), "r")
-    outpipe = os.fdopen(int(sys.argv[2]), "w")
+def dispatch(command):
+    check_rpmdb()
+    if command["action"] == "whatinstalled":
+        return whatprovides(command)
+    elif command["action"] == "whatavailable":
+        return whatprovides(command)
+    elif command["action"] in ("whatinstalled_all", "whatavailable_all"):
+        return whatprovides_all(command)
+    elif command["action"] == "batch":
+        return batch(command)
+    elif command["action"] == "resolve":
+        return resolve(command)
+    elif command["action"] == "snapshot_installed":
+        return snapshot_installed()
+    elif command["action"] == "read_rpm_headers":
+        return read_rpm_headers(command)
+    elif command["action"] in ("install", "remove"):
+        return transaction(command)
+    elif command["action"] == "release_memory":
+        release_memory()
+        return None
+    elif command["action"] == "versionlock_list":
+        return versionlock_list()
+    elif command["action"] == "backend_info":
+        return backend_info()
+    elif command["action"] == "versioncompare":
+        return versioncompare(command)
+    elif command["action"] == "refresh_installed":
+        refresh_installed()
+        return None
+    elif command["action"] == "flush_cache":
+        close_bases()
+        results_cache.clear()
+        return None
+    elif command["action"] == "refresh_metadata":
+        return refresh_metadata(command)
+    elif command["action"] == "metadata_age":
+        return metadata_age(command)
+    elif command["action"] == "export_snapshot":
+        return export_snapshot(command)
+    elif command["action"] == "import_snapshot":
+        return import_snapshot(command)
+    elif command["action"] == "cache_stats":
+        return dict(cache_stats, entries=len(results_cache))
+    elif command["action"] == "stats":
+        return get_stats()
+    elif command["action"] == "phase":
+        return phase()
+    elif command["action"] == "prefetch":
+        prefetch(command)
+        return None
+    else:
+        raise RuntimeError("bad command")
+
+
+def timed_dispatch(command):
+    global last_command
+    with lock:
+        started = time.monotonic()
+        try:
+            return dispatch(command)
+        finally:
+            last_command = time.monotonic()
+            elapsed = last_command - started
+            record(stats["queries"], command["action"], elapsed)
+            log(f"  => {command['action']} took {elapsed:.3f}s")
+            enforce_memory_budget()
+
+
+def handle(command):
+    log(f"COMMAND: {command}")
+    if command.get("protocol", 1) < 2:
+        respond(command, timed_dispatch(command))
+        return
+    try:
+        result = timed_dispatch(command)
+    except Exception as e:
+        log(f"  => error: {e!r}")
+        respond_error(command, e)
+        return
+    respond(command, result)
 
-try:
-    setup_exit_handler()
+
+def serve(daemon=False):
     while 1:
         # stop the process if the parent proc goes away
-        ppid = os.getppid()
-        if ppid == 1:
+        if not daemon and os.getppid() == 1:
             raise RuntimeError("orphaned")
 
         line = inpipe.readline()
@@ -474,15 +2134,99 @@ try:
         except ValueError:
             raise RuntimeError("bad json parse")
 
-        log(f"COMMAND: {command}")
-        if command["action"] == "whatinstalled":
-            query(command)
-        elif command["action"] == "whatavailable":
-            query(command)
-        elif command["action"] == "versioncompare":
-            versioncompare(command)
+        handle(command)
+
+
+def listen(path):
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except ConnectionRefusedError:
+            os.unlink(path)
         else:
-            raise RuntimeError("bad command")
-finally:
-    if DNF_VERSION == 4 and base is not None:
-        base.close()
+            raise RuntimeError(f"a dnf helper is already listening on {path}")
+        finally:
+            probe.close()
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # the helper runs as root and answers for the whole system
+    old_umask = os.umask(0o077)
+    try:
+        server.bind(path)
+    finally:
+        os.umask(old_umask)
+    server.listen(1)
+    return server
+
+
+def daemon(path):
+    """
+    Serve the same protocol over a Unix socket, one connection (one
+    chef-client run) at a time, keeping the loaded sacks in memory between
+    connections.  They are revalidated at the start of every connection.
+
+    Started with "dnf_helper.py --daemon /run/chef/dnf_helper.sock", e.g. from
+    a systemd unit; the chef-client connects to it if the socket exists.
+    """
+    global inpipe, outpipe
+    server = listen(path)
+    try:
+        while 1:
+            conn, _ = server.accept()
+            inpipe = conn.makefile("r")
+            outpipe = conn.makefile("w")
+            try:
+                with lock:
+                    revalidate()
+                serve(daemon=True)
+            except Exception as e:
+                # the forked helper would have died here, so start over from an empty state
+                log(f"connection failed: {e!r}")
+                with lock:
+                    close_bases()
+                    results_cache.clear()
+            finally:
+                for f in (inpipe, outpipe, conn):
+                    try:
+                        f.close()
+                    except OSError:
+                        pass
+    finally:
+        server.close()
+        os.unlink(path)
+
+
+def main():
+    global inpipe, outpipe
+    if len(sys.argv) == 3 and sys.argv[1] == "--daemon":
+        try:
+            setup_exit_handler(daemon=True)
+            start_watchdog()
+            daemon(sys.argv[2])
+        finally:
+            close_bases()
+        return
+
+    if len(sys.argv) < 3:
+        inpipe = sys.stdin
+        outpipe = sys.stdout
+    else:
+        os.set_blocking(int(sys.argv[1]), True)
+        inpipe = os.fdopen(int(sys.argv[1]), "r")
+        outpipe = os.fdopen(int(sys.argv[2]), "w")
+
+    # set by a client that starts the helper ahead of its first query
+    if os.environ.get("CHEF_DNF_HELPER_PREFETCH"):
+        prefetch({})
+
+    try:
+        setup_exit_handler()
+        start_watchdog()
+        serve()
+    finally:
+        close_bases()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+#
+# Copyright:: Copyright (c) 2009-2026 Progress Software Corporation and/or its subsidiaries or affiliates. All Rights Reserved.
+# License:: Apache License, Version 2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+require_relative "version"
+require_relative "version_compare"
+
+class Chef
+  class Provider
+    class Package
+      class Dnf < Chef::Provider::Package
+
+        # An index by name of every installed package, built from the "snapshot_installed" answer of the python
+        # helper, which answers most "what version of <name> is installed" queries without a round-trip.
+        #
+        # Only exact package names are looked up here.  Anything else (globs, versions, provides, version
+        # constraints, or a name that is installed for more than one arch) is left to the python helper by
+        # returning nil, so this never answers differently than the helper would.
+        class InstalledIndex
+          # @param snapshot [Hash] the "snapshot_installed" answer of the python helper
+          def initialize(snapshot)
+            @arch = snapshot["arch"]
+            @rpmdb = snapshot["rpmdb"] || {}
+            @packages = {}
+            snapshot["packages"].each do |name, version, arch, installonly|
+              (@packages[name] ||= []) << [ Version.new(name, version, arch), installonly ]
+            end
+          end
+
+          # @param name [String] the package name, optionally with a ".arch" suffix
+          # @param arch [String] the arch to look for
+          # @return [Version, nil] the latest installed version, or nil if the python helper has to be asked
+          def lookup(name, arch = nil)
+            return nil unless plain?(name) && (arch.nil? || plain?(arch))
+
+            unless @packages.key?(name)
+              # a "name.arch" package name
+              return nil unless arch.nil?
+
+              name, _, arch = name.rpartition(".")
+              return nil unless @packages.key?(name) && @packages[name].any? { |v, _| v.arch == arch }
+            end
+
+            candidates = @packages[name].map(&:first)
+            candidates = candidates.select { |v| v.arch == arch } unless arch.nil?
+            # the same preference for noarch and the native arch as the python helper
+            preferred = candidates.select { |v| v.arch == "noarch" || v.arch == @arch }
+            candidates = preferred unless preferred.empty?
+            return nil if candidates.empty? || candidates.map(&:arch).uniq.length > 1
+
+            candidates.max { |a, b| VersionCompare.compare(a.version, b.version) }
+          end
+
+          # @return [Boolean] whether any installed package of this name is installonly
+          def installonly?(name)
+            @packages.fetch(name, []).any? { |_, installonly| installonly }
+          end
+
+          # Something other than the provider (an rpm_package or an execute resource) may have changed the rpmdb
+          # since the snapshot was taken, this compares the same cookie of the rpmdb files as the python helper.
+          #
+          # @return [Boolean] whether the rpmdb is unchanged since the snapshot
+          def current?
+            !@rpmdb["path"].nil? && rpmdb_cookie(@rpmdb["path"]) == @rpmdb["cookie"]
+          end
+
+          # @return [Integer] the number of installed packages
+          def size
+            @packages.each_value.sum(&:length)
+          end
+
+          private
+
+          # the names, sizes and mtimes of the rpmdb files, see get_rpmdb_cookie() in dnf_helper.py
+          def rpmdb_cookie(dbpath)
+            entries = ::Dir.children(dbpath).sort.reject { |entry| entry.start_with?("__db", ".") || entry.end_with?("-shm") }
+            entries.filter_map do |entry|
+              st = ::File.stat(::File.join(dbpath, entry))
+              [ entry, st.size, st.mtime.tv_sec * 1_000_000_000 + st.mtime.tv_nsec ]
+            rescue SystemCallError
+              nil
+            end
+          rescue SystemCallError
+            nil
+          end
+
+          # a bare package name, which could not also be a glob, a version constraint or a name-version
+          def plain?(str)
+            str.is_a?(String) && str.match?(/\A[^\s*?\[\]<>=!]+\z/) && !str.match?(/-\d/)
+          end
+        end
+      end
+    end
+  end
+end
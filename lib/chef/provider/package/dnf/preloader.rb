@@ -0,0 +1,52 @@
+#
+# Copyright:: Copyright (c) 2009-2026 Progress Software Corporation and/or its subsidiaries or affiliates. All Rights Reserved.
+# License:: Apache License, Version 2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+require_relative "../../../event_dispatch/base"
+require_relative "../../../provider_resolver"
+require_relative "../../../resource/package"
+require_relative "../dnf"
+
+class Chef
+  class Provider
+    class Package
+      class Dnf < Chef::Provider::Package
+        # When Chef::Config[:dnf_helper_preload] is set this starts the python helper as soon as cookbook compilation
+        # starts, so that importing the dnf libraries and loading the sack overlaps with compiling the recipes instead
+        # of being done by the first package resource in the converge phase.
+        class Preloader < Chef::EventDispatch::Base
+          def cookbook_compilation_start(run_context)
+            return unless Chef::Config[:dnf_helper_preload]
+            return unless dnf_package_provider?(run_context)
+
+            Chef::Log.debug("Preloading the dnf python helper")
+            PythonHelper.instance.preload
+          rescue => e
+            # the helper will be started again by the first query, which will report any real problem
+            Chef::Log.debug("Unable to preload the dnf python helper: #{e}")
+          end
+
+          private
+
+          def dnf_package_provider?(run_context)
+            resource = Chef::Resource::Package.new("dnf_helper_preload", run_context)
+            Chef::ProviderResolver.new(run_context.node, resource, :install).resolve <= Chef::Provider::Package::Dnf
+          end
+        end
+      end
+    end
+  end
+end
@@ -20,9 +20,12 @@
 
 require_relative "../../../mixin/which"
 require_relative "../../../mixin/shell_out"
+require_relative "../python_interpreter_cache"
 require_relative "version"
+require_relative "installed_index"
 require "singleton" unless defined?(Singleton)
 require "timeout" unless defined?(Timeout)
+require "socket" unless defined?(UNIXSocket)
 
 class Chef
   class Provider
@@ -39,30 +42,96 @@ class Chef
           attr_accessor :inpipe
           attr_accessor :outpipe
           attr_accessor :wait_thr
+          attr_accessor :socket
 
           DNF_HELPER = ::File.expand_path(::File.join(::File.dirname(__FILE__), "dnf_helper.py")).freeze
 
+          # the version of the helper protocol that we speak, see respond() in dnf_helper.py
+          PROTOCOL_VERSION = 2
+
+          # the most bytes of requests that are written to the helper before reading back their answers.  the
+          # helper stops reading requests while it is blocked writing an answer that has not been read yet (the
+          # answer to snapshot_installed alone is larger than a pipe buffer), so the unanswered requests have to
+          # fit into the pipe buffer, which may be as small as one page, or both sides block on a full pipe.
+          PIPELINE_BYTES = 4096
+
           def dnf_command
             # platform-python is used for system tools on RHEL 8 and is installed under /usr/libexec
             py_cmd = "try:\n    import libdnf5\nexcept ImportError:\n    import dnf"
             @dnf_command ||= begin
                                executables = where("platform-python", "python", "python3", "python2", "python2.7", extra_path: "/usr/libexec")
-                               cmd = executables.find { |f| shell_out("#{f} -c '#{py_cmd}'").exitstatus == 0 }
+                               cmd = interpreter_cache.find(executables) { |f| shell_out("#{f} -c '#{py_cmd}'").exitstatus == 0 }
                                raise Chef::Exceptions::Package, "cannot find dnf libraries, you may need to use yum_package" unless cmd
 
                                "#{cmd} #{DNF_HELPER}"
                              end
           end
 
+          def interpreter_cache
+            @interpreter_cache ||= PythonInterpreterCache.new("dnf")
+          end
+
+          # environment used to pass Chef::Config tunables down to the python helper
+          def helper_env
+            env = {
+              "CHEF_DNF_HELPER_MAX_SACKS" => Chef::Config[:dnf_helper_max_sacks].to_s,
+              "CHEF_DNF_HELPER_METADATA_POLICY" => metadata_policy,
+            }
+            env["CHEF_DNF_HELPER_PREFETCH"] = "1" if @preload
+            env["CHEF_DNF_HELPER_MEMORY_BUDGET"] = Chef::Config[:dnf_helper_memory_budget].to_s if Chef::Config[:dnf_helper_memory_budget]
+            env["CHEF_DNF_HELPER_IDLE_TIMEOUT"] = Chef::Config[:dnf_helper_idle_timeout].to_s if Chef::Config[:dnf_helper_idle_timeout]
+            env["CHEF_DNF_HELPER_PARALLEL_LOAD"] = Chef::Config[:dnf_helper_parallel_load].to_s if Chef::Config[:dnf_helper_parallel_load]
+            env["CHEF_DNF_HELPER_SNAPSHOT"] = ::File.expand_path(Chef::Config[:dnf_helper_snapshot]) if Chef::Config[:dnf_helper_snapshot]
+            env
+          end
+
+          # Starts the helper ahead of its first query and has it load the sack in a background thread, so that the
+          # first query only waits for whatever loading is left.  Does nothing if the helper is already running.
+          def preload
+            return unless inpipe.nil?
+
+            @preload = true
+            start
+            # the daemon is already running, so ask it to prefetch instead
+            query("prefetch", {}) unless socket.nil?
+          ensure
+            @preload = false
+          end
+
+          # "expire", "never_expire" or "cache_only", see Chef::Config[:dnf_helper_metadata_policy]
+          def metadata_policy
+            (Chef::Config[:dnf_helper_metadata_policy] || "expire").to_s
+          end
+
+          # a long-running "dnf_helper.py --daemon" keeps its loaded sacks between chef-client runs
+          def daemon_socket_path
+            path = Chef::Config[:dnf_helper_socket]
+            path if path && ::File.socket?(path)
+          end
+
           def start
+            if ( path = daemon_socket_path )
+              begin
+                @socket = UNIXSocket.new(path)
+                @inpipe = @outpipe = socket
+                return
+              rescue SystemCallError => e
+                Chef::Log.debug("Unable to connect to the dnf helper daemon at #{path}, starting a new helper instead: #{e}")
+              end
+            end
             @inpipe, inpipe_write = IO.pipe
             outpipe_read, @outpipe = IO.pipe
-            @stdin, @stdout, @stderr, @wait_thr = Open3.popen3("#{dnf_command} #{outpipe_read.fileno} #{inpipe_write.fileno}", outpipe_read.fileno => outpipe_read, inpipe_write.fileno => inpipe_write, close_others: false)
+            @stdin, @stdout, @stderr, @wait_thr = Open3.popen3(helper_env, "#{dnf_command} #{outpipe_read.fileno} #{inpipe_write.fileno}", outpipe_read.fileno => outpipe_read, inpipe_write.fileno => inpipe_write, close_others: false)
             outpipe_read.close
             inpipe_write.close
           end
 
           def reap
+            @installed_index = @resolutions = nil
+            unless socket.nil?
+              socket.close rescue nil
+              @socket = @inpipe = @outpipe = nil
+            end
             unless wait_thr.nil?
               Process.kill("INT", wait_thr.pid) rescue nil
               begin
@@ -82,9 +151,119 @@ class Chef
           end
 
           def check
-            start if stdin.nil?
+            start if inpipe.nil?
+          end
+
+          # @return [Boolean] whether the helper has been started (or the helper daemon connected to)
+          def running?
+            !inpipe.nil?
+          end
+
+          # Reloads the installed packages after a transaction, keeping the available repository metadata loaded.
+          def refresh_installed
+            @installed_index = @resolutions = nil
+            query("refresh_installed", {})
+          end
+
+          # Every installed package, fetched from the helper in one query and kept until the installed packages
+          # change (see refresh_installed and flush_cache), or until anything else changes the rpmdb.
+          #
+          # @return [InstalledIndex]
+          def installed_index
+            @installed_index = nil unless @installed_index.nil? || @installed_index.current?
+            @installed_index ||= InstalledIndex.new(query("snapshot_installed", {}))
+          end
+
+          # The helper memoizes query results until the rpmdb changes.
+          #
+          # @return [Hash] the "hits", "misses" and "entries" counters of the helper's result cache
+          def cache_stats
+            query("cache_stats", {})
+          end
+
+          # Timings kept by the helper: the time spent in each phase of loading the sacks ("import", "load_config",
+          # "load_repos", ...), the count and time of each action it has answered, and the most recent sack loads.
+          # Along with its current RSS and how often it has dropped sacks to save memory.
+          #
+          # @return [Hash] the "phases", "queries", "sack_loads", "cache" and "memory" statistics of the helper
+          def stats
+            query("stats", {})
+          end
+
+          # Drops all of the sacks that the helper has loaded, like the yum helper's close_rpmdb.  They are rebuilt
+          # from the dnf cache by the next query that needs them.
+          def release_memory
+            query("release_memory", {})
+          end
+
+          # The helper loads only the rpmdb until a query needs the remote repository metadata.
+          #
+          # @return [String] "none", "installed" or "available"
+          def phase
+            query("phase", {})
+          end
+
+          # @return [Hash] the major "dnf_version" of the libraries used by the helper and the "cli_version" of the dnf command
+          def backend_info
+            @backend_info ||= query("backend_info", {})
+          end
+
+          # Checks every repo for new metadata whatever the metadata policy, and reloads the sack.
+          #
+          # @return [Hash] the metadata_age of each repo afterwards
+          # NB: "options" here is the dnf_package options hash and is deliberately not **opts
+          def refresh_metadata(options: {})
+            query("refresh_metadata", options_params(options || {}))
+          end
+
+          # @return [Hash] the seconds since the metadata of each enabled repo was downloaded, nil for a repo
+          #   without any metadata
+          # NB: "options" here is the dnf_package options hash and is deliberately not **opts
+          def metadata_age(options: {})
+            query("metadata_age", options_params(options || {}))
+          end
+
+          # Writes the repodata and solv files of the enabled repos to a directory along with a manifest of their
+          # repomd.xml checksums, for other nodes with the same repos to import instead of parsing the metadata.
+          #
+          # @param path [String] the directory to write the snapshot to, any previous snapshot there is replaced
+          # @return [Array<String>] the ids of the repos in the snapshot
+          # NB: "options" here is the dnf_package options hash and is deliberately not **opts
+          def export_snapshot(path, options: {})
+            query("export_snapshot", { "path" => ::File.expand_path(path) }.merge!(options_params(options || {})))
+          end
+
+          # Stages a snapshot written by export_snapshot into the dnf cache, see Chef::Config[:dnf_helper_snapshot]
+          # for having the helper do that before it loads the metadata.
+          #
+          # @param path [String] the directory of the snapshot
+          # @return [Hash] the ids of the repos that were "imported" or were already "current", and the reason
+          #   that each of the others was "skipped"
+          # NB: "options" here is the dnf_package options hash and is deliberately not **opts
+          def import_snapshot(path, options: {})
+            query("import_snapshot", { "path" => ::File.expand_path(path) }.merge!(options_params(options || {})))
+          end
+
+          # Reads the name, version and arch of local rpm files from their headers in the helper, rather than by
+          # running "rpm -qp" for each of them.  The helper remembers each file until its size or mtime changes.
+          #
+          # @param paths [Array<String>] the paths of the rpm files
+          # @return [Array<Version>]
+          def read_rpm_headers(paths)
+            paths = paths.map { |path| ::File.expand_path(path) }
+            query("read_rpm_headers", { "paths" => paths }).each_with_index.map { |matches, i| parse_matches(paths[i], matches) }
+          end
+
+          # @return [Array<String>] the names of the packages locked by the versionlock plugin (dnf4) or by dnf5
+          def versionlock_list
+            query("versionlock_list", {})
           end
 
+          # The provider compares versions in-process with VersionCompare.  This asks the helper instead, and is
+          # only kept for the specs that check VersionCompare against the helper's rpm comparison (see
+          # spec/data/dnf/version_compare_corpus.txt).
+          #
+          # @api private
           def compare_versions(version1, version2)
             query("versioncompare", { "versions" => [version1, version2] }).to_i
           end
@@ -109,23 +288,174 @@ class Chef
           # @return Array<Version>
           # NB: "options" here is the dnf_package options hash and is deliberately not **opts
           def package_query(action, provides, version: nil, arch: nil, options: {})
+            if action == :whatinstalled && version.nil? && ( installed = installed_index.lookup(provides, arch) )
+              Chef::Log.trace "found #{installed} in the installed package index"
+              return installed
+            end
+
             parameters = { "provides" => provides, "version" => version, "arch" => arch }
-            repo_opts = options_params(options || {})
-            parameters.merge!(repo_opts)
-            # XXX: for now we restart before and after every query with an enablerepo/disablerepo to clean the helpers internal state
-            restart unless repo_opts.empty?
-            query_output = query(action, parameters)
-            version = parse_response(query_output.lines.last)
+            # the helper keeps a separately loaded sack for each distinct set of enablerepo/disablerepo options
+            parameters.merge!(options_params(options || {}))
+            version = parse_matches(provides, query(action, parameters))
             Chef::Log.trace "parsed #{version} from python helper"
-            reap unless repo_opts.empty?
             version
           end
 
+          # Resolves a list of packages with a single round-trip to the python helper.
+          #
+          # @param action [Symbol] :whatinstalled or :whatavailable
+          # @param provides [Array<String>] the package names to query
+          # @param versions [Array<String>] the versions to query, aligned with provides
+          # @param arches [Array<String>] the arches to query, aligned with provides
+          # @return Array<Version>
+          # NB: "options" here is the dnf_package options hash and is deliberately not **opts
+          def package_query_batch(action, provides, versions: [], arches: [], options: {})
+            results = provides.each_index.map do |i|
+              installed_index.lookup(provides[i], arches[i]) if action == :whatinstalled && versions[i].nil?
+            end
+            missing = results.each_index.select { |i| results[i].nil? }
+            unless missing.empty?
+              queries = missing.map do |i|
+                build_query_hash(action, { "provides" => provides[i], "version" => versions[i], "arch" => arches[i] })
+              end
+              parameters = { "queries" => queries }
+              # the helper keeps a separately loaded sack for each distinct set of enablerepo/disablerepo options
+              parameters.merge!(options_params(options || {}))
+              matches = query(:batch, parameters)
+              missing.each_with_index { |i, j| results[i] = parse_matches(provides[i], matches[j]) }
+            end
+            Chef::Log.trace "parsed #{results} from python helper"
+            results
+          end
+
+          # Resolves a list of packages with a single round-trip to the python helper, which looks up everything that
+          # the provider needs to know about each package together: the available candidate, the installed package
+          # that matches the version, the currently installed package, and whether the package is installonly.
+          #
+          # @param provides [Array<String>] the package names to resolve
+          # @param versions [Array<String>] the versions to resolve, aligned with provides
+          # @param arches [Array<String>] the arches to resolve, aligned with provides
+          # @return [Array<Hash>] the :available, :installed and :current Versions and :installonly of each package
+          # NB: "options" here is the dnf_package options hash and is deliberately not **opts
+          def resolve_batch(provides, versions: [], arches: [], options: {})
+            # the helper keeps a separately loaded sack for each distinct set of enablerepo/disablerepo options
+            repo_params = options_params(options || {})
+            results = provides.each_with_index.map { |p, i| prefetched_resolutions[[p, versions[i], arches[i], repo_params]] }
+            missing = results.each_index.select { |i| results[i].nil? }
+            Chef::Log.trace "found #{provides.length - missing.length} of #{provides.length} packages in the prefetched resolutions"
+            unless missing.empty?
+              queries = missing.map do |i|
+                build_query_hash(:resolve, { "provides" => provides[i], "version" => versions[i], "arch" => arches[i] })
+              end
+              answers = query(:batch, { "queries" => queries }.merge(repo_params))
+              missing.zip(answers).each { |i, answer| results[i] = parse_resolution(provides[i], answer) }
+            end
+            Chef::Log.trace "parsed #{results} from python helper"
+            results
+          end
+
+          # Resolves the packages of every dnf_package resource of the run up front (see Package::Prefetcher), with
+          # one batch request for each distinct set of enablerepo/disablerepo options so that the helper answers each
+          # of them in one pass over its sack, and with all of the batches pipelined.  resolve_batch answers from these
+          # until the installed packages change or clear_resolutions is called.
+          #
+          # @param packages [Array<Array(String, String, String, Array)>] the name, version, arch and options of each package
+          # @return [Integer] the number of packages that were resolved
+          def prefetch_resolutions(packages)
+            groups = packages.uniq.group_by { |_, _, _, options| options_params(options || {}) }.to_a
+            requests = groups.map do |repo_params, group|
+              queries = group.map do |provides, version, arch, _|
+                build_query_hash(:resolve, { "provides" => provides, "version" => version, "arch" => arch })
+              end
+              [:batch, { "queries" => queries }.merge(repo_params)]
+            end
+            # the resolutions are only good for as long as this snapshot of the rpmdb is.  it is asked for on its
+            # own since its answer is the largest one by far.
+            @installed_index = InstalledIndex.new(query("snapshot_installed", {}))
+            answers = pipeline(requests)
+            @resolutions = {}
+            groups.zip(answers).each do |(repo_params, group), group_answers|
+              group.zip(group_answers).each do |(provides, version, arch, _), answer|
+                @resolutions[[provides, version, arch, repo_params]] = parse_resolution(provides, answer)
+              end
+            end
+            @resolutions.size
+          end
+
+          # Forgets the resolutions of prefetch_resolutions, they only last for one chef-client run.
+          def clear_resolutions
+            @resolutions = nil
+          end
+
+          # Sends requests to the python helper without waiting for the answer to one before sending the next,
+          # the answers are tagged with the id of their request and read back in bulk.
+          #
+          # @param requests [Array<Array(Symbol, Hash)>] the action and the parameters of each request
+          # @param retries [Integer] how many times to try the requests, restarting the helper in between
+          # @param timeout [Integer] the seconds to wait for all of the answers
+          # @return [Array] the result of each request, in the same order as the requests
+          def pipeline(requests, retries: 5, timeout: 600)
+            responses = with_helper(retries: retries, timeout: timeout) do
+              ids = requests.map { @request_id = (@request_id || 0) + 1 }
+              answers = {}
+              unanswered = {}
+              requests.each_with_index do |(action, parameters), i|
+                json = build_query(action, parameters.merge("protocol" => PROTOCOL_VERSION, "id" => ids[i]))
+                # a request that does not fit on its own is sent once every earlier one has been answered
+                until unanswered.empty? || unanswered.values.sum + json.bytesize < PIPELINE_BYTES
+                  outpipe.flush
+                  read_answer(answers)
+                  unanswered.delete_if { |id, _| answers.key?(id) }
+                end
+                Chef::Log.trace "sending '#{json}' to python helper"
+                outpipe.puts json
+                unanswered[ids[i]] = json.bytesize + 1
+              end
+              outpipe.flush
+              read_answer(answers) while answers.size < requests.size
+              ids.map { |id| answers.fetch(id) }
+            end
+            responses.map do |response|
+              if response["error"]
+                raise Chef::Exceptions::Package, "dnf_helper.py failed: #{response["error"]["type"]}: #{response["error"]["message"]}"
+              end
+
+              response["result"]
+            end
+          end
+
+          # Installs or removes packages in the helper, with the repository metadata that it already has loaded.  A
+          # transaction is never retried, since it may have been partly run.
+          #
+          # @param action [Symbol] :install or :remove
+          # @param packages [Array<String>] the package specs, as they would be passed to "dnf install" or "dnf remove"
+          # @param timeout [Integer] the seconds to wait for the transaction
+          # @return [Hash] the NEVRAs of the "installed" and "removed" packages
+          # NB: "options" here is the dnf_package options hash and is deliberately not **opts
+          def transaction(action, packages, options: {}, timeout: 900)
+            parameters = { "packages" => packages }
+            parameters.merge!(options_params(options || {}))
+            pipeline([[action, parameters]], retries: 1, timeout: timeout).first
+          ensure
+            @installed_index = @resolutions = nil
+          end
+
           def restart
             reap
             start
           end
 
+          # Throws away all of the loaded repository metadata.  The daemon is shared and outlives us, so rather
+          # than restarting it we ask it to drop its sacks.  Unless the metadata policy is "expire" nothing else
+          # ever refreshes the metadata, so that is done here as well.
+          #
+          # NB: "options" here is the dnf_package options hash and is deliberately not **opts
+          def flush_cache(options: {})
+            restart
+            query("flush_cache", {}) unless socket.nil?
+            refresh_metadata(options: options) unless metadata_policy == "expire"
+          end
+
           private
 
           # i couldn't figure out how to decompose an evr on the python side, it seems reasonably
@@ -148,39 +478,60 @@ class Chef
           end
 
           def query(action, parameters)
-            json = build_query(action, parameters)
-            with_helper do
-              Chef::Log.trace "sending '#{json}' to python helper"
-              outpipe.puts json
-              outpipe.flush
-              output = inpipe.readline.chomp
-              Chef::Log.trace "got '#{output}' from python helper"
-              output
-            end
+            pipeline([[action, parameters]]).first
+          end
+
+          def read_answer(answers)
+            output = inpipe.readline.chomp
+            Chef::Log.trace "got '#{output}' from python helper"
+            answer = FFI_Yajl::Parser.parse(output)
+            answers[answer["id"]] = answer
           end
 
           def build_query(action, parameters)
+            FFI_Yajl::Encoder.encode(build_query_hash(action, parameters))
+          end
+
+          def build_query_hash(action, parameters)
             hash = { "action" => action }
             parameters.each do |param_name, param_value|
               hash[param_name] = param_value unless param_value.nil?
             end
 
             # Special handling for certain action / param combos
-            if %i{whatinstalled whatavailable}.include?(action)
+            if %i{whatinstalled whatavailable whatinstalled_all whatavailable_all resolve}.include?(action)
               add_version(hash, parameters["version"]) unless parameters["version"].nil?
             end
 
-            FFI_Yajl::Encoder.encode(hash)
+            hash
+          end
+
+          # the best match comes first, a query that matched nothing is answered with just the name that was asked for
+          def parse_matches(provides, matches)
+            return Version.new(provides.split.first, nil, nil) if matches.empty?
+
+            Version.new(matches.first["name"], matches.first["version"], matches.first["arch"])
+          end
+
+          # the Versions of a "resolve" answer
+          def parse_resolution(provides, answer)
+            {
+              available: parse_matches(provides, answer["available"]),
+              installed: parse_matches(provides, answer["installed"]),
+              current: parse_matches(provides, answer["current"]),
+              installonly: answer["installonly"],
+            }
           end
 
-          def parse_response(output)
-            array = output.split.map { |x| x == "nil" ? nil : x }
-            array.each_slice(3).map { |x| Version.new(*x) }.first
+          # the prefetched resolutions, as long as nothing has changed the rpmdb since they were fetched
+          def prefetched_resolutions
+            @resolutions = nil unless @installed_index&.current?
+            @resolutions || {}
           end
 
           def drain_fds
             output = ""
-            fds, = IO.select([stderr, stdout, inpipe], nil, nil, 0)
+            fds, = IO.select([stderr, stdout, inpipe].compact, nil, nil, 0)
             unless fds.nil?
               fds.each do |fd|
                 output += fd.sysread(4096) rescue ""
@@ -191,10 +542,10 @@ class Chef
             output
           end
 
-          def with_helper
-            max_retries ||= 5
+          def with_helper(retries: 5, timeout: 600)
+            max_retries ||= retries
             ret = nil
-            Timeout.timeout(600) do
+            Timeout.timeout(timeout) do
               check
               ret = yield
             end
@@ -212,6 +563,9 @@ class Chef
               end
               retry
             else
+              # the python found on an earlier run may no longer be able to import dnf
+              interpreter_cache.forget
+              @dnf_command = nil
               raise e if output.empty?
 
               raise "dnf_helper.py had stderr/stdout output:\n\n#{output}"
@@ -0,0 +1,65 @@
+#
+# Copyright:: Copyright (c) 2009-2026 Progress Software Corporation and/or its subsidiaries or affiliates. All Rights Reserved.
+# License:: Apache License, Version 2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+require_relative "../../../event_dispatch/base"
+require_relative "../../../resource/dnf_package"
+require_relative "../dnf"
+
+class Chef
+  class Provider
+    class Package
+      class Dnf < Chef::Provider::Package
+        # Asks the python helper how it spent its time once at the end of the converge phase, logs that once for the
+        # whole run, and saves it in node.run_state[:dnf_helper_stats] for report handlers.  A helper that is not
+        # running, or that no dnf_package resource was converged with, is never asked.
+        class StatsCollector < Chef::EventDispatch::Base
+          def converge_start(run_context)
+            @run_context = run_context
+          end
+
+          def converge_complete
+            collect_stats
+          end
+
+          def converge_failed(exception)
+            collect_stats
+          end
+
+          private
+
+          def collect_stats
+            return if @run_context.nil? || !PythonHelper.instance.running?
+
+            converged = false
+            @run_context.resource_collection.each do |resource|
+              converged ||= resource.is_a?(Chef::Resource::DnfPackage) && resource.executed_by_runner
+            end
+            return unless converged
+
+            stats = PythonHelper.instance.stats
+            Chef::Log.info("dnf python helper stats: #{stats}")
+            @run_context.node.run_state[:dnf_helper_stats] = stats
+          rescue => e
+            Chef::Log.debug("Unable to get the dnf python helper stats: #{e}")
+          ensure
+            @run_context = nil
+          end
+        end
+      end
+    end
+  end
+end
@@ -0,0 +1,202 @@
+#
+# Copyright:: Copyright (c) 2009-2026 Progress Software Corporation and/or its subsidiaries or affiliates. All Rights Reserved.
+# License:: Apache License, Version 2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+class Chef
+  class Provider
+    class Package
+      class Dnf < Chef::Provider::Package
+
+        # In-process RPM version comparison for the dnf provider.
+        #
+        # This must give exactly the same answers as the "versioncompare" action of dnf_helper.py, it is
+        # a port of the version_tuple() parsing in the helper and of rpmvercmp() from rpm's lib/rpmvercmp.c
+        # (including the tilde and caret rules).  The spec/data/dnf/version_compare_corpus.txt file is
+        # checked against both this and the python helper, please add any new cases there.
+        #
+        # NOTE: this is deliberately not Yum::RPMUtils, that code predates tilde/caret support and does
+        # not match rpm.
+        class VersionCompare
+          CACHE_SIZE = 1024
+
+          class << self
+            # @param version1 [String] an [epoch:]version[-release[.arch]] string
+            # @param version2 [String] an [epoch:]version[-release[.arch]] string
+            # @return [Integer] -1, 0 or 1 (0 if either version is nil)
+            def compare(version1, version2)
+              return 0 if version1.nil? || version2.nil?
+
+              key = [version1, version2]
+              cache.fetch(key) do
+                cache.clear if cache.size >= CACHE_SIZE
+                cache[key] = compare_evr(version_tuple(version1), version_tuple(version2))
+              end
+            end
+
+            # Splits a version string into an [epoch, version, release] triple the same way as the python helper
+            # does, including its handling of the trailing arch.
+            #
+            # @return [Array<String>]
+            def version_tuple(versionstr)
+              epoch = "0"
+              version = nil
+              release = nil
+              colon_index = versionstr.index(":") || -1
+              epoch = versionstr[0...colon_index] if colon_index > 0
+              dash_index = versionstr.index("-") || -1
+              if dash_index > 0
+                tmp = substring(versionstr, colon_index + 1, dash_index)
+                version = tmp unless tmp.empty?
+                arch_index = versionstr.rindex(".") || -1
+                release = if arch_index > dash_index
+                            substring(versionstr, dash_index + 1, arch_index)
+                          else
+                            substring(versionstr, dash_index + 1, versionstr.length)
+                          end
+              else
+                tmp = substring(versionstr, colon_index + 1, versionstr.length)
+                version = tmp unless tmp.empty?
+              end
+              [epoch, version, release]
+            end
+
+            # rpm's labelCompare() on [epoch, version, release] triples
+            #
+            # @return [Integer] -1, 0 or 1
+            def compare_evr(evr1, evr2)
+              evr1.zip(evr2).each do |a, b|
+                rc = compare_values(a, b)
+                return rc unless rc == 0
+              end
+              0
+            end
+
+            # port of rpmvercmp() from rpm's lib/rpmvercmp.c
+            #
+            # @return [Integer] -1, 0 or 1
+            def rpmvercmp(a, b)
+              return 0 if a == b
+
+              one = 0
+              two = 0
+              while one < a.length || two < b.length
+                one += 1 while one < a.length && separator?(a[one])
+                two += 1 while two < b.length && separator?(b[two])
+
+                # handle the tilde separator, it sorts before everything else
+                if a[one] == "~" || b[two] == "~"
+                  return 1 if a[one] != "~"
+                  return -1 if b[two] != "~"
+
+                  one += 1
+                  two += 1
+                  next
+                end
+
+                # handle the caret separator, the same as tilde except that if one of the strings ends (the
+                # base version) then the other one is considered to be the higher version
+                if a[one] == "^" || b[two] == "^"
+                  return -1 if one >= a.length
+                  return 1 if two >= b.length
+                  return 1 if a[one] != "^"
+                  return -1 if b[two] != "^"
+
+                  one += 1
+                  two += 1
+                  next
+                end
+
+                # if we ran to the end of either, we are finished with the loop
+                break if one >= a.length || two >= b.length
+
+                # grab the first completely alpha or completely numeric segment
+                isnum = digit?(a[one])
+                str1 = one
+                str2 = two
+                if isnum
+                  str1 += 1 while str1 < a.length && digit?(a[str1])
+                  str2 += 1 while str2 < b.length && digit?(b[str2])
+                else
+                  str1 += 1 while str1 < a.length && alpha?(a[str1])
+                  str2 += 1 while str2 < b.length && alpha?(b[str2])
+                end
+
+                # the segments are of different types: one numeric, the other alpha (i.e. empty), numeric
+                # segments are always newer than alpha segments
+                return (isnum ? 1 : -1) if two == str2
+
+                seg1 = a[one...str1]
+                seg2 = b[two...str2]
+                if isnum
+                  # throw away any leading zeros and then whichever number has more digits wins
+                  seg1 = seg1.sub(/\A0+/, "")
+                  seg2 = seg2.sub(/\A0+/, "")
+                  return 1 if seg1.length > seg2.length
+                  return -1 if seg2.length > seg1.length
+                end
+
+                rc = seg1 <=> seg2
+                return rc unless rc == 0
+
+                one = str1
+                two = str2
+              end
+
+              # all of the numeric and alpha segments compared identically but the separators were different
+              return 0 if one >= a.length && two >= b.length
+
+              # whichever version still has characters left over wins
+              one >= a.length ? -1 : 1
+            end
+
+            private
+
+            def cache
+              @cache ||= {}
+            end
+
+            # python slice semantics, an empty string if the range is backwards
+            def substring(str, start, stop)
+              return "" if stop <= start
+
+              str[start...stop]
+            end
+
+            def compare_values(a, b)
+              return 0 if a.nil? && b.nil?
+              return 1 if b.nil?
+              return -1 if a.nil?
+
+              rpmvercmp(a, b)
+            end
+
+            def digit?(c)
+              c.between?("0", "9")
+            end
+
+            def alpha?(c)
+              c.between?("a", "z") || c.between?("A", "Z")
+            end
+
+            def separator?(c)
+              !digit?(c) && !alpha?(c) && c != "~" && c != "^"
+            end
+          end
+        end
+      end
+    end
+  end
+end
@@ -0,0 +1,99 @@
+#
+# Copyright:: Copyright (c) 2009-2026 Progress Software Corporation and/or its subsidiaries or affiliates. All Rights Reserved.
+# License:: Apache License, Version 2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+require_relative "../../event_dispatch/base"
+require_relative "../../provider_resolver"
+require_relative "../../resource/dnf_package"
+require_relative "../../resource/yum_package"
+require_relative "dnf"
+require_relative "yum"
+
+class Chef
+  class Provider
+    class Package
+      # When Chef::Config[:package_helper_prefetch] is set this resolves the packages of every dnf_package and
+      # yum_package resource in the resource collection as soon as the converge phase starts, with a single round-trip
+      # to each python helper, rather than with one round-trip per resource as each of them is converged.  The helpers
+      # keep the answers for the rest of the run (or until the installed packages change) and the providers look
+      # there first.
+      #
+      # Resources with a source package, or with a lazy name, version, arch or options, are left to be resolved when
+      # they are converged.
+      class Prefetcher < Chef::EventDispatch::Base
+        PROPERTIES = %i{package_name version arch options}.freeze
+
+        def converge_start(run_context)
+          return unless Chef::Config[:package_helper_prefetch]
+
+          packages = Hash.new { |h, k| h[k] = [] }
+          run_context.resource_collection.each do |resource|
+            next unless prefetchable?(resource)
+
+            helper = python_helper(Chef::ProviderResolver.new(run_context.node, resource, resource.action.first).resolve)
+            packages[helper].concat(packages(resource)) unless helper.nil?
+          end
+
+          @helpers = packages.keys
+          packages.each do |helper, list|
+            Chef::Log.debug("Prefetching #{list.length} packages with the #{helper}")
+            helper.instance.prefetch_resolutions(list)
+          end
+        rescue => e
+          # anything that was not prefetched is resolved by its provider, which will report any real problem
+          Chef::Log.debug("Unable to prefetch packages: #{e}")
+        end
+
+        def converge_complete
+          clear_resolutions
+        end
+
+        def converge_failed(exception)
+          clear_resolutions
+        end
+
+        private
+
+        def clear_resolutions
+          (@helpers || []).each { |helper| helper.instance.clear_resolutions }
+          @helpers = nil
+        end
+
+        def prefetchable?(resource)
+          (resource.is_a?(Chef::Resource::DnfPackage) || resource.is_a?(Chef::Resource::YumPackage)) && resource.source.nil? &&
+            PROPERTIES.none? { |name| resource.class.properties[name].get_value(resource).is_a?(Chef::DelayedEvaluator) }
+        end
+
+        def python_helper(provider)
+          if provider <= Chef::Provider::Package::Dnf
+            Chef::Provider::Package::Dnf::PythonHelper
+          elsif provider <= Chef::Provider::Package::Yum
+            Chef::Provider::Package::Yum::PythonHelper
+          end
+        end
+
+        # the name, version, arch and options of each package of the resource, in the same way as the providers
+        # split them up into package_name_array, safe_version_array and safe_arch_array
+        def packages(resource)
+          names = [ resource.package_name ].flatten
+          versions = resource.version.is_a?(Array) ? resource.version : [ resource.version ]
+          arches = resource.arch.is_a?(Array) ? resource.arch : [ resource.arch ]
+          names.each_with_index.map { |name, i| [ name, versions[i], arches[i], resource.options ] }
+        end
+      end
+    end
+  end
+end
@@ -0,0 +1,87 @@
+#
+# Copyright:: Copyright (c) 2009-2026 Progress Software Corporation and/or its subsidiaries or affiliates. All Rights Reserved.
+# License:: Apache License, Version 2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+require_relative "../package"
+require_relative "../../file_cache"
+
+class Chef
+  class Provider
+    class Package
+      # Finding a python that can run the dnf or yum helper means importing the whole of the dnf or yum libraries
+      # with each candidate interpreter in turn, which takes a second or more at the start of every chef-client run.
+      # The interpreter that was found is remembered in the file cache along with the path, the realpath and the
+      # mtime of every candidate, and the candidates are only probed again once any of those change (or the helper
+      # fails to start with the remembered interpreter, see #forget).
+      class PythonInterpreterCache
+        # @param name [String] the helper that the interpreter is for, "dnf" or "yum"
+        def initialize(name)
+          @name = name
+        end
+
+        # @param candidates [Array<String>] the paths of the interpreters, in order of preference
+        # @yield [String] the path of a candidate, should return whether it can run the helper
+        # @return [String, nil] the first candidate for which the block returned true
+        def find(candidates)
+          key = fingerprint(candidates)
+          cached = read
+          if cached && cached["candidates"] == key
+            Chef::Log.trace("Using the cached #{@name} helper python #{cached["python"]}")
+            return cached["python"]
+          end
+
+          python = candidates.find { |candidate| yield candidate }
+          write("candidates" => key, "python" => python) unless python.nil?
+          python
+        end
+
+        # forgets the remembered interpreter, so that the candidates are probed again
+        def forget
+          Chef::FileCache.delete(cache_file)
+        rescue SystemCallError => e
+          Chef::Log.debug("Unable to remove #{cache_file} from the file cache: #{e}")
+        end
+
+        private
+
+        def cache_file
+          "#{@name}_helper_python.json"
+        end
+
+        def fingerprint(candidates)
+          candidates.map do |candidate|
+            st = ::File.stat(candidate)
+            [ candidate, ::File.realpath(candidate), st.mtime.to_i * 1_000_000_000 + st.mtime.nsec ]
+          rescue SystemCallError
+            [ candidate ]
+          end
+        end
+
+        def read
+          FFI_Yajl::Parser.parse(Chef::FileCache.load(cache_file))
+        rescue Chef::Exceptions::FileNotFound, SystemCallError, FFI_Yajl::ParseError
+          nil
+        end
+
+        def write(data)
+          Chef::FileCache.store(cache_file, FFI_Yajl::Encoder.encode(data))
+        rescue SystemCallError => e
+          Chef::Log.debug("Unable to save the #{@name} helper python to the file cache: #{e}")
+        end
+      end
+    end
+  end
+end
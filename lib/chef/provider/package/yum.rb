@@ -110,13 +110,12 @@ class Chef
             next if n.nil?
 
             av = available_version(i)
-            name = av.name # resolve the name via the available/candidate version
             iv = python_helper.package_query(:whatinstalled, av.name_with_arch, options: options)
 
             method = "install"
 
             # If this is a package like the kernel that can be installed multiple times, we'll skip over this logic
-            if new_resource.allow_downgrade && version_gt?(iv.version_with_arch, av.version_with_arch) && !python_helper.install_only_packages(name)
+            if new_resource.allow_downgrade && version_gt?(iv.version_with_arch, av.version_with_arch) && !installonly?(i)
               # We allow downgrading only in the event of single-package
               # rules where the user explicitly allowed it
               method = "downgrade"
@@ -220,14 +219,20 @@ class Chef
         end
 
         def resolve_source_to_version_obj
-          shell_out!("rpm -qp --queryformat '%{NAME} %{EPOCH} %{VERSION} %{RELEASE} %{ARCH}\n' #{new_resource.source}").stdout.each_line do |line|
-            # this is another case of committing the sin of doing some lightweight mangling of RPM versions in ruby -- but the output of the rpm command
-            # does not match what the yum library accepts.
-            case line
-              when /^(\S+)\s+(\S+)\s+(\S+)\s+(\S+)\s+(\S+)$/
-                return Version.new($1, "#{$2 == "(none)" ? "0" : $2}:#{$3}-#{$4}", $5)
-            end
-          end
+          python_helper.read_rpm_headers([ new_resource.source ]).first
+        end
+
+        # resolves the available, installed and current versions of a package and whether it is installonly with one
+        # request to the python helper
+        def resolve_package(index)
+          resolution = python_helper.resolve(package_name_array[index], version: safe_version_array[index], arch: safe_arch_array[index], options: options)
+          @magical_version ||= []
+          @current_version ||= []
+          @installonly ||= []
+          @magical_version[index] ||= resolution[:installed]
+          @current_version[index] ||= resolution[:current]
+          @installonly[index] = resolution[:installonly] if @installonly[index].nil?
+          resolution[:available]
         end
 
         # @return Array<Version>
@@ -237,12 +242,18 @@ class Chef
           @available_version[index] ||= if new_resource.source
                                           resolve_source_to_version_obj
                                         else
-                                          python_helper.package_query(:whatavailable, package_name_array[index], version: safe_version_array[index], arch: safe_arch_array[index], options: options)
+                                          resolve_package(index)
                                         end
 
           @available_version[index]
         end
 
+        def installonly?(index)
+          @installonly ||= []
+          @installonly[index] = python_helper.install_only_packages(available_version(index).name) if @installonly[index].nil?
+          @installonly[index]
+        end
+
         def magical_version(index)
           @magical_version ||= []
           @magical_version[index] ||= if new_resource.source
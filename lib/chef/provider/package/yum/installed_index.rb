@@ -0,0 +1,102 @@
+#
+# Copyright:: Copyright (c) 2009-2026 Progress Software Corporation and/or its subsidiaries or affiliates. All Rights Reserved.
+# License:: Apache License, Version 2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+require_relative "version"
+
+class Chef
+  class Provider
+    class Package
+      class Yum < Chef::Provider::Package
+
+        # An index by name of every installed package, built from the "snapshot_installed" answer of the python
+        # helper, which answers most "what version of <name> is installed" queries without a round-trip.
+        #
+        # Only an exact package name that is installed exactly once (for the requested arch) is looked up here.
+        # Anything else is left to the python helper by returning nil, since picking the best of several arches
+        # or versions is up to yum.
+        class InstalledIndex
+          # @param snapshot [Hash] the "snapshot_installed" answer of the python helper
+          def initialize(snapshot)
+            @installonlypkgs = snapshot["installonlypkgs"] || []
+            @rpmdb_path = (snapshot["rpmdb"] || {})["path"]
+            @rpmdb_cookie = rpmdb_cookie(@rpmdb_path) unless @rpmdb_path.nil?
+            @packages = {}
+            snapshot["packages"].each do |name, version, arch|
+              (@packages[name] ||= []) << Version.new(name, version, arch)
+            end
+          end
+
+          # @param name [String] the package name, optionally with a ".arch" suffix
+          # @param arch [String] the arch to look for
+          # @return [Version, nil] the installed version, or nil if the python helper has to be asked
+          def lookup(name, arch = nil)
+            return nil unless plain?(name) && (arch.nil? || plain?(arch))
+
+            unless @packages.key?(name)
+              # a "name.arch" package name
+              return nil unless arch.nil?
+
+              name, _, arch = name.rpartition(".")
+              return nil unless @packages.key?(name)
+            end
+
+            candidates = @packages[name]
+            candidates = candidates.select { |v| v.arch == arch } unless arch.nil?
+            candidates.first if candidates.length == 1
+          end
+
+          # the same answer as the "installonlypkgs" action of the python helper
+          #
+          # @return [Boolean]
+          def installonly?(name)
+            @installonlypkgs.include?(name)
+          end
+
+          # Something other than the provider (an rpm_package or an execute resource) may have changed the rpmdb
+          # since the snapshot was taken.  yum has no cheap way of telling, so this compares the names, sizes and
+          # mtimes of the rpmdb files with how they were when the snapshot was taken.
+          #
+          # @return [Boolean] whether the rpmdb is unchanged since the snapshot
+          def current?
+            !@rpmdb_cookie.nil? && rpmdb_cookie(@rpmdb_path) == @rpmdb_cookie
+          end
+
+          private
+
+          # the same cookie as the dnf InstalledIndex, the Berkeley DB environment and lock files are left out
+          # since the helper's own reads of the rpmdb write to them
+          def rpmdb_cookie(dbpath)
+            entries = ::Dir.children(dbpath).sort.reject { |entry| entry.start_with?("__db", ".") || entry.end_with?("-shm") }
+            entries.filter_map do |entry|
+              st = ::File.stat(::File.join(dbpath, entry))
+              [ entry, st.size, st.mtime.tv_sec * 1_000_000_000 + st.mtime.tv_nsec ]
+            rescue SystemCallError
+              nil
+            end
+          rescue SystemCallError
+            nil
+          end
+
+          # a bare package name, which could not also be a glob, a version constraint or a name-version
+          def plain?(str)
+            str.is_a?(String) && str.match?(/\A[^\s*?\[\]<>=!]+\z/) && !str.match?(/-\d/)
+          end
+        end
+      end
+    end
+  end
+end
@@ -18,6 +18,8 @@
 require_relative "../../../mixin/which"
 require_relative "../../../mixin/shell_out"
 require_relative "version"
+require_relative "installed_index"
+require_relative "../python_interpreter_cache"
 require "singleton" unless defined?(Singleton)
 require "timeout" unless defined?(Timeout)
 
@@ -39,17 +41,29 @@ class Chef
 
           YUM_HELPER = ::File.expand_path(::File.join(::File.dirname(__FILE__), "yum_helper.py")).freeze
 
+          # the version of the helper protocol that we speak, see respond() in yum_helper.py
+          PROTOCOL_VERSION = 2
+
+          # the most bytes of requests that are written to the helper before reading back their answers.  the
+          # helper stops reading requests while it is blocked writing an answer that has not been read yet (the
+          # answer to snapshot_installed alone is larger than a pipe buffer), so the unanswered requests have to
+          # fit into the pipe buffer, which may be as small as one page, or both sides block on a full pipe.
+          PIPELINE_BYTES = 4096
+
           def yum_command
             @yum_command ||= begin
-              cmd = which("platform-python", "python", "python2", "python2.7", extra_path: "/usr/libexec") do |f|
-                shell_out("#{f} -c 'import yum'").exitstatus == 0
-              end
+              executables = where("platform-python", "python", "python2", "python2.7", extra_path: "/usr/libexec")
+              cmd = interpreter_cache.find(executables) { |f| shell_out("#{f} -c 'import yum'").exitstatus == 0 }
               raise Chef::Exceptions::Package, "cannot find yum libraries, you may need to use dnf_package" unless cmd
 
               "#{cmd} #{YUM_HELPER}"
             end
           end
 
+          def interpreter_cache
+            @interpreter_cache ||= PythonInterpreterCache.new("yum")
+          end
+
           def start
             @inpipe, inpipe_write = IO.pipe
             outpipe_read, @outpipe = IO.pipe
@@ -59,6 +73,7 @@ class Chef
           end
 
           def reap
+            @installed_index = @resolutions = @candidates = nil
             unless wait_thr.nil?
               Process.kill("INT", wait_thr.pid) rescue nil
               begin
@@ -82,20 +97,44 @@ class Chef
           end
 
           def close_rpmdb
+            @installed_index = @resolutions = @candidates = nil
             query("close_rpmdb", {})
           end
 
+          # Timings kept by the helper: the time spent in each phase of loading yum ("import", "yumbase", "rpmdb",
+          # "pkgSack") and the count and time of each action it has answered.
+          #
+          # @return [Hash] the "phases" and "queries" statistics of the helper
+          def stats
+            query("stats", {})
+          end
+
+          # Reads the name, version and arch of local rpm files from their headers in the helper, rather than by
+          # running "rpm -qp" for each of them.  The helper remembers each file until its size or mtime changes.
+          #
+          # @param paths [Array<String>] the paths of the rpm files
+          # @return [Array<Version>]
+          def read_rpm_headers(paths)
+            paths = paths.map { |path| ::File.expand_path(path) }
+            query("read_rpm_headers", { "paths" => paths }).each_with_index.map { |matches, i| parse_matches(paths[i], matches) }
+          end
+
           def compare_versions(version1, version2)
             query("versioncompare", { "versions" => [version1, version2] }).to_i
           end
 
           def install_only_packages(name)
-            query_output = query("installonlypkgs", { "package" => name })
-            if query_output == "False"
-              false
-            elsif query_output == "True"
-              true
-            end
+            installed_index.installonly?(name)
+          end
+
+          # Every installed package, fetched from the helper in one query and kept until the helper reloads the
+          # rpmdb (see close_rpmdb), or until anything else changes the rpmdb.
+          #
+          # @return [InstalledIndex]
+          def installed_index
+            # the helper's copy of the rpmdb is just as stale, so it has to reload it as well
+            close_rpmdb unless @installed_index.nil? || @installed_index.current?
+            @installed_index ||= InstalledIndex.new(query("snapshot_installed", {}))
           end
 
           def options_params(options)
@@ -211,18 +250,120 @@ class Chef
           # @return Array<Version>
           # NB: "options" here is the yum_package options hash and is deliberately not **opts
           def package_query(action, provides, version: nil, arch: nil, options: {})
+            if action == :whatinstalled && version.nil? && ( installed = installed_index.lookup(provides, arch) )
+              Chef::Log.trace "found #{installed} in the installed package index"
+              return installed
+            end
+
             parameters = combine_args(provides, version, arch)
-            repo_opts = options_params(options || {})
-            parameters.merge!(repo_opts)
-            # XXX: for now we close the rpmdb before and after every query with an enablerepo/disablerepo to clean the helpers internal state
-            close_rpmdb unless repo_opts.empty?
-            query_output = query(action, parameters)
-            version = parse_response(query_output.lines.last)
+            matches = repo_query(action, parameters, options)
+            version = parse_matches(parameters["provides"], matches)
             Chef::Log.trace "parsed #{version} from python helper"
-            close_rpmdb unless repo_opts.empty?
             version
           end
 
+          # Every package that package_query picks the best of, each with the id of the repo that it is from, so that
+          # several questions about the versions of a package can be answered from one answer of the helper.  The
+          # answers are kept until the rpmdb is closed.
+          #
+          # @param action [Symbol] :whatinstalled or :whatavailable
+          # @return [Array<Version>] newest first, empty if nothing matched
+          # NB: "options" here is the yum_package options hash and is deliberately not **opts
+          def package_query_all(action, provides, version: nil, arch: nil, options: {})
+            parameters = combine_args(provides, version, arch)
+            candidates[[action, parameters, options_params(options || {})]] ||=
+              repo_query(:"#{action}_all", parameters, options).map do |match|
+                Version.new(match["name"], match["version"], match["arch"], match["repo"])
+              end
+          end
+
+          # Resolves everything that the provider needs to know about a package with a single round-trip to the python
+          # helper: the available candidate, the installed package that matches the version, the currently installed
+          # package, and whether the package is installonly.
+          #
+          # @return [Hash] the :available, :installed and :current Versions and :installonly of the package
+          # NB: "options" here is the yum_package options hash and is deliberately not **opts
+          def resolve(provides, version: nil, arch: nil, options: {})
+            if ( result = resolutions[[provides, version, arch, options_params(options || {})]] )
+              Chef::Log.trace "found #{provides} in the prefetched resolutions"
+              return result
+            end
+
+            parameters, current_parameters = resolve_parameters(provides, version, arch)
+            result = parse_resolution(parameters, current_parameters, repo_query("resolve", parameters, options))
+            Chef::Log.trace "parsed #{result} from python helper"
+            result
+          end
+
+          # Resolves the packages of every yum_package resource of the run up front (see Package::Prefetcher), with
+          # all of the "resolve" requests sent to the helper in a single round-trip and the repo-scoped ones grouped by
+          # their set of enablerepo/disablerepo options.  resolve answers from these until the rpmdb is closed or
+          # clear_resolutions is called.
+          #
+          # @param packages [Array<Array(String, String, String, Array)>] the name, version, arch and options of each package
+          # @return [Integer] the number of packages that were resolved
+          def prefetch_resolutions(packages)
+            groups = packages.uniq.group_by { |_, _, _, options| options_params(options || {}) }.to_a
+            parameters = groups.map do |_, group|
+              group.map { |provides, version, arch, _| resolve_parameters(provides, version, arch) }
+            end
+            requests = groups.zip(parameters).flat_map do |(repo_opts, _), group_parameters|
+              resolves = group_parameters.map { |params, _| ["resolve", params.merge(repo_opts)] }
+              # the same cleanup of the helpers internal state as repo_query, but once for the whole group
+              repo_opts.empty? ? resolves : [["close_rpmdb", {}], *resolves, ["close_rpmdb", {}]]
+            end
+            answers = pipeline(requests)
+            @resolutions = {}
+            groups.zip(parameters).each do |(repo_opts, group), group_parameters|
+              answers.shift unless repo_opts.empty?
+              group.zip(group_parameters).each do |(provides, version, arch, _), (params, current_params)|
+                @resolutions[[provides, version, arch, repo_opts]] = parse_resolution(params, current_params, answers.shift)
+              end
+              answers.shift unless repo_opts.empty?
+            end
+            @resolutions.size
+          end
+
+          # Forgets the resolutions of prefetch_resolutions, they only last for one chef-client run.
+          def clear_resolutions
+            @resolutions = nil
+          end
+
+          # Sends requests to the python helper without waiting for the answer to one before sending the next,
+          # the answers are tagged with the id of their request and read back in bulk.
+          #
+          # @param requests [Array<Array(Symbol, Hash)>] the action and the parameters of each request
+          # @return [Array] the result of each request, in the same order as the requests
+          def pipeline(requests)
+            responses = with_helper do
+              ids = requests.map { @request_id = (@request_id || 0) + 1 }
+              answers = {}
+              unanswered = {}
+              requests.each_with_index do |(action, parameters), i|
+                json = build_query(action, parameters.merge("protocol" => PROTOCOL_VERSION, "id" => ids[i]))
+                # a request that does not fit on its own is sent once every earlier one has been answered
+                until unanswered.empty? || unanswered.values.sum + json.bytesize < PIPELINE_BYTES
+                  outpipe.flush
+                  read_answer(answers)
+                  unanswered.delete_if { |id, _| answers.key?(id) }
+                end
+                Chef::Log.trace "sending '#{json}' to python helper"
+                outpipe.puts json
+                unanswered[ids[i]] = json.bytesize + 1
+              end
+              outpipe.flush
+              read_answer(answers) while answers.size < requests.size
+              ids.map { |id| answers.fetch(id) }
+            end
+            responses.map do |response|
+              if response["error"]
+                raise Chef::Exceptions::Package, "yum_helper.py failed: #{response["error"]["type"]}: #{response["error"]["message"]}"
+              end
+
+              response["result"]
+            end
+          end
+
           def restart
             reap
             start
@@ -231,15 +372,51 @@ class Chef
           private
 
           def query(action, parameters)
-            with_helper do
-              json = build_query(action, parameters)
-              Chef::Log.trace "sending '#{json}' to python helper"
-              outpipe.puts json
-              outpipe.flush
-              output = inpipe.readline.chomp
-              Chef::Log.trace "got '#{output}' from python helper"
-              output
-            end
+            pipeline([[action, parameters]]).first
+          end
+
+          def read_answer(answers)
+            output = inpipe.readline.chomp
+            Chef::Log.trace "got '#{output}' from python helper"
+            answer = FFI_Yajl::Parser.parse(output)
+            answers[answer["id"]] = answer
+          end
+
+          def repo_query(action, parameters, options)
+            repo_opts = options_params(options || {})
+            parameters = parameters.merge(repo_opts)
+            # XXX: for now we close the rpmdb before and after every query with an enablerepo/disablerepo to clean the helpers internal state
+            requests = [[action, parameters]]
+            requests = [["close_rpmdb", {}], *requests, ["close_rpmdb", {}]] unless repo_opts.empty?
+            results = pipeline(requests)
+            repo_opts.empty? ? results.first : results[1]
+          end
+
+          def resolutions
+            @resolutions || {}
+          end
+
+          def candidates
+            @candidates ||= {}
+          end
+
+          # the "resolve" parameters of a package, with a separate "current" query when the version or arch would
+          # not also find the currently installed package
+          def resolve_parameters(provides, version, arch)
+            parameters = combine_args(provides, version, arch)
+            current_parameters = combine_args(provides, nil, arch)
+            parameters["current"] = current_parameters unless current_parameters == parameters
+            [parameters, current_parameters]
+          end
+
+          # the Versions of a "resolve" answer
+          def parse_resolution(parameters, current_parameters, answer)
+            {
+              available: parse_matches(parameters["provides"], answer["available"]),
+              installed: parse_matches(parameters["provides"], answer["installed"]),
+              current: parse_matches(current_parameters["provides"], answer["current"]),
+              installonly: answer["installonly"],
+            }
           end
 
           def build_query(action, parameters)
@@ -251,9 +428,11 @@ class Chef
             FFI_Yajl::Encoder.encode(hash)
           end
 
-          def parse_response(output)
-            array = output.split.map { |x| x == "nil" ? nil : x }
-            array.each_slice(3).map { |x| Version.new(*x) }.first
+          # the best match comes first, a query that matched nothing is answered with just the name that was asked for
+          def parse_matches(provides, matches)
+            return Version.new(provides.split.first, nil, nil) if matches.empty?
+
+            Version.new(matches.first["name"], matches.first["version"], matches.first["arch"])
           end
 
           def drain_fds
@@ -290,6 +469,9 @@ class Chef
               end
               retry
             else
+              # the python found on an earlier run may no longer be able to import yum
+              interpreter_cache.forget
+              @yum_command = nil
               raise e if output.empty?
 
               raise "yum-helper.py had stderr/stdout output:\n\n#{output}"
@@ -25,11 +25,14 @@ class Chef
           attr_accessor :name
           attr_accessor :version
           attr_accessor :arch
+          # the id of the repo that the package is from, only known for the answers of package_query_all
+          attr_accessor :repo
 
-          def initialize(name, version, arch)
+          def initialize(name, version, arch, repo = nil)
             @name    = name
             @version = version
             @arch    = arch
+            @repo    = repo
           end
 
           def to_s
@@ -77,8 +77,7 @@ class Chef
           # (because the bigger issue there is a buggy+broken python_helper -- so don't try to fix those
           # kinds of bugs here)
           def version_available?(name, version, arch = nil)
-            p = python_helper.package_query(:whatavailable, name, version: version, arch: arch)
-            !p.version.nil?
+            !python_helper.package_query_all(:whatavailable, name, version: version, arch: arch).empty?
           end
 
           # @api private
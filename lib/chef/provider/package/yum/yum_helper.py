@@ -7,12 +7,19 @@
 #
 
 import sys
+import time
+
+HELPER_STARTED = time.time()
+
 import yum
+import rpm
 import signal
 import os
 import fcntl
 import json
 import re
+import collections
+import contextlib
 from rpmUtils.miscutils import stringToVersion,compareEVR
 from rpmUtils.arch import getBaseArch, getArchList
 from yum.misc import string_to_prco_tuple
@@ -22,6 +29,41 @@ from yum.misc import string_to_prco_tuple
 if not hasattr(yum.packages.FakeRepository, 'compare_providers_priority'):
     yum.packages.FakeRepository.compare_providers_priority = 99
 
+# Timings returned by the "stats" action: the total time spent in each phase of loading yum and the
+# time spent answering each action.
+stats = {
+    'phases': { 'import': { 'count': 1, 'seconds': time.time() - HELPER_STARTED } },
+    'queries': {},
+}
+
+def record(table, name, seconds):
+    entry = table.setdefault(name, { 'count': 0, 'seconds': 0.0 })
+    entry['count'] += 1
+    entry['seconds'] += seconds
+
+@contextlib.contextmanager
+def timed(table, name):
+    started = time.time()
+    try:
+        yield
+    finally:
+        record(table, name, time.time() - started)
+
+def get_stats():
+    return {
+        'helper': 'yum',
+        'uptime': time.time() - HELPER_STARTED,
+        'phases': stats['phases'],
+        'queries': stats['queries'],
+    }
+
+# The answer to a whatinstalled/whatavailable query, evr and arch are None when nothing matched.
+Package = collections.namedtuple("Package", ["name", "evr", "arch"])
+
+# The NEVRAs of the local rpm files read by read_rpm_headers(), keyed on the path, size and mtime of each
+# file so that a file that is replaced is read again.
+rpm_headers = {}
+
 def versioncompare(versions):
     arch_list = getArchList()
     candidate_arch1 = versions[0].split(".")[-1]
@@ -41,18 +83,50 @@ def versioncompare(versions):
     (e1, v1, r1) = stringToVersion(final_version1)
     (e2, v2, r2) = stringToVersion(final_version2)
 
-    evr_comparison = compareEVR((e1, v1, r1), (e2, v2, r2))
-    outpipe.write("%(e)s\n" % { 'e': evr_comparison })
-    outpipe.flush()
+    return compareEVR((e1, v1, r1), (e2, v2, r2))
 
 def install_only_packages(base, name):
-    if name in base.conf.installonlypkgs:
-        outpipe.write('True\n')
-    else:
-        outpipe.write('False\n')
-    outpipe.flush()
+    return name in base.conf.installonlypkgs
 
-def query(base, command):
+def rpmdb_path(base):
+    return os.path.realpath(os.path.join(base.conf.installroot, rpm.expandMacro('%{_dbpath}').lstrip('/')))
+
+def snapshot_installed(base):
+    # every installed package in one answer, so that the provider can index them by name, along with the
+    # installonlypkgs so that it can answer the "installonlypkgs" action as well, and the path of the rpmdb
+    # so that it can tell when something else has changed the rpmdb
+    with timed(stats['phases'], 'rpmdb'):
+        pkgs = base.rpmdb.returnPackages()
+    packages = []
+    for pkg in pkgs:
+        evr = "%(e)s:%(v)s-%(r)s" % { 'e': pkg.epoch, 'v': pkg.version, 'r': pkg.release }
+        packages.append([pkg.name, evr, pkg.arch])
+    return { 'installonlypkgs': list(base.conf.installonlypkgs), 'packages': packages, 'rpmdb': { 'path': rpmdb_path(base) } }
+
+def read_rpm_header(ts, path):
+    st = os.stat(path)
+    key = (path, st.st_size, st.st_mtime)
+    if key not in rpm_headers:
+        for stale in [k for k in rpm_headers if k[0] == path]:
+            del rpm_headers[stale]
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            hdr = ts.hdrFromFdno(fd)
+        finally:
+            os.close(fd)
+        evr = "%s:%s-%s" % (hdr[rpm.RPMTAG_EPOCH] or 0, hdr[rpm.RPMTAG_VERSION], hdr[rpm.RPMTAG_RELEASE])
+        rpm_headers[key] = Package(hdr[rpm.RPMTAG_NAME], evr, hdr[rpm.RPMTAG_ARCH])
+    return rpm_headers[key]
+
+def read_rpm_headers(command):
+    # the NEVRA of each of the local rpm files, read from their headers in-process rather than by running
+    # "rpm -qp" for every file.  like "rpm -qp", a signature by an unknown key is not an error.
+    ts = rpm.TransactionSet()
+    ts.setVSFlags(rpm._RPMVSF_NOSIGNATURES)
+    with timed(stats['phases'], 'read_rpm_headers'):
+        return [read_rpm_header(ts, path) for path in command['paths']]
+
+def match(base, command):
     # Handle any repocontrols passed in with our options
 
     if 'repos' in command:
@@ -80,11 +154,14 @@ def query(base, command):
     else:
         desired_arch = getBaseArch()
 
+    # yum loads the rpmdb and the repository metadata the first time that they are used
     obj = None
     if command['action'] == "whatinstalled":
-        obj = base.rpmdb
+        with timed(stats['phases'], 'rpmdb'):
+            obj = base.rpmdb
     else:
-        obj = base.pkgSack
+        with timed(stats['phases'], 'pkgSack'):
+            obj = base.pkgSack
 
     # if we are given "name == 1.2.3" then we must use the getProvides() API.
     #   - this means that we ignore arch and version properties when given prco tuples as a package_name
@@ -107,19 +184,102 @@ def query(base, command):
         pats = [command['provides']]
         pkgs = obj.returnPackages(patterns=pats)
 
+        if not pkgs and not command['provides'].startswith('/'):
+            # an exact provide is answered by the primary metadata, searchProvides() may pull in the much
+            # larger filelists to also match file names
+            pkgs = list(obj.getProvides(command['provides']))
+
         if not pkgs:
-            # handles wildcards
+            # handles wildcards and paths
             pkgs = obj.searchProvides(command['provides'])
 
+    return pkgs
+
+def query(base, command):
+    pkgs = match(base, command)
     if not pkgs:
-        outpipe.write(command['provides'].split().pop(0)+' nil nil\n')
-        outpipe.flush()
+        return Package(command['provides'].split().pop(0), None, None)
+
+    # make sure we picked the package with the highest version
+    pkgs = base.bestPackagesFromList(pkgs,single_name=True)
+    pkg = pkgs.pop(0)
+    return Package(pkg.name, "%(e)s:%(v)s-%(r)s" % { 'e': pkg.epoch, 'v': pkg.version, 'r': pkg.release }, pkg.arch)
+
+def query_all(base, command):
+    # every package that a whatinstalled/whatavailable query picks the best of, with the repo that it is from,
+    # newest first, so that several questions about the versions of a package can be answered with one query
+    pkgs = match(base, dict(command, action=command['action'][:-len('_all')]))
+    pkgs = sorted(pkgs, key=lambda pkg: (pkg.name, pkg.arch, pkg.repoid))
+    # verCMP() orders by name and then by EVR, the stable sort keeps the order above among equal packages.
+    # functools.cmp_to_key is new in python 2.7, which centos 6 does not ship, and python 3 sorts take no cmp
+    if sys.version_info[0] < 3:
+        pkgs.sort(cmp=lambda a, b: a.verCMP(b), reverse=True)
     else:
-        # make sure we picked the package with the highest version
-        pkgs = base.bestPackagesFromList(pkgs,single_name=True)
-        pkg = pkgs.pop(0)
-        outpipe.write("%(n)s %(e)s:%(v)s-%(r)s %(a)s\n" % { 'n': pkg.name, 'e': pkg.epoch, 'v': pkg.version, 'r': pkg.release, 'a': pkg.arch })
-        outpipe.flush()
+        import functools
+        pkgs.sort(key=functools.cmp_to_key(lambda a, b: a.verCMP(b)), reverse=True)
+    return [
+        { 'name': pkg.name, 'version': "%(e)s:%(v)s-%(r)s" % { 'e': pkg.epoch, 'v': pkg.version, 'r': pkg.release }, 'arch': pkg.arch, 'repo': pkg.repoid }
+        for pkg in pkgs
+    ]
+
+def resolve(base, command):
+    # everything that the provider needs to know about one package in one round-trip: the available candidate, the
+    # installed package matching the version, the currently installed package (which the provider asks for with
+    # different "current" arguments when it asks for a version), and whether the package is installonly
+    available = query(base, dict(command, action='whatavailable'))
+    installed = query(base, dict(command, action='whatinstalled'))
+    if 'current' in command:
+        current_command = dict(command['current'], action='whatinstalled')
+        if 'repos' in command:
+            current_command['repos'] = command['repos']
+        current = query(base, current_command)
+    else:
+        current = installed
+    return {
+        'available': available,
+        'installed': installed,
+        'current': current,
+        'installonly': install_only_packages(base, available.name),
+    }
+
+def format_package(package):
+    return " ".join(["nil" if field is None else field for field in package])
+
+def matches(package):
+    if package.evr is None:
+        return []
+    return [{ 'name': package.name, 'version': package.evr, 'arch': package.arch }]
+
+# Protocol 1 answers every request with a bare line, "name e:v-r arch" for package queries.  Protocol 2
+# requests carry an "id" and are answered with a JSON object tagged with that id so that the ruby side can
+# pipeline them, package queries answer with a list of matches and failures with an "error" object.
+def encode(result):
+    # the packages anywhere in an answer become lists of matches, anything else is sent as it is
+    if isinstance(result, Package):
+        return matches(result)
+    if isinstance(result, list):
+        return [encode(item) for item in result]
+    if isinstance(result, dict):
+        return dict((key, encode(value)) for key, value in result.items())
+    return result
+
+def respond(command, result):
+    if command.get('protocol', 1) >= 2:
+        line = json.dumps({ 'id': command.get('id'), 'result': encode(result) })
+    elif isinstance(result, Package):
+        line = format_package(result)
+    elif result is None:
+        line = "nil nil nil"
+    elif isinstance(result, (list, dict)):
+        line = json.dumps(encode(result))
+    else:
+        line = str(result)
+    outpipe.write(line + "\n")
+    outpipe.flush()
+
+def respond_error(command, error):
+    outpipe.write(json.dumps({ 'id': command.get('id'), 'error': { 'type': type(error).__name__, 'message': str(error) } }) + "\n")
+    outpipe.flush()
 
 # the design of this helper is that it should try to be 'brittle' and fail hard and exit in order
 # to keep process tables clean.  additional error handling should probably be added to the retry loop
@@ -170,23 +330,44 @@ try:
             raise RuntimeError("bad json parse")
 
         if base is None:
-            base = yum.YumBase()
-
-        if command['action'] == "whatinstalled":
-            query(base, command)
-        elif command['action'] == "whatavailable":
-            query(base, command)
-        elif command['action'] == "versioncompare":
-            versioncompare(command['versions'])
-        elif command['action'] == "installonlypkgs":
-            install_only_packages(base, command['package'])
-        elif command['action'] == "close_rpmdb":
-            base.closeRpmDB()
-            base = None
-            outpipe.write('nil nil nil\n')
-            outpipe.flush()
-        else:
-            raise RuntimeError("bad command")
+            with timed(stats['phases'], 'yumbase'):
+                base = yum.YumBase()
+
+        started = time.time()
+        try:
+            if command['action'] == "whatinstalled":
+                result = query(base, command)
+            elif command['action'] == "whatavailable":
+                result = query(base, command)
+            elif command['action'] in ("whatinstalled_all", "whatavailable_all"):
+                result = query_all(base, command)
+            elif command['action'] == "versioncompare":
+                result = versioncompare(command['versions'])
+            elif command['action'] == "resolve":
+                result = resolve(base, command)
+            elif command['action'] == "snapshot_installed":
+                result = snapshot_installed(base)
+            elif command['action'] == "read_rpm_headers":
+                result = read_rpm_headers(command)
+            elif command['action'] == "installonlypkgs":
+                result = install_only_packages(base, command['package'])
+            elif command['action'] == "close_rpmdb":
+                base.closeRpmDB()
+                base = None
+                result = None
+            elif command['action'] == "stats":
+                result = get_stats()
+            else:
+                raise RuntimeError("bad command")
+        except Exception as e:
+            if command.get('protocol', 1) < 2:
+                raise
+            respond_error(command, e)
+            continue
+        finally:
+            record(stats['queries'], command['action'], time.time() - started)
+
+        respond(command, result)
 finally:
     if base is not None:
         base.closeRpmDB()
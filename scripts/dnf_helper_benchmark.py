@@ -0,0 +1,554 @@
+#!/usr/bin/env python3
+#
+# Copyright:: Copyright (c) 2009-2026 Progress Software Corporation and/or its subsidiaries or affiliates. All Rights Reserved.
+# License:: Apache License, Version 2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Offline benchmark of lib/chef/provider/package/dnf/dnf_helper.py.
+
+For every requested repository size this generates an installroot containing
+synthetic file:// repositories (multiple arches, epochs, lots of provides, an
+updates repo) and an rpmdb with a subset of the packages installed, and then
+drives the helper over its pipe protocol the same way Dnf::PythonHelper does,
+with the dnf4 and/or the dnf5 libraries.  It measures:
+
+- cold_start: spawning the helper with an empty cache directory and its first
+  versioncompare, whatinstalled and whatavailable answers, including the time
+  from spawning the helper to its first answer
+- interpreter_probe: the "python -c 'import ...'" that Dnf::PythonHelper runs
+  to find an interpreter when it has none cached
+- restart: the same again with the cache directory populated
+- parallel_cold_start: the cold start again with the solv caches rebuilt in a
+  pool of --parallel processes, along with the speedup that the helper reports
+  for the pool (only with --parallel, and best with --repos above 1)
+- queries: uncached answers from a warm helper for each query shape that
+  query_dnf5() handles (names, name.arch, n-v-r, globs, "foo >= 1.2", ...)
+- cached: the same queries answered from the helper's result cache
+
+The results are written out as JSON (to stdout, or --output) so that runs can
+be compared.  Nothing is fetched from the network.  Building the rpmdb needs
+rpmbuild and rpm, without them the installed set is left empty.
+
+Usage:
+
+    python3 scripts/dnf_helper_benchmark.py --sizes 1000,10000,50000 --output results.json
+    python3 scripts/dnf_helper_benchmark.py --sizes 50000 --repos 16 --parallel 4
+"""
+
+import argparse
+import datetime
+import gzip
+import hashlib
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+DNF_HELPER = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "..",
+    "lib",
+    "chef",
+    "provider",
+    "package",
+    "dnf",
+    "dnf_helper.py",
+)
+
+BACKEND_MODULES = {"dnf4": "dnf", "dnf5": "libdnf5"}
+
+REPO_PROVIDES = 6
+
+
+def package_name(i):
+    return "bench-pkg-{:05d}".format(i)
+
+
+def arches():
+    machine = platform.machine()
+    if machine == "x86_64":
+        return machine, ["i686"]
+    return machine, []
+
+
+def generate_packages(size):
+    """
+    Yield (repo, package) pairs until there are size packages in total.  Every
+    name has an old and a new version, every fifth name also has the new
+    version built for the multilib arch, every seventh name is noarch, every
+    eleventh name has an epoch on its new version, and every tenth name has an
+    even newer version in the updates repo.
+    """
+    basearch, multilib = arches()
+    count = 0
+    i = 0
+    while count < size:
+        name = package_name(i)
+        arch = "noarch" if i % 7 == 0 else basearch
+        epoch = "1" if i % 11 == 0 else "0"
+        builds = [
+            ("base", "0", "1.0", "1", arch),
+            ("base", epoch, "2.{}".format(i % 10), "1", arch),
+        ]
+        if i % 5 == 0 and arch != "noarch":
+            builds += [("base", epoch, "2.{}".format(i % 10), "1", a) for a in multilib]
+        if i % 10 == 0:
+            builds.append(("updates", epoch, "3.0", "1", arch))
+        for repo, e, v, r, a in builds:
+            if count == size:
+                return
+            yield repo, {"i": i, "name": name, "epoch": e, "version": v, "release": r, "arch": a}
+            count += 1
+        i += 1
+
+
+def package_xml(pkg):
+    i = pkg["i"]
+    nevra = "{name}-{version}-{release}.{arch}".format(**pkg)
+    provides = [
+        (pkg["name"], "EQ", pkg["epoch"], pkg["version"], pkg["release"]),
+        ("bench-cap-{:05d}".format(i), "EQ", "0", pkg["version"], None),
+        ("bench-virtual-{}".format(i % 50), None, None, None, None),
+    ]
+    provides += [
+        ("bench-feature({}-{})".format(i, n), None, None, None, None)
+        for n in range(REPO_PROVIDES - len(provides))
+    ]
+    entries = []
+    for name, flags, epoch, ver, rel in provides:
+        attrs = 'name="{}"'.format(name)
+        if flags:
+            attrs += ' flags="{}" epoch="{}" ver="{}"'.format(flags, epoch, ver)
+            if rel:
+                attrs += ' rel="{}"'.format(rel)
+        entries.append("      <rpm:entry {}/>".format(attrs))
+    checksum = hashlib.sha256(nevra.encode()).hexdigest()
+    return """<package type="rpm">
+  <name>{name}</name>
+  <arch>{arch}</arch>
+  <version epoch="{epoch}" ver="{version}" rel="{release}"/>
+  <checksum type="sha256" pkgid="YES">{checksum}</checksum>
+  <summary>synthetic benchmark package</summary>
+  <description>synthetic benchmark package</description>
+  <packager/>
+  <url/>
+  <time file="0" build="0"/>
+  <size package="0" installed="0" archive="0"/>
+  <location href="Packages/{nevra}.rpm"/>
+  <format>
+    <rpm:license>Apache-2.0</rpm:license>
+    <rpm:vendor/>
+    <rpm:group>Unspecified</rpm:group>
+    <rpm:buildhost>localhost</rpm:buildhost>
+    <rpm:sourcerpm>{name}-{version}-{release}.src.rpm</rpm:sourcerpm>
+    <rpm:header-range start="0" end="0"/>
+    <rpm:provides>
+{provides}
+    </rpm:provides>
+    <file>/usr/bin/bench-{i:05d}</file>
+  </format>
+</package>
+""".format(checksum=checksum, nevra=nevra, provides="\n".join(entries), **pkg)
+
+
+def filelists_xml(pkg):
+    checksum = hashlib.sha256("{name}-{version}-{release}.{arch}".format(**pkg).encode()).hexdigest()
+    return """<package pkgid="{checksum}" name="{name}" arch="{arch}">
+  <version epoch="{epoch}" ver="{version}" rel="{release}"/>
+  <file>/usr/bin/bench-{i:05d}</file>
+  <file>/usr/share/bench/{name}/README</file>
+</package>
+""".format(checksum=checksum, **pkg)
+
+
+def write_metadata(repodata, kind, header, footer, chunks):
+    raw = (header + "".join(chunks) + footer).encode()
+    compressed = gzip.compress(raw, mtime=0)
+    checksum = hashlib.sha256(compressed).hexdigest()
+    href = "repodata/{}-{}.xml.gz".format(checksum, kind)
+    with open(os.path.join(repodata, os.path.basename(href)), "wb") as f:
+        f.write(compressed)
+    return """  <data type="{kind}">
+    <checksum type="sha256">{checksum}</checksum>
+    <open-checksum type="sha256">{open_checksum}</open-checksum>
+    <location href="{href}"/>
+    <timestamp>{timestamp}</timestamp>
+    <size>{size}</size>
+    <open-size>{open_size}</open-size>
+  </data>
+""".format(
+        kind=kind,
+        checksum=checksum,
+        open_checksum=hashlib.sha256(raw).hexdigest(),
+        href=href,
+        timestamp=int(time.time()),
+        size=len(compressed),
+        open_size=len(raw),
+    )
+
+
+def write_repo(path, packages):
+    repodata = os.path.join(path, "repodata")
+    os.makedirs(repodata)
+    primary = write_metadata(
+        repodata,
+        "primary",
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<metadata xmlns="http://linux.duke.edu/metadata/common" '
+        'xmlns:rpm="http://linux.duke.edu/metadata/rpm" packages="{}">\n'.format(len(packages)),
+        "</metadata>\n",
+        [package_xml(pkg) for pkg in packages],
+    )
+    filelists = write_metadata(
+        repodata,
+        "filelists",
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<filelists xmlns="http://linux.duke.edu/metadata/filelists" packages="{}">\n'.format(len(packages)),
+        "</filelists>\n",
+        [filelists_xml(pkg) for pkg in packages],
+    )
+    with open(os.path.join(repodata, "repomd.xml"), "w") as f:
+        f.write(
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<repomd xmlns="http://linux.duke.edu/metadata/repo" '
+            'xmlns:rpm="http://linux.duke.edu/metadata/rpm">\n'
+            "  <revision>{}</revision>\n{}{}</repomd>\n".format(int(time.time()), primary, filelists)
+        )
+
+
+def build_rpmdb(root, installed, workdir):
+    """
+    Build empty subpackages for the installed packages with a single rpmbuild
+    run and register them in an rpmdb under the installroot with --justdb, so
+    that no root privileges are needed.
+    """
+    if not installed:
+        return 0
+    if shutil.which("rpmbuild") is None or shutil.which("rpm") is None:
+        sys.stderr.write("rpmbuild or rpm not found, the installed set will be empty\n")
+        return 0
+
+    topdir = os.path.join(workdir, "rpmbuild")
+    os.makedirs(os.path.join(topdir, "SPECS"))
+    spec = [
+        "Name: bench-installed",
+        "Version: 1.0",
+        "Release: 1",
+        "Summary: synthetic benchmark packages",
+        "License: Apache-2.0",
+        "%description",
+        "synthetic benchmark packages",
+    ]
+    for pkg in installed:
+        spec += [
+            "%package -n {}".format(pkg["name"]),
+            "Summary: synthetic benchmark package",
+            "Provides: bench-cap-{:05d} = 1.0".format(pkg["i"]),
+        ]
+        if pkg["arch"] == "noarch":
+            spec.append("BuildArch: noarch")
+        spec += [
+            "%description -n {}".format(pkg["name"]),
+            "synthetic benchmark package",
+            "%files -n {}".format(pkg["name"]),
+        ]
+    spec_file = os.path.join(topdir, "SPECS", "bench-installed.spec")
+    with open(spec_file, "w") as f:
+        f.write("\n".join(spec) + "\n")
+    subprocess.run(
+        ["rpmbuild", "-bb", "--quiet", "--define", "_topdir {}".format(topdir), spec_file],
+        check=True,
+        stdout=subprocess.DEVNULL,
+    )
+
+    rpms = []
+    for dirpath, _, files in os.walk(os.path.join(topdir, "RPMS")):
+        rpms += [os.path.join(dirpath, f) for f in files if f.endswith(".rpm")]
+    dbpath = subprocess.run(
+        ["rpm", "--eval", "%{_dbpath}"], check=True, stdout=subprocess.PIPE, universal_newlines=True
+    ).stdout.strip()
+    dbpath = os.path.join(root, dbpath.lstrip("/"))
+    os.makedirs(dbpath, exist_ok=True)
+    subprocess.run(["rpm", "--dbpath", dbpath, "--initdb"], check=True)
+    subprocess.run(
+        ["rpm", "--dbpath", dbpath, "-i", "--justdb", "--nodeps", "--noscripts", "--notriggers",
+         "--nosignature", "--nodigest", "--ignorearch"] + rpms,
+        check=True,
+    )
+    return len(rpms)
+
+
+def generate_root(workdir, size, installed_count, repo_count=1):
+    root = os.path.join(workdir, "root-{}".format(size))
+    repos = {"base": [], "updates": []}
+    for repo, pkg in generate_packages(size):
+        repos[repo].append(pkg)
+    # spread the base packages over repo_count repos, every build of a name in the same one
+    layout = {
+        "base" if n == 0 else "base-{}".format(n): [p for p in repos["base"] if p["i"] % repo_count == n]
+        for n in range(repo_count)
+    }
+    layout["updates"] = repos["updates"]
+
+    os.makedirs(os.path.join(root, "etc", "yum.repos.d"))
+    os.makedirs(os.path.join(root, "etc", "dnf", "vars"))
+    os.makedirs(os.path.join(root, "var", "cache", "dnf"))
+    with open(os.path.join(root, "etc", "dnf", "dnf.conf"), "w") as f:
+        f.write("[main]\ngpgcheck=0\nmetadata_expire=-1\n")
+    with open(os.path.join(root, "etc", "dnf", "vars", "releasever"), "w") as f:
+        f.write("bench\n")
+    with open(os.path.join(root, "etc", "yum.repos.d", "bench.repo"), "w") as f:
+        for repo, packages in layout.items():
+            path = os.path.join(workdir, "repos-{}".format(size), repo)
+            write_repo(path, packages)
+            f.write(
+                "[bench-{repo}]\nname=bench {repo}\nbaseurl=file://{path}\n"
+                "gpgcheck=0\nenabled=1\n\n".format(repo=repo, path=path)
+            )
+
+    # install the old version of the first installed_count names
+    installed = [p for p in repos["base"] if p["version"] == "1.0"][:installed_count]
+    count = build_rpmdb(root, installed, os.path.join(workdir, "build-{}".format(size)))
+    return root, count, max(p["i"] for p in repos["base"]) + 1, installed
+
+
+class Helper:
+    def __init__(self, python, root, backend, env=None):
+        env = dict(os.environ, **(env or {}))
+        env["CHEF_DNF_HELPER_INSTALLROOT"] = root
+        env["CHEF_DNF_HELPER_DNF_VERSION"] = backend[-1]
+        self.proc = subprocess.Popen(
+            [python, DNF_HELPER],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            env=env,
+            universal_newlines=True,
+        )
+        self.id = 0
+
+    def request(self, action, **parameters):
+        self.id += 1
+        parameters.update({"action": action, "protocol": 2, "id": self.id})
+        started = time.monotonic()
+        self.proc.stdin.write(json.dumps(parameters) + "\n")
+        self.proc.stdin.flush()
+        response = json.loads(self.proc.stdout.readline())
+        elapsed = time.monotonic() - started
+        if "error" in response:
+            raise RuntimeError("{}: {}".format(parameters, response["error"]))
+        return response["result"], elapsed
+
+    def close(self):
+        self.proc.stdin.close()
+        self.proc.wait()
+
+
+def query_shapes(i, basearch):
+    """
+    The query shapes from the query_dnf5() docstring, for the i-th name.
+    """
+    name = package_name(i)
+    arch = "noarch" if i % 7 == 0 else basearch
+    version = "2.{}".format(i % 10)
+    return {
+        "name": {"provides": name},
+        "name.arch": {"provides": "{}.{}".format(name, arch)},
+        "name-version": {"provides": "{}-{}".format(name, version)},
+        "name-version-release": {"provides": "{}-{}-1".format(name, version)},
+        "name-version-release.arch": {"provides": "{}-{}-1.{}".format(name, version, arch)},
+        "name glob": {"provides": "{}*".format(name[:-1])},
+        "version glob": {"provides": "{}-2.*".format(name)},
+        "version and arch properties": {"provides": name, "version": version, "arch": arch},
+        "reldep": {"provides": "{} >= 1.2".format(name)},
+        "virtual provides": {"provides": "bench-cap-{:05d}".format(i)},
+        "file provides": {"provides": "/usr/bin/bench-{:05d}".format(i)},
+    }
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    return {
+        "samples": len(samples),
+        "min": samples[0],
+        "median": statistics.median(samples),
+        "p95": samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+        "max": samples[-1],
+        "mean": statistics.mean(samples),
+    }
+
+
+def start_costs(python, root, backend, installed_name, available_name, env=None):
+    started = time.monotonic()
+    helper = Helper(python, root, backend, env)
+    try:
+        _, first = helper.request("versioncompare", versions=["1.0-1", "1.0-2"])
+        first_answer = time.monotonic() - started
+        _, installed = helper.request("whatinstalled", provides=installed_name)
+        _, available = helper.request("whatavailable", provides=available_name)
+        total = time.monotonic() - started
+        helper_stats, _ = helper.request("stats")
+    finally:
+        helper.close()
+    return {
+        "startup": first,
+        "spawn_to_first_answer": first_answer,
+        "first_whatinstalled": installed,
+        "first_whatavailable": available,
+        "total": total,
+        "parallel_loads": helper_stats.get("parallel_loads", []),
+    }
+
+
+def clear_cache(root):
+    cachedir = os.path.join(root, "var", "cache", "dnf")
+    shutil.rmtree(cachedir)
+    os.makedirs(cachedir)
+
+
+def probe_cost(python, backend, iterations):
+    samples = []
+    for _ in range(iterations):
+        started = time.monotonic()
+        backend_available(python, backend)
+        samples.append(time.monotonic() - started)
+    return summarize(samples)
+
+
+def run_benchmark(python, root, backend, names, installed, iterations, parallel=0):
+    basearch, _ = arches()
+    installed_name = installed[0]["name"] if installed else package_name(0)
+    result = {
+        "interpreter_probe": probe_cost(python, backend, min(iterations, 5)),
+        "cold_start": start_costs(python, root, backend, installed_name, package_name(1)),
+        "restart": start_costs(python, root, backend, installed_name, package_name(1)),
+    }
+    if parallel > 1:
+        clear_cache(root)
+        result["parallel_cold_start"] = start_costs(
+            python,
+            root,
+            backend,
+            installed_name,
+            package_name(1),
+            env={"CHEF_DNF_HELPER_PARALLEL_LOAD": str(parallel)},
+        )
+
+    helper = Helper(python, root, backend)
+    try:
+        # load both sacks before timing the individual queries
+        helper.request("whatinstalled", provides=installed_name)
+        helper.request("whatavailable", provides=package_name(0))
+
+        # spread the picks over the repo, and over the installed packages for whatinstalled
+        picks = {
+            "whatavailable": [n * names // iterations for n in range(iterations)],
+            "whatinstalled": [installed[n * len(installed) // iterations]["i"] for n in range(iterations)]
+            if installed
+            else [],
+        }
+        queries = {}
+        cached = {}
+        for shape in query_shapes(0, basearch):
+            for action in ("whatavailable", "whatinstalled"):
+                if not picks[action]:
+                    continue
+                uncached_samples = []
+                cached_samples = []
+                for i in picks[action]:
+                    parameters = query_shapes(i, basearch)[shape]
+                    _, elapsed = helper.request(action, **parameters)
+                    uncached_samples.append(elapsed)
+                    _, elapsed = helper.request(action, **parameters)
+                    cached_samples.append(elapsed)
+                key = "{} {}".format(action, shape)
+                queries[key] = summarize(uncached_samples)
+                cached[key] = summarize(cached_samples)
+        result["queries"] = queries
+        result["cached"] = cached
+        result["helper_stats"], _ = helper.request("stats")
+    finally:
+        helper.close()
+    return result
+
+
+def backend_available(python, backend):
+    return subprocess.run(
+        [python, "-c", "import {}".format(BACKEND_MODULES[backend])],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    ).returncode == 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of dnf_helper.py")
+    parser.add_argument("--sizes", default="1000,10000,50000", help="comma separated repository sizes")
+    parser.add_argument("--installed", type=int, default=300, help="number of installed packages")
+    parser.add_argument("--backends", default="dnf4,dnf5", help="comma separated backends to benchmark")
+    parser.add_argument("--python", default=sys.executable, help="python interpreter for the helper")
+    parser.add_argument("--repos", type=int, default=1, help="number of repos to spread the base packages over")
+    parser.add_argument("--parallel", type=int, default=0, help="also cold start with a pool of this many processes")
+    parser.add_argument("--iterations", type=int, default=20, help="samples per query shape")
+    parser.add_argument("--workdir", help="where to generate the repositories (default: a temporary directory)")
+    parser.add_argument("--output", help="write the JSON results here instead of to stdout")
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="dnf-helper-benchmark-")
+    results = {
+        "generated_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "host": {"machine": platform.machine(), "python": args.python, "helper": os.path.realpath(DNF_HELPER)},
+        "config": {
+            "installed": args.installed,
+            "iterations": args.iterations,
+            "repos": args.repos,
+            "parallel": args.parallel,
+        },
+        "results": [],
+    }
+    try:
+        for size in [int(s) for s in args.sizes.split(",")]:
+            sys.stderr.write("generating {} packages in {}\n".format(size, workdir))
+            root, installed_count, names, installed = generate_root(workdir, size, args.installed, args.repos)
+            for backend in args.backends.split(","):
+                entry = {"backend": backend, "size": size, "installed": installed_count}
+                if not backend_available(args.python, backend):
+                    entry["skipped"] = "{} cannot import {}".format(args.python, BACKEND_MODULES[backend])
+                else:
+                    sys.stderr.write("benchmarking {} with {} packages\n".format(backend, size))
+                    # every backend starts from an empty cache directory
+                    clear_cache(root)
+                    entry.update(
+                        run_benchmark(args.python, root, backend, names, installed, args.iterations, args.parallel)
+                    )
+                results["results"].append(entry)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
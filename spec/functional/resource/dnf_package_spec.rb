@@ -168,6 +168,196 @@ describe Chef::Resource::DnfPackage, :requires_root, external: exclude_test do
       end
     end
 
+    context "on-demand filelists" do
+      # the file is only listed in the filelists metadata, the primary metadata only lists the files in bin dirs and /etc
+      it "installs a package by the path of a file in it" do
+        flush_cache
+        dnf_package "/opt/chef_rpm/sample_file" do
+          options default_options
+          action :install
+        end.should_be_updated
+        expect_matching_installed_version("^chef_rpm-1.10-1.#{pkg_arch}$")
+        loads = Chef::Provider::Package::Dnf::PythonHelper.instance.stats["sack_loads"]
+        expect(loads).to include(a_hash_including("filelists" => true))
+      end
+
+      it "reloads the sack with the filelists when the primary metadata has no match" do
+        flush_cache
+        helper = Chef::Provider::Package::Dnf::PythonHelper.instance
+        expect(helper.package_query(:whatavailable, "no_such_package", options: default_options.split).version).to be_nil
+        expect(helper.stats["sack_loads"].last).to include("filelists" => true)
+      end
+    end
+
+    context "lazy metadata loading" do
+      it "does not load any repository metadata for an already installed package" do
+        preinstall("chef_rpm-1.10-1.#{pkg_arch}.rpm")
+        dnf_package "chef_rpm" do
+          options default_options
+          action :install
+        end.should_not_be_updated
+        expect(Chef::Provider::Package::Dnf::PythonHelper.instance.phase).to eql("installed")
+      end
+
+      it "loads the repository metadata once a candidate version is needed" do
+        preinstall("chef_rpm-1.10-1.#{pkg_arch}.rpm")
+        dnf_package "chef_rpm" do
+          options default_options
+          action :upgrade
+        end.should_not_be_updated
+        expect(Chef::Provider::Package::Dnf::PythonHelper.instance.phase).to eql("available")
+      end
+
+      it "reports the installed package that provides a name" do
+        preinstall("chef_rpm-1.10-1.#{pkg_arch}.rpm")
+        version = Chef::Provider::Package::Dnf::PythonHelper.instance.package_query(:whatinstalled, "chef_rpm_provides", options: default_options.split)
+        expect(version.name).to eql("chef_rpm")
+        expect(version.version).to eql("0:1.10-1")
+      end
+
+      it "is idempotent for a package installed by a name that it provides" do
+        preinstall("chef_rpm-1.10-1.#{pkg_arch}.rpm")
+        dnf_package "chef_rpm_provides" do
+          options default_options
+        end.should_not_be_updated
+      end
+
+      it "answers repeated queries from the helper's result cache" do
+        preinstall("chef_rpm-1.10-1.#{pkg_arch}.rpm")
+        2.times do
+          dnf_package "chef_rpm" do
+            options default_options
+            action :upgrade
+          end.should_not_be_updated
+        end
+        stats = Chef::Provider::Package::Dnf::PythonHelper.instance.cache_stats
+        expect(stats["hits"]).to be > 0
+        expect(stats["entries"]).to be > 0
+      end
+
+      it "indexes each sack once for all of the queries on it" do
+        skip "the sack index is only used with dnf5" unless dnf5?
+        preinstall("chef_rpm-1.10-1.#{pkg_arch}.rpm")
+        helper = Chef::Provider::Package::Dnf::PythonHelper.instance
+        dnf_package "chef_rpm" do
+          options default_options
+          action :upgrade
+        end.should_not_be_updated
+        indexed = helper.stats["phases"]["sack_index"]["count"]
+        dnf_package "chef_rpm.#{pkg_arch}" do
+          options default_options
+          action :upgrade
+        end.should_not_be_updated
+        expect(helper.stats["phases"]["sack_index"]["count"]).to eql(indexed)
+      end
+
+      it "keeps the repository metadata loaded across transactions" do
+        flush_cache
+        dnf_package "chef_rpm" do
+          options default_options
+          action :install
+        end.should_be_updated
+        helper = Chef::Provider::Package::Dnf::PythonHelper.instance
+        pid = helper.wait_thr.pid
+        expect(helper.phase).to eql("available")
+        dnf_package "chef_rpm" do
+          options default_options
+          action :remove
+        end.should_be_updated
+        expect(helper.wait_thr.pid).to eql(pid)
+        expect(helper.phase).to eql("available")
+      end
+
+      it "answers whatavailable_all with every available version of a package and its repo, newest first" do
+        flush_cache
+        helper = Chef::Provider::Package::Dnf::PythonHelper.instance
+        versions = helper.pipeline([[:whatavailable_all, { "provides" => "chef_rpm", "arch" => pkg_arch, "repos" => [{ "disable" => "*" }, { "enable" => "chef-dnf-localtesting" }] }]]).first
+        expect(versions.map { |v| v["version"] }).to eql(["0:1.10-1", "0:1.2-1"])
+        expect(versions.map { |v| v["repo"] }.uniq).to eql(["chef-dnf-localtesting"])
+      end
+    end
+
+    context "metadata policy" do
+      let(:helper) { Chef::Provider::Package::Dnf::PythonHelper.instance }
+
+      it "reports the age of the metadata of the local repo" do
+        flush_cache
+        ages = helper.metadata_age(options: default_options.split)
+        expect(ages.keys).to eql(["chef-dnf-localtesting"])
+        expect(ages["chef-dnf-localtesting"]).to be >= 0
+      end
+
+      it "installs from the cached metadata without expiring it" do
+        Chef::Config[:dnf_helper_metadata_policy] = "never_expire"
+        flush_cache
+        dnf_package "chef_rpm" do
+          options default_options
+          action :install
+        end.should_be_updated
+        expect(helper.stats["metadata_policy"]).to eql("never_expire")
+        expect(helper.stats["phases"]).not_to have_key("refresh_metadata")
+      end
+
+      it "only refreshes the metadata on flush_cache with the cache_only policy" do
+        Chef::Config[:dnf_helper_metadata_policy] = "cache_only"
+        flush_cache
+        dnf_package "chef_rpm" do
+          options default_options
+          flush_cache [ :before ]
+          action :install
+        end.should_be_updated
+        expect(helper.stats["metadata_policy"]).to eql("cache_only")
+        expect(helper.stats["phases"]["refresh_metadata"]["count"]).to eql(1)
+      end
+
+      it "installs packages in the helper with the cache_only policy" do
+        Chef::Config[:dnf_helper_metadata_policy] = "cache_only"
+        Chef::Config[:dnf_helper_transactions] = true
+        flush_cache
+        dnf_package "chef_rpm" do
+          options default_options
+          flush_cache [ :before ]
+          action :install
+        end.should_be_updated
+        expect_matching_installed_version("^chef_rpm-1.10-1.#{pkg_arch}$")
+        expect(helper.stats["queries"]).to have_key("install")
+      end
+
+      it "keeps the loaded metadata across the transactions of the helper" do
+        Chef::Config[:dnf_helper_transactions] = true
+        flush_cache
+        dnf_package "chef_rpm" do
+          options default_options
+          action :install
+        end.should_be_updated
+        dnf_package "chef_rpm" do
+          options default_options
+          action :remove
+        end.should_be_updated
+        expect(helper.stats["sack_loads"].count { |load| load["repos"] != "@System" }).to eql(1)
+        expect(helper.stats["phases"]["load_system_repo"]["count"]).to be >= 2
+      end
+
+      it "exports a snapshot of the metadata for the helper to stage into the cache" do
+        flush_cache
+        snapshot = ::File.join(Dir.mktmpdir, "snapshot")
+        expect(helper.export_snapshot(snapshot, options: default_options.split)).to eql(["chef-dnf-localtesting"])
+        expect(helper.import_snapshot(snapshot, options: default_options.split)).to eql(
+          { "imported" => [], "current" => ["chef-dnf-localtesting"], "skipped" => {} }
+        )
+        Chef::Config[:dnf_helper_snapshot] = snapshot
+        flush_cache
+        dnf_package "chef_rpm" do
+          options default_options
+          action :install
+        end.should_be_updated
+        expect(helper.stats["snapshot"]).to eql(snapshot)
+        expect(helper.stats["phases"]).to have_key("import_snapshot")
+      ensure
+        FileUtils.rm_rf(::File.dirname(snapshot)) if snapshot
+      end
+    end
+
     context "expanded idempotency checks with version variants" do
       %w{1.10 1* 1.10-1 1*-1 1.10-* 1*-* 0:1.10 0:1* 0:1.10-1 0:1*-1 *:1.10-* *:1*-*}.each do |vstring|
         it "installs the rpm when #{vstring} is in the package_name" do
@@ -1077,6 +1267,20 @@ describe Chef::Resource::DnfPackage, :requires_root, external: exclude_test do
           action :install
         end.should_not_be_updated
       end
+
+      it "does not restart the helper for repo-scoped queries" do
+        preinstall("chef_rpm-1.10-1.#{pkg_arch}.rpm")
+        dnf_package "chef_rpm" do
+          options "--nogpgcheck"
+          action :install
+        end.should_not_be_updated
+        pid = Chef::Provider::Package::Dnf::PythonHelper.instance.wait_thr.pid
+        dnf_package "chef_rpm" do
+          options "--nogpgcheck --disablerepo=* --enablerepo=chef-dnf-localtesting"
+          action :install
+        end.should_not_be_updated
+        expect(Chef::Provider::Package::Dnf::PythonHelper.instance.wait_thr.pid).to eql(pid)
+      end
     end
   end
 
@@ -94,6 +94,15 @@ describe Chef::Resource::YumPackage, :requires_root, external: exclude_test do
         expect_matching_installed_version("^chef_rpm-1.10-1.#{pkg_arch}$")
       end
 
+      it "installs a package by the path of a file that is only in the filelists" do
+        flush_cache
+        yum_package "/opt/chef_rpm/sample_file" do
+          options default_options
+          action :install
+        end.should_be_updated
+        expect_matching_installed_version("^chef_rpm-1.10-1.#{pkg_arch}$")
+      end
+
       it "does not install if the package is installed" do
         preinstall("chef_rpm-1.10-1.#{pkg_arch}.rpm")
         yum_package "chef_rpm" do
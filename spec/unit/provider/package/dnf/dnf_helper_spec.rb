@@ -0,0 +1,386 @@
+#
+# Copyright:: Copyright (c) 2009-2026 Progress Software Corporation and/or its subsidiaries or affiliates. All Rights Reserved.
+# License:: Apache License, Version 2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+require "spec_helper"
+require "open3"
+
+# These exercise the parts of dnf_helper.py that do not touch a sack directly in the python that the helper runs
+# in.  The helper only imports the dnf libraries when they are first used, but it still needs a python that has
+# them to start at all.
+dnf_helper_python = %w{/usr/libexec/platform-python /usr/bin/python3}.find do |python|
+  ::File.executable?(python) &&
+    system(python, "-c", "import importlib.util, sys; sys.exit(not (importlib.util.find_spec('libdnf5') or importlib.util.find_spec('dnf')))")
+end
+
+describe "dnf_helper.py", external: dnf_helper_python.nil? do
+  let(:python) { dnf_helper_python }
+  let(:helper_dir) { ::File.dirname(Chef::Provider::Package::Dnf::PythonHelper::DNF_HELPER) }
+
+  # stands in for loading and closing the bases, which needs real repos.  the bases remember whether they were
+  # loaded with the filelists.
+  let(:fake_bases) do
+    <<~PY
+      h.close_base = lambda base: None
+      loads = []
+      def load_base(key, filelists=False, refresh=False):
+          loads.append(filelists)
+          return {"filelists": filelists}
+      h.load_base_dnf5 = h.load_base_dnf4 = load_base
+      h.has_optional_metadata = lambda base: True
+      h.base_fingerprint = lambda base: ()
+      h.metadata_expires_at = lambda base: None
+    PY
+  end
+
+  # Runs the python code with the helper imported as "h" and returns whatever the code left in "result".
+  def run_helper(code, env = {})
+    script = <<~PY
+      import json, sys
+      sys.path.insert(0, #{helper_dir.to_json})
+      import dnf_helper as h
+      result = None
+      #{code}
+      sys.stdout.write("\\n" + json.dumps(result, default=list) + "\\n")
+    PY
+    stdout, stderr, status = Open3.capture3(env, python, "-", stdin_data: script)
+    raise "dnf_helper.py failed: #{stderr}" unless status.success?
+
+    JSON.parse(stdout.lines.last)
+  end
+
+  describe "repo_key" do
+    it "keeps the order of the repo options and collapses repeated ones" do
+      result = run_helper(<<~PY)
+        result = h.repo_key({"repos": [{"disable": "*"}, {"enable": "foo"}, {"disable": "*"}]})
+      PY
+      expect(result).to eql([%w{enable foo}, %w{disable *}])
+    end
+
+    it "is empty without repo options" do
+      expect(run_helper("result = h.repo_key({})")).to eql([])
+    end
+  end
+
+  describe "cache_key" do
+    it "keys whatavailable queries on the repo options" do
+      result = run_helper(<<~PY)
+        command = {"action": "whatavailable", "provides": "foo", "version": "1.2", "repos": [{"enable": "extras"}]}
+        result = h.cache_key(command)
+      PY
+      expect(result).to eql(["whatavailable", "foo", nil, "1.2", nil, nil, [%w{enable extras}]])
+    end
+
+    it "does not key whatinstalled queries on the repo options" do
+      result = run_helper(<<~PY)
+        with_repos = {"action": "whatinstalled", "provides": "foo", "repos": [{"enable": "extras"}]}
+        result = [h.cache_key(with_repos), h.cache_key({"action": "whatinstalled", "provides": "foo"})]
+      PY
+      expect(result.uniq.length).to eql(1)
+    end
+  end
+
+  describe "needs_filelists" do
+    it "is true for path provides" do
+      expect(run_helper('result = h.needs_filelists({"provides": "/usr/bin/foo"})')).to be true
+    end
+
+    it "is false for name provides" do
+      expect(run_helper('result = h.needs_filelists({"provides": "foo"})')).to be false
+    end
+  end
+
+  describe "filelists" do
+    it "loads the base with the filelists for a path" do
+      result = run_helper(fake_bases + <<~PY)
+        h.get_base({"action": "whatavailable", "provides": "/usr/bin/foo"})
+        h.get_base({"action": "whatavailable", "provides": "foo"})
+        result = loads
+      PY
+      expect(result).to eql([true])
+    end
+
+    it "reloads the base with the filelists once when the primary metadata has no match" do
+      result = run_helper(fake_bases + <<~PY)
+        # a package that can only be found in the filelists
+        h.query = lambda command, base_queries=None: "foo" if h.get_base(command)["filelists"] else None
+        h.to_package = lambda command, pkg: pkg
+        first = h.cached_query({"action": "whatavailable", "provides": "libfoo"})
+        second = h.cached_query({"action": "whatavailable", "provides": "libfoo"})
+        result = [first, second, loads]
+      PY
+      expect(result).to eql(["foo", "foo", [false, true]])
+    end
+
+    it "does not reload the base for whatinstalled queries or for bases that have the filelists" do
+      result = run_helper(fake_bases + <<~PY)
+        h.get_base({"action": "whatavailable", "provides": "/usr/bin/foo"})
+        result = [
+            h.load_filelists({"action": "whatinstalled", "provides": "foo"}),
+            h.load_filelists({"action": "whatavailable", "provides": "foo"}),
+        ]
+      PY
+      expect(result).to eql([false, false])
+    end
+  end
+
+  describe "results cache" do
+    let(:queries) do
+      <<~PY
+        a = {"action": "whatavailable", "provides": "foo", "repos": [{"enable": "a"}]}
+        installed = {"action": "whatinstalled", "provides": "foo"}
+      PY
+    end
+
+    it "drops the answers from a base that is evicted" do
+      result = run_helper(fake_bases + queries + <<~PY)
+        h.MAX_SACKS = 1
+        h.get_base(a)
+        h.results_cache[h.cache_key(a)] = "foo from a"
+        h.results_cache[h.cache_key(installed)] = "installed foo"
+        hit_before = h.cache_hit(h.cache_key(a))
+        h.get_base({"action": "whatavailable", "provides": "foo", "repos": [{"enable": "b"}]})
+        result = [hit_before, h.cache_key(a) in h.results_cache, h.cache_hit(h.cache_key(installed))]
+      PY
+      expect(result).to eql([true, false, true])
+    end
+
+    it "drops the answers from the available repos when the bases are released" do
+      result = run_helper(fake_bases + queries + <<~PY)
+        h.get_base(a)
+        h.results_cache[h.cache_key(a)] = "foo from a"
+        h.results_cache[h.cache_key(installed)] = "installed foo"
+        h.release_memory()
+        result = sorted(k[0] for k in h.results_cache)
+      PY
+      expect(result).to eql(["whatinstalled"])
+    end
+
+    it "does not use an answer whose base is no longer loaded" do
+      result = run_helper(<<~PY)
+        key = h.cache_key({"action": "whatavailable", "provides": "foo"})
+        h.results_cache[key] = "foo"
+        result = [h.cache_hit(key), len(h.results_cache)]
+      PY
+      expect(result).to eql([false, 0])
+    end
+  end
+
+  describe "refresh_installed" do
+    it "reloads the installed packages into the loaded bases and keeps their metadata" do
+      result = run_helper(fake_bases + <<~PY)
+        h.get_rpmdb_cookie = lambda: ("before",)
+        for repo in ("a", "broken"):
+            h.get_base({"action": "whatavailable", "provides": "foo", "repos": [{"enable": repo}]})
+        reloads = []
+        def reload_system_repo(base):
+            reloads.append(base)
+            if len(reloads) == 2:
+                raise RuntimeError("no rpmdb")
+        h.reload_system_repo = reload_system_repo
+        h.results_cache[h.cache_key({"action": "whatinstalled", "provides": "foo"})] = "installed foo"
+        h.get_rpmdb_cookie = lambda: ("after",)
+        h.refresh_installed()
+        result = [len(reloads), list(h.bases), dict((k[0][1], v) for k, v in h.base_rpmdb.items()), len(h.results_cache), loads]
+      PY
+      expect(result).to eql([2, [[%w{enable a}]], { "a" => ["after"] }, 0, [false, false]])
+    end
+  end
+
+  describe "respond" do
+    let(:responses) do
+      <<~PY
+        import io
+        h.outpipe = io.StringIO()
+        foo = h.Package("foo", "0:1.2-3", "x86_64")
+      PY
+    end
+
+    it "answers protocol 1 package queries with bare name, version and arch triples" do
+      result = run_helper(responses + <<~PY)
+        h.respond({"action": "whatavailable"}, foo)
+        h.respond({"action": "whatavailable"}, h.Package("bar", None, None))
+        h.respond({"action": "batch"}, [foo, foo])
+        result = h.outpipe.getvalue().splitlines()
+      PY
+      expect(result).to eql(["foo 0:1.2-3 x86_64", "bar nil nil", "foo 0:1.2-3 x86_64 foo 0:1.2-3 x86_64"])
+    end
+
+    it "answers protocol 1 requests for lists of anything but packages with JSON" do
+      result = run_helper(responses + <<~PY)
+        h.respond({"action": "versionlock_list"}, ["foo-0:1.2-3.*"])
+        h.respond({"action": "whatavailable_all"}, [{"name": "foo", "version": "0:1.2-3", "arch": "x86_64", "repo": "base"}])
+        result = h.outpipe.getvalue().splitlines()
+      PY
+      expect(result.map { |line| JSON.parse(line) }).to eql([
+        ["foo-0:1.2-3.*"],
+        [{ "name" => "foo", "version" => "0:1.2-3", "arch" => "x86_64", "repo" => "base" }],
+      ])
+    end
+
+    it "answers protocol 2 requests with the result tagged with the id of the request" do
+      result = run_helper(responses + <<~PY)
+        h.respond({"action": "whatavailable", "protocol": 2, "id": 7}, foo)
+        result = h.outpipe.getvalue()
+      PY
+      expect(JSON.parse(result)).to eql({ "id" => 7, "result" => [{ "name" => "foo", "version" => "0:1.2-3", "arch" => "x86_64" }] })
+    end
+  end
+
+  describe "transaction_dnf4" do
+    it "downloads the packages that it installs under the cache_only policy" do
+      result = run_helper(<<~PY)
+        class Conf:
+            cacheonly = True
+        class Transaction:
+            install_set = ["foo-1.2-3.x86_64"]
+            remove_set = []
+        class Base:
+            conf = Conf()
+            transaction = Transaction()
+            downloaded_cacheonly = None
+            def install(self, spec): pass
+            def resolve(self, allow_erasing=False): pass
+            def download_packages(self, pkgs):
+                self.downloaded_cacheonly = self.conf.cacheonly
+            def do_transaction(self): pass
+            def reset(self, goal=False): pass
+        h.check_signatures_dnf4 = lambda base, pkgs: None
+        base = Base()
+        answer = h.transaction_dnf4(base, {"action": "install", "packages": ["foo"]})
+        result = [answer, base.downloaded_cacheonly, base.conf.cacheonly]
+      PY
+      expect(result).to eql([{ "installed" => ["foo-1.2-3.x86_64"], "removed" => [] }, false, true])
+    end
+  end
+
+  describe "memory" do
+    let(:three_bases) do
+      <<~PY
+        for repo in ("a", "b", "c"):
+            h.get_base({"action": "whatavailable", "provides": "foo", "repos": [{"enable": repo}]})
+        h.MEMORY_BUDGET = 150
+      PY
+    end
+
+    it "drops the least recently used bases until the rss is within the budget" do
+      result = run_helper(fake_bases + three_bases + <<~PY)
+        rss = [300, 200, 100]
+        h.get_rss = lambda: rss.pop(0)
+        h.enforce_memory_budget()
+        result = [[k[0][1] for k in h.bases], h.stats["memory"]["evictions"]]
+      PY
+      expect(result).to eql([["c"], 2])
+    end
+
+    it "keeps the base in use however large the rss is" do
+      result = run_helper(fake_bases + three_bases + <<~PY)
+        h.get_rss = lambda: 1000
+        h.enforce_memory_budget()
+        result = [[k[0][1] for k in h.bases], h.stats["memory"]["evictions"]]
+      PY
+      expect(result).to eql([["c"], 2])
+    end
+
+    it "releases the bases and their cached answers once the helper has been idle" do
+      result = run_helper(fake_bases + <<~PY)
+        import time
+        command = {"action": "whatavailable", "provides": "foo"}
+        h.get_base(command)
+        h.results_cache[h.cache_key(command)] = "foo"
+        h.IDLE_TIMEOUT = 0.1
+        h.last_command = time.monotonic()
+        h.start_watchdog()
+        deadline = time.monotonic() + 10
+        while h.stats["memory"]["releases"] == 0 and time.monotonic() < deadline:
+            time.sleep(0.1)
+        with h.lock:
+            result = [len(h.bases), h.stats["memory"]["releases"], h.cache_hit(h.cache_key(command))]
+      PY
+      expect(result).to eql([0, 1, false])
+    end
+  end
+
+  describe "rebuild_solv_caches" do
+    it "rebuilds the stale solv caches in a pool of processes" do
+      result = run_helper(<<~'PY')
+        import __main__, os, shutil, sys, tempfile
+        # the spawned workers would otherwise try to run this script from "<stdin>" again
+        del __main__.__file__
+        # the workers have to be able to import the stand-in for loading a repo
+        scratch = tempfile.mkdtemp()
+        with open(os.path.join(scratch, "fake_solv.py"), "w") as f:
+            f.write(
+                "import os\n"
+                "def build_solv_cache(key, repo_id, filelists):\n"
+                "    if repo_id == 'broken':\n"
+                "        raise RuntimeError('no metadata')\n"
+                "    with open(os.path.join(os.environ['SOLV_MARKERS'], repo_id), 'w') as f:\n"
+                "        f.write(str(os.getpid()))\n"
+                "    return 1.0\n"
+            )
+        sys.path.insert(0, scratch)
+        os.environ["SOLV_MARKERS"] = scratch
+        import fake_solv
+        h.build_solv_cache = fake_solv.build_solv_cache
+        h.stale_repos = lambda base: ["a", "b", "broken"]
+        h.PARALLEL_LOAD = 2
+        h.rebuild_solv_caches(None, (), False)
+        pids = set()
+        for repo in ("a", "b"):
+            with open(os.path.join(scratch, repo)) as f:
+                pids.add(int(f.read()))
+        load = h.stats["parallel_loads"][-1]
+        result = [load["repos"], load["workers"], load["serial_seconds"], os.getpid() in pids]
+        shutil.rmtree(scratch)
+      PY
+      expect(result).to eql([%w{a b broken}, 2, 2.0, false])
+    end
+
+    it "leaves the caches to the load of the base without CHEF_DNF_HELPER_PARALLEL_LOAD or with one stale repo" do
+      result = run_helper(<<~PY)
+        h.stale_repos = lambda base: ["a", "b"]
+        h.rebuild_solv_caches(None, (), False)
+        h.PARALLEL_LOAD = 4
+        h.stale_repos = lambda base: ["a"]
+        h.rebuild_solv_caches(None, (), False)
+        result = h.stats["parallel_loads"]
+      PY
+      expect(result).to eql([])
+    end
+  end
+
+  describe "base_fingerprint" do
+    it "changes when the repomd.xml of a local file:// repo changes" do
+      result = run_helper(<<~PY)
+        import os, shutil, tempfile
+        repo = tempfile.mkdtemp()
+        os.mkdir(os.path.join(repo, "repodata"))
+        repomd = os.path.join(repo, "repodata", "repomd.xml")
+        h.config_paths = lambda base: []
+        h.enabled_repos = lambda base: [h.Repo("local", os.path.join(repo, "cache"), -1, ["file://" + repo])]
+        with open(repomd, "w") as f:
+            f.write("<repomd>1</repomd>")
+        before = h.base_fingerprint(None)
+        with open(repomd, "w") as f:
+            f.write("<repomd>2</repomd>")
+        result = before != h.base_fingerprint(None)
+        shutil.rmtree(repo)
+      PY
+      expect(result).to be true
+    end
+  end
+end
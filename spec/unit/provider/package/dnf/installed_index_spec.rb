@@ -0,0 +1,77 @@
+#
+# Copyright:: Copyright (c) 2009-2026 Progress Software Corporation and/or its subsidiaries or affiliates. All Rights Reserved.
+# License:: Apache License, Version 2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+require "spec_helper"
+
+describe Chef::Provider::Package::Dnf::InstalledIndex do
+  let(:packages) do
+    [
+      ["kernel", "0:5.14.0-9", "x86_64", true],
+      ["kernel", "0:5.14.0-10", "x86_64", true],
+      ["glibc", "0:2.34-1", "x86_64", false],
+      ["glibc", "0:2.34-1", "i686", false],
+      ["zlib", "0:1.2.11-3", "i686", false],
+      ["python3.11", "0:3.11.2-1", "x86_64", false],
+    ]
+  end
+
+  let(:rpmdb) { Dir.mktmpdir }
+  let(:index) do
+    described_class.new("arch" => "x86_64", "installonlypkgs" => %w{kernel}, "packages" => packages, "rpmdb" => { "path" => rpmdb, "cookie" => [] })
+  end
+
+  after { FileUtils.rm_rf(rpmdb) }
+
+  def version(name, version, arch)
+    Chef::Provider::Package::Dnf::Version.new(name, version, arch)
+  end
+
+  it "finds the latest installed version of a package" do
+    expect(index.lookup("kernel")).to eql(version("kernel", "0:5.14.0-10", "x86_64"))
+  end
+
+  it "prefers the native arch like the python helper" do
+    expect(index.lookup("glibc")).to eql(version("glibc", "0:2.34-1", "x86_64"))
+    expect(index.lookup("zlib")).to eql(version("zlib", "0:1.2.11-3", "i686"))
+  end
+
+  it "finds a package by name and arch" do
+    expect(index.lookup("glibc", "i686")).to eql(version("glibc", "0:2.34-1", "i686"))
+    expect(index.lookup("glibc.i686")).to eql(version("glibc", "0:2.34-1", "i686"))
+    expect(index.lookup("python3.11")).to eql(version("python3.11", "0:3.11.2-1", "x86_64"))
+  end
+
+  it "leaves anything but an installed package name to the python helper" do
+    expect(index.lookup("httpd")).to be_nil
+    expect(index.lookup("zlib", "x86_64")).to be_nil
+    expect(index.lookup("kernel.ppc64le")).to be_nil
+    expect(index.lookup("kernel-5.14.0")).to be_nil
+    expect(index.lookup("kern*")).to be_nil
+    expect(index.lookup("kernel >= 5")).to be_nil
+  end
+
+  it "knows which packages are installonly" do
+    expect(index.installonly?("kernel")).to be true
+    expect(index.installonly?("glibc")).to be false
+  end
+
+  it "goes stale when the rpmdb changes" do
+    expect(index.current?).to be true
+    File.write(File.join(rpmdb, "rpmdb.sqlite"), "")
+    expect(index.current?).to be false
+  end
+end
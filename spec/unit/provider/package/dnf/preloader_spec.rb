@@ -0,0 +1,59 @@
+#
+# Copyright:: Copyright (c) 2009-2026 Progress Software Corporation and/or its subsidiaries or affiliates. All Rights Reserved.
+# License:: Apache License, Version 2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+require "spec_helper"
+
+describe Chef::Provider::Package::Dnf::Preloader do
+  let(:preloader) { Chef::Provider::Package::Dnf::Preloader.new }
+  let(:node) { Chef::Node.new }
+  let(:events) { Chef::EventDispatch::Dispatcher.new }
+  let(:run_context) { Chef::RunContext.new(node, {}, events) }
+  let(:python_helper) { double("PythonHelper") }
+  let(:resolver) { double("ProviderResolver") }
+
+  before do
+    allow(Chef::Provider::Package::Dnf::PythonHelper).to receive(:instance).and_return(python_helper)
+    allow(Chef::ProviderResolver).to receive(:new).and_return(resolver)
+    allow(resolver).to receive(:resolve).and_return(Chef::Provider::Package::Dnf)
+  end
+
+  it "does nothing unless dnf_helper_preload is set" do
+    Chef::Config[:dnf_helper_preload] = false
+    expect(python_helper).not_to receive(:preload)
+    preloader.cookbook_compilation_start(run_context)
+  end
+
+  context "with dnf_helper_preload set" do
+    before { Chef::Config[:dnf_helper_preload] = true }
+
+    it "preloads the helper when packages are installed with dnf" do
+      expect(python_helper).to receive(:preload)
+      preloader.cookbook_compilation_start(run_context)
+    end
+
+    it "does not preload the helper when packages are installed with another provider" do
+      allow(resolver).to receive(:resolve).and_return(Chef::Provider::Package::Yum)
+      expect(python_helper).not_to receive(:preload)
+      preloader.cookbook_compilation_start(run_context)
+    end
+
+    it "does not fail the run if the helper cannot be started" do
+      expect(python_helper).to receive(:preload).and_raise(Chef::Exceptions::Package, "cannot find dnf libraries")
+      expect { preloader.cookbook_compilation_start(run_context) }.not_to raise_error
+    end
+  end
+end
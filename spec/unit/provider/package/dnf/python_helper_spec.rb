@@ -17,6 +17,14 @@
 
 require "spec_helper"
 
+shared_context "a new dnf python helper" do
+  # the helper is a singleton, every example gets a new one
+  let(:helper) do
+    Singleton.__init__(Chef::Provider::Package::Dnf::PythonHelper)
+    Chef::Provider::Package::Dnf::PythonHelper.instance
+  end
+end
+
 # NOTE: most of the tests of this functionality are baked into the func tests for the dnf package provider
 
 # run this test only for following platforms.
@@ -33,13 +41,20 @@ describe Chef::Provider::Package::Dnf::PythonHelper, :requires_root, external: e
   it "compares EVRAs with dots in the release correctly" do
     expect(helper.compare_versions("0:1.8.29-6.el8.x86_64", "0:1.8.29-6.el8_3.1.x86_64")).to eql(-1)
   end
+
+  it "compares versions the same as rpm and the in-process VersionCompare port" do
+    File.readlines(File.join(CHEF_SPEC_DATA, "dnf", "version_compare_corpus.txt")).each do |line|
+      next if line.start_with?("#") || line.strip.empty?
+
+      version1, version2, expected = line.split
+      expect(helper.compare_versions(version1, version2)).to eql(expected.to_i), "the helper's #{version1} <=> #{version2} should be #{expected}"
+      expect(Chef::Provider::Package::Dnf::VersionCompare.compare(version1, version2)).to eql(expected.to_i), "VersionCompare's #{version1} <=> #{version2} should be #{expected}"
+    end
+  end
 end
 
 describe Chef::Provider::Package::Dnf::PythonHelper, "#dnf_command" do
-  let(:helper) do
-    Singleton.__init__(Chef::Provider::Package::Dnf::PythonHelper)
-    Chef::Provider::Package::Dnf::PythonHelper.instance
-  end
+  include_context "a new dnf python helper"
 
   let(:dnf_helper_path) do
     Chef::Provider::Package::Dnf::PythonHelper::DNF_HELPER
@@ -51,6 +66,12 @@ describe Chef::Provider::Package::Dnf::PythonHelper, "#dnf_command" do
     "try:\n    import libdnf5\nexcept ImportError:\n    import dnf"
   }
 
+  before do
+    # nothing is remembered from an earlier probe
+    allow(Chef::FileCache).to receive(:load).and_raise(Chef::Exceptions::FileNotFound)
+    allow(Chef::FileCache).to receive(:store)
+  end
+
   it "stops shell_out calls after finding the first working python" do
     allow(helper).to receive(:where).and_return(
       ["/usr/bin/python3", "/usr/bin/python2", "/usr/bin/python2.7"]
@@ -106,3 +127,370 @@ describe Chef::Provider::Package::Dnf::PythonHelper, "#dnf_command" do
     )
   end
 end
+
+describe Chef::Provider::Package::Dnf::PythonHelper, "#package_query_batch" do
+  include_context "a new dnf python helper"
+
+  it "sends every package in one batch request and parses one version per package" do
+    expect(helper).to receive(:query).with(:batch, {
+      "queries" => [
+        { "action" => :whatavailable, "provides" => "foo", "version" => "1.2", "arch" => "x86_64" },
+        { "action" => :whatavailable, "provides" => "bar" },
+      ],
+    }).once.and_return([[{ "name" => "foo", "version" => "0:1.2-3", "arch" => "x86_64" }], []])
+
+    versions = helper.package_query_batch(:whatavailable, %w{foo bar}, versions: ["1.2", nil], arches: ["x86_64", nil])
+    expect(versions).to eql([
+      Chef::Provider::Package::Dnf::Version.new("foo", "0:1.2-3", "x86_64"),
+      Chef::Provider::Package::Dnf::Version.new("bar", nil, nil),
+    ])
+  end
+
+  it "splits epochs and releases out of the versions of the sub-queries" do
+    expect(helper).to receive(:query).with(:batch, {
+      "queries" => [
+        { "action" => :whatinstalled, "provides" => "foo", "epoch" => "1", "version" => "1.2", "release" => "3" },
+      ],
+    }).and_return([[{ "name" => "foo", "version" => "1:1.2-3", "arch" => "x86_64" }]])
+
+    helper.package_query_batch(:whatinstalled, %w{foo}, versions: ["1:1.2-3"])
+  end
+end
+
+describe Chef::Provider::Package::Dnf::PythonHelper, "#resolve_batch" do
+  include_context "a new dnf python helper"
+
+  it "resolves the available, installed and current versions of every package in one request" do
+    expect(helper).to receive(:query).with(:batch, {
+      "queries" => [
+        { "action" => :resolve, "provides" => "foo", "version" => "1.2" },
+        { "action" => :resolve, "provides" => "kernel" },
+      ],
+    }).once.and_return([
+      {
+        "available" => [{ "name" => "foo", "version" => "0:1.2-3", "arch" => "x86_64" }],
+        "installed" => [],
+        "current" => [{ "name" => "foo", "version" => "0:1.1-1", "arch" => "x86_64" }],
+        "installonly" => false,
+      },
+      {
+        "available" => [{ "name" => "kernel", "version" => "0:6.1-2", "arch" => "x86_64" }],
+        "installed" => [{ "name" => "kernel", "version" => "0:6.1-1", "arch" => "x86_64" }],
+        "current" => [{ "name" => "kernel", "version" => "0:6.1-1", "arch" => "x86_64" }],
+        "installonly" => true,
+      },
+    ])
+
+    resolutions = helper.resolve_batch(%w{foo kernel}, versions: ["1.2", nil])
+    expect(resolutions[0]).to eql({
+      available: Chef::Provider::Package::Dnf::Version.new("foo", "0:1.2-3", "x86_64"),
+      installed: Chef::Provider::Package::Dnf::Version.new("foo", nil, nil),
+      current: Chef::Provider::Package::Dnf::Version.new("foo", "0:1.1-1", "x86_64"),
+      installonly: false,
+    })
+    expect(resolutions[1][:installonly]).to be true
+  end
+end
+
+describe Chef::Provider::Package::Dnf::PythonHelper, "#pipeline" do
+  include_context "a new dnf python helper"
+
+  let(:outpipe) { StringIO.new }
+
+  def answers(*answers)
+    StringIO.new(answers.map { |a| FFI_Yajl::Encoder.encode(a) + "\n" }.join)
+  end
+
+  before do
+    allow(helper).to receive(:check)
+    helper.outpipe = outpipe
+  end
+
+  it "sends every request tagged with an id and matches the answers back up by id" do
+    helper.inpipe = answers({ "id" => 2, "result" => 1 }, { "id" => 1, "result" => -1 })
+    results = helper.pipeline([
+      ["versioncompare", { "versions" => %w{1.0 2.0} }],
+      ["versioncompare", { "versions" => %w{2.0 1.0} }],
+    ])
+    expect(results).to eql([-1, 1])
+    requests = outpipe.string.lines.map { |l| FFI_Yajl::Parser.parse(l) }
+    expect(requests.map { |r| r["id"] }).to eql([1, 2])
+    expect(requests.map { |r| r["protocol"] }).to eql([2, 2])
+  end
+
+  it "reads back answers before the unanswered requests could fill the pipe" do
+    helper.inpipe = answers({ "id" => 1, "result" => [] }, { "id" => 2, "result" => [] })
+    sent = []
+    allow(helper).to receive(:read_answer).and_wrap_original do |m, answers|
+      sent << outpipe.string.lines.length
+      m.call(answers)
+    end
+    paths = ["/tmp/" + "x" * (Chef::Provider::Package::Dnf::PythonHelper::PIPELINE_BYTES * 3 / 4)]
+    helper.pipeline([["read_rpm_headers", { "paths" => paths }], ["read_rpm_headers", { "paths" => paths }]])
+    expect(sent).to eql([1, 2])
+  end
+
+  it "raises the error reported by the helper" do
+    helper.inpipe = answers({ "id" => 1, "error" => { "type" => "RuntimeError", "message" => "bad command" } })
+    expect { helper.pipeline([["bogus", {}]]) }.to raise_error(Chef::Exceptions::Package, /RuntimeError: bad command/)
+  end
+
+  it "answers a package query that matched nothing with just the name" do
+    helper.inpipe = answers({ "id" => 1, "result" => [] })
+    expect(helper.package_query(:whatavailable, "foo")).to eql(Chef::Provider::Package::Dnf::Version.new("foo", nil, nil))
+  end
+end
+
+describe Chef::Provider::Package::Dnf::PythonHelper, "#prefetch_resolutions" do
+  include_context "a new dnf python helper"
+
+  let(:snapshot) { { "arch" => "x86_64", "packages" => [], "rpmdb" => { "path" => "/var/lib/rpm", "cookie" => [] } } }
+  let(:foo) { { "available" => [{ "name" => "foo", "version" => "0:1.2-3", "arch" => "x86_64" }], "installed" => [], "current" => [], "installonly" => false } }
+  let(:bar) { { "available" => [{ "name" => "bar", "version" => "0:2.0-1", "arch" => "noarch" }], "installed" => [], "current" => [], "installonly" => false } }
+
+  before do
+    allow_any_instance_of(Chef::Provider::Package::Dnf::InstalledIndex).to receive(:current?).and_return(true)
+    expect(helper).to receive(:query).with("snapshot_installed", {}).and_return(snapshot)
+    expect(helper).to receive(:pipeline).once.with([
+      [:batch, { "queries" => [{ "action" => :resolve, "provides" => "foo" }] }],
+      [:batch, { "queries" => [{ "action" => :resolve, "provides" => "bar" }], "repos" => [{ "enable" => "extras" }] }],
+    ]).and_return([[foo], [bar]])
+    expect(helper.prefetch_resolutions([["foo", nil, nil, []], ["bar", nil, nil, ["--enablerepo=extras"]]])).to eql(2)
+  end
+
+  it "resolves every package with one batch per set of repos" do
+    expect(helper).not_to receive(:query)
+    expect(helper.resolve_batch(%w{bar}, options: ["--enablerepo=extras"]).first[:available]).to eql(Chef::Provider::Package::Dnf::Version.new("bar", "0:2.0-1", "noarch"))
+    expect(helper.resolve_batch(%w{foo}).first[:available]).to eql(Chef::Provider::Package::Dnf::Version.new("foo", "0:1.2-3", "x86_64"))
+  end
+
+  it "only asks the helper about the packages that were not prefetched" do
+    expect(helper).to receive(:query).with(:batch, { "queries" => [{ "action" => :resolve, "provides" => "bar" }] }).and_return([bar])
+    expect(helper.resolve_batch(%w{foo bar}).map { |r| r[:available].name }).to eql(%w{foo bar})
+  end
+
+  it "forgets the resolutions when the installed packages change" do
+    allow(helper).to receive(:query).with("refresh_installed", {})
+    helper.refresh_installed
+    expect(helper).to receive(:query).with(:batch, { "queries" => [{ "action" => :resolve, "provides" => "foo" }] }).and_return([foo])
+    helper.resolve_batch(%w{foo})
+  end
+
+  it "forgets the resolutions when they are cleared" do
+    helper.clear_resolutions
+    expect(helper).to receive(:query).with(:batch, { "queries" => [{ "action" => :resolve, "provides" => "foo" }] }).and_return([foo])
+    helper.resolve_batch(%w{foo})
+  end
+end
+
+describe Chef::Provider::Package::Dnf::PythonHelper, "#read_rpm_headers" do
+  include_context "a new dnf python helper"
+
+  it "reads the versions of local rpm files with one request to the helper" do
+    expect(helper).to receive(:query).with("read_rpm_headers", { "paths" => ["/tmp/foo-1.2-3.x86_64.rpm", "/tmp/bar-2.0-1.noarch.rpm"] }).and_return([
+      [{ "name" => "foo", "version" => "0:1.2-3", "arch" => "x86_64" }],
+      [{ "name" => "bar", "version" => "1:2.0-1", "arch" => "noarch" }],
+    ])
+    expect(helper.read_rpm_headers(["/tmp/foo-1.2-3.x86_64.rpm", "/tmp/bar-2.0-1.noarch.rpm"])).to eql([
+      Chef::Provider::Package::Dnf::Version.new("foo", "0:1.2-3", "x86_64"),
+      Chef::Provider::Package::Dnf::Version.new("bar", "1:2.0-1", "noarch"),
+    ])
+  end
+
+  it "sends the helper absolute paths" do
+    expect(helper).to receive(:query).with("read_rpm_headers", { "paths" => [::File.expand_path("foo.rpm")] }).and_return([[{ "name" => "foo", "version" => "0:1.0-1", "arch" => "noarch" }]])
+    helper.read_rpm_headers(["foo.rpm"])
+  end
+end
+
+describe Chef::Provider::Package::Dnf::PythonHelper, "#installed_index" do
+  include_context "a new dnf python helper"
+
+  let(:snapshot) do
+    {
+      "arch" => "x86_64",
+      "installonlypkgs" => %w{kernel},
+      "packages" => [["foo", "0:1.2-3", "x86_64", false]],
+      "rpmdb" => { "path" => "/var/lib/rpm", "cookie" => [] },
+    }
+  end
+
+  before do
+    allow_any_instance_of(Chef::Provider::Package::Dnf::InstalledIndex).to receive(:current?).and_return(true)
+  end
+
+  it "answers whatinstalled queries from one snapshot of the installed packages" do
+    expect(helper).to receive(:query).with("snapshot_installed", {}).once.and_return(snapshot)
+    2.times do
+      expect(helper.package_query(:whatinstalled, "foo")).to eql(Chef::Provider::Package::Dnf::Version.new("foo", "0:1.2-3", "x86_64"))
+    end
+  end
+
+  it "asks the helper about anything that is not in the snapshot" do
+    expect(helper).to receive(:query).with("snapshot_installed", {}).and_return(snapshot)
+    expect(helper).to receive(:query).with(:whatinstalled, { "provides" => "bar", "version" => nil, "arch" => nil }).and_return([])
+    expect(helper.package_query(:whatinstalled, "bar")).to eql(Chef::Provider::Package::Dnf::Version.new("bar", nil, nil))
+  end
+
+  it "only sends the packages that are not in the snapshot in a batch" do
+    expect(helper).to receive(:query).with("snapshot_installed", {}).and_return(snapshot)
+    expect(helper).to receive(:query).with(:batch, {
+      "queries" => [{ "action" => :whatinstalled, "provides" => "bar" }],
+    }).and_return([[{ "name" => "bar", "version" => "0:2.0-1", "arch" => "noarch" }]])
+    expect(helper.package_query_batch(:whatinstalled, %w{foo bar})).to eql([
+      Chef::Provider::Package::Dnf::Version.new("foo", "0:1.2-3", "x86_64"),
+      Chef::Provider::Package::Dnf::Version.new("bar", "0:2.0-1", "noarch"),
+    ])
+  end
+
+  it "takes a new snapshot after the installed packages are refreshed" do
+    expect(helper).to receive(:query).with("snapshot_installed", {}).twice.and_return(snapshot)
+    expect(helper).to receive(:query).with("refresh_installed", {})
+    helper.package_query(:whatinstalled, "foo")
+    helper.refresh_installed
+    helper.package_query(:whatinstalled, "foo")
+  end
+end
+
+describe Chef::Provider::Package::Dnf::PythonHelper, "#helper_env" do
+  include_context "a new dnf python helper"
+
+  it "does not limit the memory of the helper by default" do
+    expect(helper.helper_env.keys).not_to include("CHEF_DNF_HELPER_MEMORY_BUDGET", "CHEF_DNF_HELPER_IDLE_TIMEOUT")
+  end
+
+  it "passes the memory budget and the idle timeout to the helper" do
+    Chef::Config[:dnf_helper_memory_budget] = 512
+    Chef::Config[:dnf_helper_idle_timeout] = 300
+    expect(helper.helper_env).to include("CHEF_DNF_HELPER_MEMORY_BUDGET" => "512", "CHEF_DNF_HELPER_IDLE_TIMEOUT" => "300")
+  end
+
+  it "passes the metadata policy to the helper" do
+    expect(helper.helper_env).to include("CHEF_DNF_HELPER_METADATA_POLICY" => "expire")
+    Chef::Config[:dnf_helper_metadata_policy] = "cache_only"
+    expect(helper.helper_env).to include("CHEF_DNF_HELPER_METADATA_POLICY" => "cache_only")
+  end
+
+  it "passes the size of the process pool for loading the metadata to the helper" do
+    expect(helper.helper_env.keys).not_to include("CHEF_DNF_HELPER_PARALLEL_LOAD")
+    Chef::Config[:dnf_helper_parallel_load] = 4
+    expect(helper.helper_env).to include("CHEF_DNF_HELPER_PARALLEL_LOAD" => "4")
+  end
+
+  it "passes the metadata snapshot to the helper when there is one" do
+    expect(helper.helper_env.keys).not_to include("CHEF_DNF_HELPER_SNAPSHOT")
+    Chef::Config[:dnf_helper_snapshot] = "/srv/dnf-snapshot"
+    expect(helper.helper_env).to include("CHEF_DNF_HELPER_SNAPSHOT" => "/srv/dnf-snapshot")
+  end
+end
+
+describe Chef::Provider::Package::Dnf::PythonHelper, "metadata snapshots" do
+  include_context "a new dnf python helper"
+
+  it "exports the metadata of the repos of the resource" do
+    expect(helper).to receive(:query).with("export_snapshot", { "path" => "/srv/dnf-snapshot", "repos" => [{ "enable" => "extras" }] }).and_return(%w{extras})
+    expect(helper.export_snapshot("/srv/dnf-snapshot", options: ["--enablerepo=extras"])).to eql(%w{extras})
+  end
+
+  it "imports a snapshot with an absolute path" do
+    result = { "imported" => %w{base}, "current" => [], "skipped" => {} }
+    expect(helper).to receive(:query).with("import_snapshot", { "path" => ::File.expand_path("dnf-snapshot") }).and_return(result)
+    expect(helper.import_snapshot("dnf-snapshot")).to eql(result)
+  end
+end
+
+describe Chef::Provider::Package::Dnf::PythonHelper, "#flush_cache" do
+  include_context "a new dnf python helper"
+
+  before { allow(helper).to receive(:restart) }
+
+  it "leaves refreshing the metadata to its expiry by default" do
+    expect(helper).not_to receive(:query).with("refresh_metadata", anything)
+    helper.flush_cache
+  end
+
+  it "refreshes the metadata of the repos of the resource unless it expires by itself" do
+    Chef::Config[:dnf_helper_metadata_policy] = "never_expire"
+    expect(helper).to receive(:query).with("refresh_metadata", { "repos" => [{ "enable" => "extras" }] }).and_return({ "extras" => 0.5 })
+    helper.flush_cache(options: ["--enablerepo=extras"])
+  end
+end
+
+describe Chef::Provider::Package::Dnf::PythonHelper, "#backend_info" do
+  include_context "a new dnf python helper"
+
+  it "asks the helper only once" do
+    expect(helper).to receive(:query).with("backend_info", {}).once.and_return({ "dnf_version" => 5, "cli_version" => 5 })
+    2.times { expect(helper.backend_info).to eql({ "dnf_version" => 5, "cli_version" => 5 }) }
+  end
+end
+
+describe Chef::Provider::Package::Dnf::PythonHelper, "#transaction" do
+  include_context "a new dnf python helper"
+
+  let(:outpipe) { StringIO.new }
+
+  before do
+    allow(helper).to receive(:check)
+    helper.outpipe = outpipe
+  end
+
+  it "sends the packages and the repo options of the transaction to the helper" do
+    helper.inpipe = StringIO.new(FFI_Yajl::Encoder.encode({ "id" => 1, "result" => { "installed" => ["foo-1.2-3.x86_64"], "removed" => [] } }) + "\n")
+    result = helper.transaction(:install, ["foo-0:1.2-3.x86_64"], options: ["--enablerepo=bar"])
+    expect(result).to eql({ "installed" => ["foo-1.2-3.x86_64"], "removed" => [] })
+    request = FFI_Yajl::Parser.parse(outpipe.string)
+    expect(request).to include("action" => "install", "packages" => ["foo-0:1.2-3.x86_64"], "repos" => [{ "enable" => "bar" }])
+  end
+
+  it "does not retry a transaction that failed" do
+    helper.inpipe = StringIO.new("")
+    expect(helper).to receive(:restart).once
+    expect { helper.transaction(:remove, ["foo-0:1.2-3.x86_64"]) }.to raise_error(EOFError)
+  end
+end
+
+describe Chef::Provider::Package::Dnf::PythonHelper, "daemon" do
+  include_context "a new dnf python helper"
+
+  let(:socket_path) { "/run/chef/dnf_helper.sock" }
+  let(:socket) { double("UNIXSocket", close: nil) }
+
+  before do
+    Chef::Config[:dnf_helper_socket] = socket_path
+  end
+
+  it "connects to the daemon socket when it exists" do
+    allow(::File).to receive(:socket?).with(socket_path).and_return(true)
+    expect(UNIXSocket).to receive(:new).with(socket_path).and_return(socket)
+    expect(Open3).not_to receive(:popen3)
+    helper.start
+    expect(helper.inpipe).to eql(socket)
+    expect(helper.outpipe).to eql(socket)
+  end
+
+  it "starts a helper process when the daemon socket does not exist" do
+    allow(::File).to receive(:socket?).with(socket_path).and_return(false)
+    allow(helper).to receive(:dnf_command).and_return("/usr/bin/python3 dnf_helper.py")
+    expect(UNIXSocket).not_to receive(:new)
+    expect(Open3).to receive(:popen3).and_return([nil, nil, nil, nil])
+    helper.start
+    expect(helper.socket).to be_nil
+  end
+
+  it "starts a helper process when the daemon does not accept connections" do
+    allow(::File).to receive(:socket?).with(socket_path).and_return(true)
+    allow(helper).to receive(:dnf_command).and_return("/usr/bin/python3 dnf_helper.py")
+    expect(UNIXSocket).to receive(:new).with(socket_path).and_raise(Errno::ECONNREFUSED)
+    expect(Open3).to receive(:popen3).and_return([nil, nil, nil, nil])
+    helper.start
+    expect(helper.socket).to be_nil
+  end
+
+  it "asks the daemon to drop its sacks instead of restarting it on flush_cache" do
+    allow(::File).to receive(:socket?).with(socket_path).and_return(true)
+    allow(UNIXSocket).to receive(:new).with(socket_path).and_return(socket)
+    expect(helper).to receive(:query).with("flush_cache", {})
+    helper.flush_cache
+  end
+end
@@ -0,0 +1,72 @@
+#
+# Copyright:: Copyright (c) 2009-2026 Progress Software Corporation and/or its subsidiaries or affiliates. All Rights Reserved.
+# License:: Apache License, Version 2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+require "spec_helper"
+
+describe Chef::Provider::Package::Dnf::StatsCollector do
+  let(:collector) { Chef::Provider::Package::Dnf::StatsCollector.new }
+  let(:node) { Chef::Node.new }
+  let(:events) { Chef::EventDispatch::Dispatcher.new }
+  let(:run_context) { Chef::RunContext.new(node, {}, events) }
+  let(:python_helper) { double("PythonHelper", running?: true) }
+  let(:stats) { { "phases" => {}, "queries" => {} } }
+  let(:converged) { Chef::Resource::DnfPackage.new("foo", run_context) }
+  let(:skipped) { Chef::Resource::DnfPackage.new("bar", run_context) }
+
+  before do
+    allow(Chef::Provider::Package::Dnf::PythonHelper).to receive(:instance).and_return(python_helper)
+    converged.executed_by_runner = true
+    run_context.resource_collection << converged
+    run_context.resource_collection << skipped
+    collector.converge_start(run_context)
+  end
+
+  it "asks the helper for its stats once and saves them in the run state of the node" do
+    expect(python_helper).to receive(:stats).once.and_return(stats)
+    collector.converge_complete
+    expect(node.run_state[:dnf_helper_stats]).to eql(stats)
+  end
+
+  it "logs the stats once for the whole run" do
+    allow(python_helper).to receive(:stats).and_return(stats)
+    expect(Chef::Log).to receive(:info).with("dnf python helper stats: #{stats}").once
+    collector.converge_complete
+  end
+
+  it "collects the stats when the converge fails" do
+    expect(python_helper).to receive(:stats).once.and_return(stats)
+    collector.converge_failed(RuntimeError.new)
+    expect(node.run_state[:dnf_helper_stats]).to eql(stats)
+  end
+
+  it "does not start the helper to ask for its stats" do
+    allow(python_helper).to receive(:running?).and_return(false)
+    expect(python_helper).not_to receive(:stats)
+    collector.converge_complete
+  end
+
+  it "does not ask for the stats when no dnf_package resource was converged" do
+    converged.executed_by_runner = false
+    expect(python_helper).not_to receive(:stats)
+    collector.converge_complete
+  end
+
+  it "does not fail the run if the helper cannot answer" do
+    expect(python_helper).to receive(:stats).and_raise(Chef::Exceptions::Package, "dnf_helper.py failed")
+    expect { collector.converge_complete }.not_to raise_error
+  end
+end
@@ -0,0 +1,41 @@
+#
+# Copyright:: Copyright (c) 2009-2026 Progress Software Corporation and/or its subsidiaries or affiliates. All Rights Reserved.
+# License:: Apache License, Version 2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+require "spec_helper"
+
+describe Chef::Provider::Package::Dnf::VersionCompare do
+  let(:corpus) do
+    File.readlines(File.join(CHEF_SPEC_DATA, "dnf", "version_compare_corpus.txt")).reject { |l| l.start_with?("#") || l.strip.empty? }.map(&:split)
+  end
+
+  it "matches rpm for every entry in the differential corpus" do
+    corpus.each do |version1, version2, expected|
+      expect(described_class.compare(version1, version2)).to eql(expected.to_i), "#{version1} <=> #{version2} should be #{expected}"
+    end
+  end
+
+  it "returns 0 when either version is nil" do
+    expect(described_class.compare(nil, "1.0")).to eql(0)
+    expect(described_class.compare("1.0", nil)).to eql(0)
+  end
+
+  it "splits versions the same way as the python helper" do
+    expect(described_class.version_tuple("1:1.2-3.el8.x86_64")).to eql(["1", "1.2", "3.el8"])
+    expect(described_class.version_tuple("1.2")).to eql(["0", "1.2", nil])
+    expect(described_class.version_tuple("1.2-3")).to eql(["0", "1.2", "3"])
+  end
+end
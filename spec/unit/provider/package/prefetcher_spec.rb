@@ -0,0 +1,93 @@
+#
+# Copyright:: Copyright (c) 2009-2026 Progress Software Corporation and/or its subsidiaries or affiliates. All Rights Reserved.
+# License:: Apache License, Version 2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+require "spec_helper"
+
+describe Chef::Provider::Package::Prefetcher do
+  let(:prefetcher) { Chef::Provider::Package::Prefetcher.new }
+  let(:node) { Chef::Node.new }
+  let(:events) { Chef::EventDispatch::Dispatcher.new }
+  let(:run_context) { Chef::RunContext.new(node, {}, events) }
+  let(:dnf_helper) { double("Dnf::PythonHelper") }
+  let(:yum_helper) { double("Yum::PythonHelper") }
+  let(:resolver) { double("ProviderResolver", resolve: Chef::Provider::Package::Dnf) }
+
+  def add_resource(klass, name, &block)
+    resource = klass.new(name, run_context)
+    resource.instance_eval(&block) if block
+    run_context.resource_collection << resource
+    resource
+  end
+
+  before do
+    allow(Chef::Provider::Package::Dnf::PythonHelper).to receive(:instance).and_return(dnf_helper)
+    allow(Chef::Provider::Package::Yum::PythonHelper).to receive(:instance).and_return(yum_helper)
+    allow(Chef::ProviderResolver).to receive(:new).and_return(resolver)
+    add_resource(Chef::Resource::DnfPackage, "foo")
+    add_resource(Chef::Resource::DnfPackage, "multi") do
+      package_name %w{bar baz}
+      version %w{1.0 2.0}
+      options "--enablerepo=extras"
+    end
+  end
+
+  it "does nothing unless package_helper_prefetch is set" do
+    Chef::Config[:package_helper_prefetch] = false
+    expect(dnf_helper).not_to receive(:prefetch_resolutions)
+    prefetcher.converge_start(run_context)
+  end
+
+  context "with package_helper_prefetch set" do
+    before { Chef::Config[:package_helper_prefetch] = true }
+
+    it "prefetches every package of the run with one call to the helper" do
+      expect(dnf_helper).to receive(:prefetch_resolutions).once.with([
+        ["foo", nil, nil, nil],
+        ["bar", "1.0", nil, ["--enablerepo=extras"]],
+        ["baz", "2.0", nil, ["--enablerepo=extras"]],
+      ])
+      prefetcher.converge_start(run_context)
+    end
+
+    it "sends packages to the helper of the provider that they resolve to" do
+      allow(resolver).to receive(:resolve).and_return(Chef::Provider::Package::Yum)
+      expect(yum_helper).to receive(:prefetch_resolutions).once
+      expect(dnf_helper).not_to receive(:prefetch_resolutions)
+      prefetcher.converge_start(run_context)
+    end
+
+    it "skips source packages and lazy properties" do
+      add_resource(Chef::Resource::DnfPackage, "local") { source "/tmp/local.rpm" }
+      add_resource(Chef::Resource::DnfPackage, "later") { version lazy { "1.0" } }
+      add_resource(Chef::Resource::AptPackage, "apt")
+      expect(dnf_helper).to receive(:prefetch_resolutions) { |packages| expect(packages.map(&:first)).to eql(%w{foo bar baz}) }
+      prefetcher.converge_start(run_context)
+    end
+
+    it "does not fail the run if the helper cannot be started" do
+      expect(dnf_helper).to receive(:prefetch_resolutions).and_raise(Chef::Exceptions::Package, "cannot find dnf libraries")
+      expect { prefetcher.converge_start(run_context) }.not_to raise_error
+    end
+
+    it "clears the resolutions at the end of the converge phase" do
+      allow(dnf_helper).to receive(:prefetch_resolutions)
+      prefetcher.converge_start(run_context)
+      expect(dnf_helper).to receive(:clear_resolutions)
+      prefetcher.converge_complete
+    end
+  end
+end
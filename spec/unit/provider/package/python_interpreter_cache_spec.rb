@@ -0,0 +1,66 @@
+#
+# Copyright:: Copyright (c) 2009-2026 Progress Software Corporation and/or its subsidiaries or affiliates. All Rights Reserved.
+# License:: Apache License, Version 2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+require "spec_helper"
+
+describe Chef::Provider::Package::PythonInterpreterCache do
+  let(:cache) { Chef::Provider::Package::PythonInterpreterCache.new("dnf") }
+  let(:tmpdir) { Dir.mktmpdir }
+  let(:python3) { File.join(tmpdir, "python3") }
+  let(:python2) { File.join(tmpdir, "python2") }
+  let(:candidates) { [python3, python2] }
+
+  before do
+    Chef::Config[:file_cache_path] = File.join(tmpdir, "cache")
+    FileUtils.touch([python3, python2])
+  end
+
+  after { FileUtils.rm_rf(tmpdir) }
+
+  it "probes the candidates in order until one succeeds" do
+    probed = []
+    expect(cache.find(candidates) { |f| probed << f; f == python2 }).to eql(python2)
+    expect(probed).to eql([python3, python2])
+  end
+
+  it "does not probe the candidates again on the next run" do
+    cache.find(candidates) { |f| f == python2 }
+    expect(Chef::Provider::Package::PythonInterpreterCache.new("dnf").find(candidates) { raise "probed" }).to eql(python2)
+  end
+
+  it "probes the candidates again when one of them changes" do
+    cache.find(candidates) { |f| f == python2 }
+    File.utime(Time.now + 60, Time.now + 60, python3)
+    expect(cache.find(candidates) { true }).to eql(python3)
+  end
+
+  it "probes the candidates again when the list of them changes" do
+    cache.find(candidates) { |f| f == python2 }
+    expect(cache.find([python3]) { true }).to eql(python3)
+  end
+
+  it "probes the candidates again once it is told to forget" do
+    cache.find(candidates) { |f| f == python2 }
+    cache.forget
+    expect(cache.find(candidates) { true }).to eql(python3)
+  end
+
+  it "does not remember that no candidate worked" do
+    expect(cache.find(candidates) { false }).to be_nil
+    expect(cache.find(candidates) { true }).to eql(python3)
+  end
+end
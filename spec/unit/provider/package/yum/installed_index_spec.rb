@@ -0,0 +1,76 @@
+#
+# Copyright:: Copyright (c) 2009-2026 Progress Software Corporation and/or its subsidiaries or affiliates. All Rights Reserved.
+# License:: Apache License, Version 2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+require "spec_helper"
+
+describe Chef::Provider::Package::Yum::InstalledIndex do
+  let(:rpmdb) { Dir.mktmpdir }
+  let(:index) do
+    described_class.new("installonlypkgs" => %w{kernel}, "rpmdb" => { "path" => rpmdb }, "packages" => [
+      ["kernel", "0:3.10.0-1", "x86_64"],
+      ["kernel", "0:3.10.0-2", "x86_64"],
+      ["glibc", "0:2.17-1", "x86_64"],
+      ["glibc", "0:2.17-1", "i686"],
+      ["zlib", "0:1.2.7-1", "x86_64"],
+    ])
+  end
+
+  after { FileUtils.rm_rf(rpmdb) }
+
+  def version(name, version, arch)
+    Chef::Provider::Package::Yum::Version.new(name, version, arch)
+  end
+
+  it "finds a package that is installed once" do
+    expect(index.lookup("zlib")).to eql(version("zlib", "0:1.2.7-1", "x86_64"))
+    expect(index.lookup("glibc", "i686")).to eql(version("glibc", "0:2.17-1", "i686"))
+    expect(index.lookup("glibc.x86_64")).to eql(version("glibc", "0:2.17-1", "x86_64"))
+  end
+
+  it "leaves packages that are installed more than once to the python helper" do
+    expect(index.lookup("kernel")).to be_nil
+    expect(index.lookup("glibc")).to be_nil
+  end
+
+  it "leaves anything but an installed package name to the python helper" do
+    expect(index.lookup("httpd")).to be_nil
+    expect(index.lookup("zlib-1.2.7")).to be_nil
+    expect(index.lookup("zlib*")).to be_nil
+  end
+
+  it "answers the installonlypkgs query" do
+    expect(index.installonly?("kernel")).to be true
+    expect(index.installonly?("zlib")).to be false
+  end
+
+  it "goes stale when the rpmdb changes" do
+    File.write(File.join(rpmdb, "Packages"), "")
+    expect(index.current?).to be true
+    File.write(File.join(rpmdb, "Packages"), "more packages")
+    expect(index.current?).to be false
+  end
+
+  it "is not changed by the Berkeley DB environment files" do
+    expect(index.current?).to be true
+    File.write(File.join(rpmdb, "__db.001"), "")
+    expect(index.current?).to be true
+  end
+
+  it "is never current without the path of the rpmdb" do
+    expect(described_class.new("packages" => []).current?).to be false
+  end
+end
@@ -17,6 +17,14 @@
 
 require "spec_helper"
 
+shared_context "a new yum python helper" do
+  # the helper is a singleton, every example gets a new one
+  let(:helper) do
+    Singleton.__init__(Chef::Provider::Package::Yum::PythonHelper)
+    Chef::Provider::Package::Yum::PythonHelper.instance
+  end
+end
+
 # NOTE: most of the tests of this functionality are baked into the func tests for the yum package provider
 
 describe Chef::Provider::Package::Yum::PythonHelper do
@@ -28,3 +36,185 @@ describe Chef::Provider::Package::Yum::PythonHelper do
     expect { helper.package_query(:whatprovides, "tcpdump") }.to raise_error(/your hands in the air/)
   end
 end
+
+describe Chef::Provider::Package::Yum::PythonHelper, "#pipeline" do
+  include_context "a new yum python helper"
+
+  let(:outpipe) { StringIO.new }
+
+  def answers(*answers)
+    StringIO.new(answers.map { |a| FFI_Yajl::Encoder.encode(a) + "\n" }.join)
+  end
+
+  before do
+    allow(helper).to receive(:check)
+    helper.outpipe = outpipe
+  end
+
+  it "sends every request tagged with an id and matches the answers back up by id" do
+    helper.inpipe = answers({ "id" => 2, "result" => true }, { "id" => 1, "result" => -1 })
+    results = helper.pipeline([
+      ["versioncompare", { "versions" => %w{1.0 2.0} }],
+      ["installonlypkgs", { "package" => "kernel" }],
+    ])
+    expect(results).to eql([-1, true])
+    requests = outpipe.string.lines.map { |l| FFI_Yajl::Parser.parse(l) }
+    expect(requests.map { |r| r["id"] }).to eql([1, 2])
+    expect(requests.map { |r| r["protocol"] }).to eql([2, 2])
+  end
+
+  it "reads back answers before the unanswered requests could fill the pipe" do
+    helper.inpipe = answers({ "id" => 1, "result" => [] }, { "id" => 2, "result" => [] })
+    sent = []
+    allow(helper).to receive(:read_answer).and_wrap_original do |m, answers|
+      sent << outpipe.string.lines.length
+      m.call(answers)
+    end
+    paths = ["/tmp/" + "x" * (Chef::Provider::Package::Yum::PythonHelper::PIPELINE_BYTES * 3 / 4)]
+    helper.pipeline([["read_rpm_headers", { "paths" => paths }], ["read_rpm_headers", { "paths" => paths }]])
+    expect(sent).to eql([1, 2])
+  end
+
+  it "raises the error reported by the helper" do
+    helper.inpipe = answers({ "id" => 1, "error" => { "type" => "RuntimeError", "message" => "bad command" } })
+    expect { helper.pipeline([["bogus", {}]]) }.to raise_error(Chef::Exceptions::Package, /RuntimeError: bad command/)
+  end
+
+  it "resolves the available, installed and current versions of a package in one request" do
+    expect(helper).to receive(:pipeline).once.with([
+      ["resolve", { "provides" => "foo-1.0", "current" => { "provides" => "foo" } }],
+    ]).and_return([{
+      "available" => [{ "name" => "foo", "version" => "0:1.0-1", "arch" => "noarch" }],
+      "installed" => [],
+      "current" => [{ "name" => "foo", "version" => "0:0.9-1", "arch" => "noarch" }],
+      "installonly" => false,
+    }])
+    expect(helper.resolve("foo", version: "1.0")).to eql({
+      available: Chef::Provider::Package::Yum::Version.new("foo", "0:1.0-1", "noarch"),
+      installed: Chef::Provider::Package::Yum::Version.new("foo-1.0", nil, nil),
+      current: Chef::Provider::Package::Yum::Version.new("foo", "0:0.9-1", "noarch"),
+      installonly: false,
+    })
+  end
+
+  it "closes the rpmdb around a repo-scoped query in the same round-trip" do
+    expect(helper).to receive(:pipeline).once.with([
+      ["close_rpmdb", {}],
+      [:whatavailable, { "provides" => "foo", "repos" => [{ "enable" => "bar" }] }],
+      ["close_rpmdb", {}],
+    ]).and_return([nil, [{ "name" => "foo", "version" => "0:1.0-1", "arch" => "noarch" }], nil])
+    expect(helper.package_query(:whatavailable, "foo", options: ["--enablerepo=bar"])).to eql(Chef::Provider::Package::Yum::Version.new("foo", "0:1.0-1", "noarch"))
+  end
+end
+
+describe Chef::Provider::Package::Yum::PythonHelper, "#prefetch_resolutions" do
+  include_context "a new yum python helper"
+
+  let(:foo) { { "available" => [{ "name" => "foo", "version" => "0:1.2-3", "arch" => "x86_64" }], "installed" => [], "current" => [], "installonly" => false } }
+  let(:bar) { { "available" => [{ "name" => "bar", "version" => "0:2.0-1", "arch" => "noarch" }], "installed" => [], "current" => [], "installonly" => false } }
+
+  before do
+    expect(helper).to receive(:pipeline).once.with([
+      ["resolve", { "provides" => "foo" }],
+      ["close_rpmdb", {}],
+      ["resolve", { "provides" => "bar", "repos" => [{ "enable" => "extras" }] }],
+      ["close_rpmdb", {}],
+    ]).and_return([foo, nil, bar, nil])
+    expect(helper.prefetch_resolutions([["foo", nil, nil, []], ["bar", nil, nil, ["--enablerepo=extras"]]])).to eql(2)
+  end
+
+  it "resolves every package in one round-trip" do
+    expect(helper.resolve("foo")[:available]).to eql(Chef::Provider::Package::Yum::Version.new("foo", "0:1.2-3", "x86_64"))
+    expect(helper.resolve("bar", options: ["--enablerepo=extras"])[:available]).to eql(Chef::Provider::Package::Yum::Version.new("bar", "0:2.0-1", "noarch"))
+  end
+
+  it "forgets the resolutions when the rpmdb is closed" do
+    allow(helper).to receive(:query).with("close_rpmdb", {})
+    helper.close_rpmdb
+    expect(helper).to receive(:pipeline).with([["resolve", { "provides" => "foo" }]]).and_return([foo])
+    helper.resolve("foo")
+  end
+end
+
+describe Chef::Provider::Package::Yum::PythonHelper, "#package_query_all" do
+  include_context "a new yum python helper"
+
+  let(:matches) do
+    [
+      { "name" => "foo", "version" => "0:1.2-3", "arch" => "x86_64", "repo" => "updates" },
+      { "name" => "foo", "version" => "0:1.1-1", "arch" => "x86_64", "repo" => "base" },
+    ]
+  end
+
+  it "returns every matching package with its repo from one request until the rpmdb is closed" do
+    expect(helper).to receive(:pipeline).with([[:whatavailable_all, { "provides" => "foo" }]]).twice.and_return([matches])
+    expect(helper).to receive(:query).with("close_rpmdb", {})
+    2.times do
+      result = helper.package_query_all(:whatavailable, "foo")
+      expect(result).to eql([
+        Chef::Provider::Package::Yum::Version.new("foo", "0:1.2-3", "x86_64"),
+        Chef::Provider::Package::Yum::Version.new("foo", "0:1.1-1", "x86_64"),
+      ])
+      expect(result.map(&:repo)).to eql(%w{updates base})
+    end
+    helper.close_rpmdb
+    helper.package_query_all(:whatavailable, "foo")
+  end
+
+  it "leaves the matching of a version to the helper" do
+    expect(helper).to receive(:pipeline).with([[:whatavailable_all, { "provides" => "foo-1.*.x86_64" }]]).and_return([matches])
+    expect(helper.package_query_all(:whatavailable, "foo", version: "1.*", arch: "x86_64").length).to eql(2)
+  end
+end
+
+describe Chef::Provider::Package::Yum::PythonHelper, "#read_rpm_headers" do
+  include_context "a new yum python helper"
+
+  it "reads the versions of local rpm files with one request to the helper" do
+    expect(helper).to receive(:query).with("read_rpm_headers", { "paths" => ["/tmp/foo-1.2-3.x86_64.rpm", "/tmp/bar-2.0-1.noarch.rpm"] }).and_return([
+      [{ "name" => "foo", "version" => "0:1.2-3", "arch" => "x86_64" }],
+      [{ "name" => "bar", "version" => "1:2.0-1", "arch" => "noarch" }],
+    ])
+    expect(helper.read_rpm_headers(["/tmp/foo-1.2-3.x86_64.rpm", "/tmp/bar-2.0-1.noarch.rpm"])).to eql([
+      Chef::Provider::Package::Yum::Version.new("foo", "0:1.2-3", "x86_64"),
+      Chef::Provider::Package::Yum::Version.new("bar", "1:2.0-1", "noarch"),
+    ])
+  end
+
+  it "sends the helper absolute paths" do
+    expect(helper).to receive(:query).with("read_rpm_headers", { "paths" => [::File.expand_path("foo.rpm")] }).and_return([[{ "name" => "foo", "version" => "0:1.0-1", "arch" => "noarch" }]])
+    helper.read_rpm_headers(["foo.rpm"])
+  end
+end
+
+describe Chef::Provider::Package::Yum::PythonHelper, "#installed_index" do
+  include_context "a new yum python helper"
+
+  let(:snapshot) { { "installonlypkgs" => %w{kernel}, "packages" => [%w{foo 0:1.2-3 x86_64}], "rpmdb" => { "path" => "/var/lib/rpm" } } }
+
+  before do
+    allow_any_instance_of(Chef::Provider::Package::Yum::InstalledIndex).to receive(:current?).and_return(true)
+  end
+
+  it "answers whatinstalled and installonlypkgs queries from one snapshot of the installed packages" do
+    expect(helper).to receive(:query).with("snapshot_installed", {}).once.and_return(snapshot)
+    expect(helper.package_query(:whatinstalled, "foo")).to eql(Chef::Provider::Package::Yum::Version.new("foo", "0:1.2-3", "x86_64"))
+    expect(helper.install_only_packages("kernel")).to be true
+  end
+
+  it "takes a new snapshot after the rpmdb is closed" do
+    expect(helper).to receive(:query).with("snapshot_installed", {}).twice.and_return(snapshot)
+    expect(helper).to receive(:query).with("close_rpmdb", {})
+    helper.package_query(:whatinstalled, "foo")
+    helper.close_rpmdb
+    helper.package_query(:whatinstalled, "foo")
+  end
+
+  it "has the helper reload the rpmdb when something else changed it" do
+    expect(helper).to receive(:query).with("snapshot_installed", {}).twice.and_return(snapshot)
+    helper.package_query(:whatinstalled, "foo")
+    allow_any_instance_of(Chef::Provider::Package::Yum::InstalledIndex).to receive(:current?).and_return(false)
+    expect(helper).to receive(:query).with("close_rpmdb", {})
+    helper.package_query(:whatinstalled, "foo")
+  end
+end
@@ -22,8 +22,8 @@ describe Chef::Provider::Package::Yum::YumCache do
 
   let(:python_helper) { instance_double(Chef::Provider::Package::Yum::PythonHelper) }
 
-  def yum_version(name, version, arch)
-    Chef::Provider::Package::Yum::Version.new(name, version, arch)
+  def yum_version(name, version, arch, repo = nil)
+    Chef::Provider::Package::Yum::Version.new(name, version, arch, repo)
   end
 
   before(:each) do
@@ -40,26 +40,33 @@ describe Chef::Provider::Package::Yum::YumCache do
     expect( yum_cache.package_available?("foo") ).to be true
   end
 
-  it "version_available? returns false if the helper reports the available version is nil" do
-    expect( python_helper ).to receive(:package_query).with(:whatavailable, "foo", version: "1.2.3", arch: nil).and_return( yum_version("foo", nil, nil) )
+  it "version_available? returns false if the helper reports no available versions" do
+    expect( python_helper ).to receive(:package_query_all).with(:whatavailable, "foo", version: "1.2.3", arch: nil).and_return([])
     expect( yum_cache.version_available?("foo", "1.2.3") ).to be false
   end
 
   it "version_available? returns true if the helper returns an available version" do
-    expect( python_helper ).to receive(:package_query).with(:whatavailable, "foo", version: "1.2.3", arch: nil).and_return( yum_version("foo", "1.2.3-1", "x86_64") )
+    expect( python_helper ).to receive(:package_query_all).with(:whatavailable, "foo", version: "1.2.3", arch: nil).and_return([ yum_version("foo", "0:1.2.3-1", "x86_64", "base") ])
     expect( yum_cache.version_available?("foo", "1.2.3") ).to be true
   end
 
-  it "version_available? with an arch returns false if the helper reports the available version is nil" do
-    expect( python_helper ).to receive(:package_query).with(:whatavailable, "foo", version: "1.2.3", arch: "x86_64").and_return( yum_version("foo", nil, nil) )
+  it "version_available? with an arch returns false if the helper reports no available versions" do
+    expect( python_helper ).to receive(:package_query_all).with(:whatavailable, "foo", version: "1.2.3", arch: "x86_64").and_return([])
     expect( yum_cache.version_available?("foo", "1.2.3", "x86_64") ).to be false
   end
 
   it "version_available? with an arch returns true if the helper returns an available version" do
-    expect( python_helper ).to receive(:package_query).with(:whatavailable, "foo", version: "1.2.3", arch: "x86_64").and_return( yum_version("foo", "1.2.3-1", "x86_64") )
+    expect( python_helper ).to receive(:package_query_all).with(:whatavailable, "foo", version: "1.2.3", arch: "x86_64").and_return([ yum_version("foo", "0:1.2.3-1", "x86_64", "base") ])
     expect( yum_cache.version_available?("foo", "1.2.3", "x86_64") ).to be true
   end
 
+  it "version_available? leaves globs and version constraints to the helper" do
+    expect( python_helper ).to receive(:package_query_all).with(:whatavailable, "foo", version: "1.1-*", arch: nil).and_return([ yum_version("foo", "0:1.1-4", "x86_64", "base") ])
+    expect( python_helper ).to receive(:package_query_all).with(:whatavailable, "foo", version: ">= 2", arch: nil).and_return([])
+    expect( yum_cache.version_available?("foo", "1.1-*") ).to be true
+    expect( yum_cache.version_available?("foo", ">= 2") ).to be false
+  end
+
   %i{refresh reload reload_installed reload_provides reset reset_installed}.each do |method|
     it "restarts the python helper when #{method} is called" do
       expect( python_helper ).to receive(:restart)